@@ -9,12 +9,25 @@ class UploadFileForm(FlaskForm):
     upload = SubmitField("Upload File")                     # The submit field
     next = SubmitField("Next")
 
+# Operation codes as understood by the processing server
+OPERATION_CHOICES = [(1, 'Detect Edges'), (2, 'Image Blurring'), (3, 'Gray Scale'), (4, 'Color Inversion')]
+# Maximum number of operations that can be chained on one image
+MAX_PIPELINE_STEPS = 4
+
 class ChooseOperationForm(FlaskForm):
     # Declare our form variables
     imageName = StringField('image name:')
-    operation = SelectField("Operation", choices=[(1, 'Detect Edges'), (2, 'Image Blurring'), (3, 'Color Inversion'), (4, 'Gray Scale')])
+    operation = SelectField("Operation", choices=OPERATION_CHOICES, coerce=int)
+    # Further operations applied in order after the first one, in the same pass on the server
+    then = FieldList(SelectField("Then", choices=[(0, '-')] + OPERATION_CHOICES, coerce=int, default=0),
+                     min_entries=MAX_PIPELINE_STEPS - 1, max_entries=MAX_PIPELINE_STEPS - 1)
     # submit = SubmitField("Upload File")                     # The submit field
 
+    @staticmethod
+    def pipeline(entry):
+        # Ordered list of operation codes chosen for one image
+        return [entry['operation']] + [operation for operation in entry['then'] if operation]
+
 class ChooseOperationsForm(FlaskForm):
     # Declare the list of files and choices
     operations = FieldList(FormField(ChooseOperationForm), min_entries= 1)
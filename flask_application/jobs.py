@@ -0,0 +1,135 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from remote_procedure_calls import FORMAT_EXTENSIONS, process_images
+from session_store import PENDING, DONE, FAILED
+
+# Background processing of image batches.  Submitting a batch returns a job
+# id at once; a pool thread talks to the processing server and stores every
+# processed image on disk the moment it comes back, so it can be downloaded
+# while the rest of the batch is still running.  Job progress lives in the
+# session store, so any worker process can answer for it.
+
+# How many batches talk to the processing server at the same time
+MAX_RUNNING_JOBS = 4
+# Seconds a finished job's results, and an idle session's uploads, are kept
+RESULT_TTL = float(os.environ.get('RESULT_TTL', 24 * 3600))
+# Expired jobs and sessions are looked for at most this often, on submit and upload
+CLEANUP_INTERVAL = 60
+
+
+class JobManager:
+    def __init__(self, store, results_folder, uploads_folder, max_running=MAX_RUNNING_JOBS, ttl=RESULT_TTL):
+        self.store = store
+        self.results_folder = results_folder
+        self.uploads_folder = uploads_folder
+        self.ttl = ttl
+        self.next_cleanup = 0
+        self.executor = ThreadPoolExecutor(max_workers=max_running, thread_name_prefix='image-job')
+        # Jobs run by this process, for the admin page
+        self.stats = {'jobs_submitted': 0, 'jobs_running': 0, 'jobs_finished': 0, 'images_done': 0,
+                      'images_failed': 0, 'job_seconds': 0.0, 'jobs_expired': 0, 'sessions_expired': 0}
+        self.stats_lock = threading.Lock()
+
+    def count(self, **changes):
+        with self.stats_lock:
+            for name, amount in changes.items():
+                self.stats[name] += amount
+
+    def statistics(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats['mean_job_seconds'] = stats['job_seconds'] / stats['jobs_finished'] if stats['jobs_finished'] else None
+        return stats
+
+    def reap(self):
+        # Drop finished jobs and idle sessions older than the TTL, with their files
+        now = time.time()
+        with self.stats_lock:
+            if now < self.next_cleanup:
+                return
+            self.next_cleanup = now + CLEANUP_INTERVAL
+        job_ids, session_ids = self.store.expire(now - self.ttl)
+        for job_id in job_ids:
+            shutil.rmtree(os.path.join(self.results_folder, job_id), ignore_errors=True)
+        uploads_folder = os.path.realpath(self.uploads_folder)
+        for session_id in session_ids:
+            # The id comes from the session cookie, only ever remove a folder directly below the uploads
+            folder = os.path.realpath(os.path.join(uploads_folder, session_id))
+            if os.path.dirname(folder) == uploads_folder:
+                shutil.rmtree(folder, ignore_errors=True)
+        self.count(jobs_expired=len(job_ids), sessions_expired=len(session_ids))
+
+    def submit(self, session_id, msg):
+        self.reap()
+        job_id = uuid.uuid4().hex
+        self.store.create_job(job_id, session_id, msg)
+        self.count(jobs_submitted=1)
+        self.executor.submit(self.run, job_id, msg)
+        return job_id
+
+    def get(self, job_id, session_id):
+        # Jobs are only visible to the session that submitted them
+        job = self.store.get_job(job_id)
+        if job is None or job['session'] != session_id:
+            return None
+        return job
+
+    def result_path(self, job, index):
+        image = job['images'][index]
+        return os.path.join(self.results_folder, job['id'], image['file']) if image['status'] == DONE else None
+
+    def run(self, job_id, msg):
+        folder = os.path.join(self.results_folder, job_id)
+        started = time.monotonic()
+        self.count(jobs_running=1)
+
+        def image_done(index, image_bytes, output_format, error):
+            # Called from this pool thread as each result arrives
+            if error is not None:
+                self.store.update_image(job_id, index, FAILED, error=error)
+                self.count(images_failed=1)
+                return
+            name, _ = os.path.splitext(os.path.basename(msg[index]['image']))
+            filename = f"{index}_{name}.{FORMAT_EXTENSIONS.get(output_format, 'jpg')}"
+            os.makedirs(folder, exist_ok=True)
+            with open(os.path.join(folder, filename), 'wb') as file:
+                file.write(image_bytes)
+            self.store.update_image(job_id, index, DONE, file=filename)
+            self.count(images_done=1)
+
+        try:
+            process_images(msg, on_result=image_done)
+        except Exception as e:
+            print(f"Job {job_id} error: {e}")
+            for image in self.store.get_job(job_id)['images']:
+                if image['status'] == PENDING:
+                    self.store.update_image(job_id, image['index'], FAILED, error=f"Processing failed: {e}")
+                    self.count(images_failed=1)
+        finally:
+            self.store.finish_job(job_id)
+            self.count(jobs_running=-1, jobs_finished=1, job_seconds=time.monotonic() - started)
+
+    def finished_files(self, job_id, session_id, wait_timeout=15):
+        # Yields (name, path) for every processed image as soon as it is on disk, then
+        # ('errors.txt', bytes) listing the images that failed, if any did
+        written = set()
+        while True:
+            job = self.get(job_id, session_id)
+            if job is None:
+                # Expired while it was being sent
+                return
+            for image in job['images']:
+                if image['status'] == DONE and image['index'] not in written:
+                    written.add(image['index'])
+                    yield image['file'], self.result_path(job, image['index'])
+            if job['state'] == 'finished':
+                break
+            self.store.wait_for_change(job_id, job['version'], wait_timeout)
+        errors = [f"{image['name']}: {image['error']}" for image in job['images'] if image['status'] == FAILED]
+        if errors:
+            yield 'errors.txt', ('\n'.join(errors) + '\n').encode('utf-8')
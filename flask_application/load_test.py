@@ -0,0 +1,159 @@
+import argparse
+import http.cookiejar
+import io
+import json
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+from PIL import Image
+
+# Many simulated users against a running app, checking that nobody sees
+# anybody else's uploads or jobs.  Every user uploads files with the same
+# names but their own colour, inverts them and checks the colour that comes
+# back.  Several --url values are used round robin, like a load balancer in
+# front of several worker processes sharing a SQLite session store:
+#   SESSION_STORE=sqlite:////tmp/app.db flask --app main run -p 5000 &
+#   SESSION_STORE=sqlite:////tmp/app.db flask --app main run -p 5001 &
+#   python load_test.py --url http://127.0.0.1:5000 --url http://127.0.0.1:5001 --users 50
+
+OP_INVERT = 4
+POLL_INTERVAL = 0.1
+
+
+class SimulatedUser:
+    def __init__(self, number, urls, images):
+        self.number = number
+        self.urls = urls
+        self.images = images
+        self.requests = 0
+        # Own cookie jar, so its own session
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        self.colour = ((number * 37) % 200 + 20, (number * 91) % 200 + 20, (number * 53) % 200 + 20)
+        self.errors = []
+        self.latency = None
+
+    def url(self, path):
+        # Round robin over the app processes
+        self.requests += 1
+        return self.urls[self.requests % len(self.urls)] + path
+
+    def call(self, path, data=None, headers=None, method=None):
+        request = urllib.request.Request(self.url(path), data=data, headers=headers or {}, method=method)
+        try:
+            with self.opener.open(request, timeout=60) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def upload(self, filename):
+        image = Image.new('RGB', (64, 48), self.colour)
+        content = io.BytesIO()
+        image.save(content, format='PNG')
+        boundary = uuid.uuid4().hex
+        body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                f'Content-Type: image/png\r\n\r\n').encode() + content.getvalue() + f'\r\n--{boundary}--\r\n'.encode()
+        status, _ = self.call('/api/uploads', body, {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+        if status != 201:
+            self.errors.append(f"upload {filename}: HTTP {status}")
+
+    def run(self, start_barrier):
+        start_barrier.wait()
+        names = [f'image{index}.png' for index in range(self.images)]
+        for name in names:
+            self.upload(name)
+        status, body = self.call('/api/uploads')
+        if status != 200 or json.loads(body)['filenames'] != names:
+            self.errors.append(f"uploads list does not match: {body[:200]!r}")
+
+        started = time.perf_counter()
+        request = json.dumps({'images': [{'image': name, 'operations': [OP_INVERT]} for name in names]}).encode()
+        status, body = self.call('/api/jobs', request, {'Content-Type': 'application/json'})
+        if status != 202:
+            self.errors.append(f"submit: HTTP {status} {body[:200]!r}")
+            return None
+        job_id = json.loads(body)['id']
+        while True:
+            status, body = self.call(f'/api/jobs/{job_id}')
+            job = json.loads(body)
+            if status != 200 or job['state'] == 'finished':
+                break
+            time.sleep(POLL_INTERVAL)
+        self.latency = time.perf_counter() - started
+        if job.get('done') != self.images:
+            self.errors.append(f"job finished with {job.get('done')} of {self.images} images: {job.get('images')}")
+            return job_id
+        for image in job['images']:
+            status, body = self.call(image['url'])
+            if status != 200:
+                self.errors.append(f"download {image['name']}: HTTP {status}")
+                continue
+            # Someone else's upload would come back in someone else's colour
+            pixel = Image.open(io.BytesIO(body)).convert('RGB').getpixel((32, 24))
+            expected = tuple(255 - channel for channel in self.colour)
+            if any(abs(got - want) > 6 for got, want in zip(pixel, expected)):
+                self.errors.append(f"{image['name']} came back as {pixel}, expected {expected}")
+        return job_id
+
+    def probe(self, job_id):
+        # Another user's job must look like it does not exist
+        status, _ = self.call(f'/api/jobs/{job_id}')
+        if status != 404:
+            self.errors.append(f"could read another session's job {job_id}: HTTP {status}")
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent users load and isolation test")
+    parser.add_argument('--url', action='append', help="base URL of an app process, repeatable")
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--images', type=int, default=4, help="images per user")
+    args = parser.parse_args()
+    urls = [url.rstrip('/') for url in (args.url or ['http://127.0.0.1:5000'])]
+
+    users = [SimulatedUser(number, urls, args.images) for number in range(args.users)]
+    barrier = threading.Barrier(len(users))
+    job_ids = [None] * len(users)
+
+    def run(user):
+        try:
+            job_ids[user.number] = user.run(barrier)
+        except Exception as e:
+            user.errors.append(f"{type(e).__name__}: {e}")
+
+    threads = [threading.Thread(target=run, args=(user,)) for user in users]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    for user in users:
+        other = job_ids[(user.number + 1) % len(users)]
+        if other and len(users) > 1:
+            user.probe(other)
+
+    latencies = [user.latency for user in users if user.latency is not None]
+    failed = [user for user in users if user.errors]
+    total_images = args.users * args.images
+    print(f"{args.users} users x {args.images} images on {len(urls)} app process(es) in {elapsed:.2f}s "
+          f"({total_images / elapsed:.1f} images/s, {args.users / elapsed:.1f} jobs/s)")
+    if latencies:
+        print(f"job latency: median {statistics.median(latencies):.2f}s, p95 {percentile(latencies, 0.95):.2f}s, "
+              f"max {max(latencies):.2f}s")
+    print(f"isolation / correctness failures: {len(failed)} users")
+    for user in failed[:10]:
+        print(f"  user {user.number}: {user.errors[0]}")
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
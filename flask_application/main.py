@@ -1,26 +1,71 @@
-from flask import Flask, render_template, send_from_directory, redirect, url_for, Response, send_file
-from application_forms import UploadFileForm, ChooseOperationForm, ChooseOperationsForm, DownloadProcessedImageForm, DownloadProcessedImagesForm
+from flask import Flask, render_template, send_from_directory, redirect, url_for, Response, send_file, request, jsonify, abort, stream_with_context, session
+from application_forms import OPERATION_CHOICES, UploadFileForm, ChooseOperationForm, ChooseOperationsForm, DownloadProcessedImageForm, DownloadProcessedImagesForm
 from werkzeug.utils import secure_filename
 import os
+import json
+import uuid
 from PIL import Image
-from remote_procedure_calls import process_images
-import zipfile
+from jobs import JobManager
+from session_store import create_store, PENDING
+from zip_stream import stream_zip
+from remote_procedure_calls import MAX_PIPELINE_STEPS, fetch_server_metrics
 
 # Create flask application
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'mofta7_sery'    
 app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'static/images/')
+app.config['JOBS_FOLDER'] = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'static/processed_images/jobs/')
+# 'memory' for a single process, 'sqlite:////path/to/file.db' to share state between worker processes
+app.config['SESSION_STORE'] = os.environ.get('SESSION_STORE', 'memory')
+# When set, /admin pages want ?token=... or an X-Admin-Token header
+app.config['ADMIN_TOKEN'] = os.environ.get('ADMIN_TOKEN')
+
+# Seconds between keep-alive comments on an idle progress stream
+EVENT_STREAM_KEEPALIVE = 15
+# Operation codes the API accepts, the same ones the forms offer
+OPERATION_CODES = {code for code, _ in OPERATION_CHOICES}
 
 #############################################################################################
 
-# Global Variables
+# Shared state
+
+# Uploaded files and job progress, per session
+store = create_store(app.config['SESSION_STORE'])
+# Batches being processed in the background
+jobs = JobManager(store, app.config['JOBS_FOLDER'], app.config['UPLOAD_FOLDER'])
+
+def session_id():
+    # Random id kept in the signed session cookie, every browser gets its own uploads and jobs
+    if 'id' not in session:
+        session['id'] = uuid.uuid4().hex
+    return session['id']
+
+def session_folder():
+    # Uploads are kept apart per session so two users can upload files with the same name
+    folder = os.path.join(app.config['UPLOAD_FOLDER'], session_id())
+    os.makedirs(folder, exist_ok=True)
+    return folder
 
-# Create an array of uploaded files
-uploaded_files = []
-# Message to be sent to server
-msg = []
-# Processed images
-zipped_processed_images = []
+def save_upload(file):
+    filename = secure_filename(file.filename)
+    if not filename:
+        return None
+    jobs.reap()
+    file.save(os.path.join(session_folder(), filename))
+    store.add_upload(session_id(), filename)
+    return filename
+
+def build_message(entries):
+    # entries: (file name, [operation, ...]); only this session's uploads can be processed
+    uploads = set(store.list_uploads(session_id()))
+    msg = []
+    for name, operations in entries:
+        name = secure_filename(str(name))
+        if name not in uploads:
+            raise ValueError(f"Unknown image: {name}")
+        # Path relative to the upload folder, see remote_procedure_calls.process_images
+        msg.append({'image': os.path.join(session_id(), name), 'operations': operations})
+    return msg
 
 #############################################################################################
 
@@ -38,17 +83,10 @@ def home():
             if form.upload.data:
             # Grab the file
                 file = form.file.data 
-                # Save the file
-                file.save(
-                    os.path.join(
-                        os.path.abspath(os.path.dirname(__file__)),         # Application root directory
-                        app.config['UPLOAD_FOLDER'],                # Upload folder path
-                        secure_filename(file.filename)              # Secure file to be saved
-                    ))
-                # Update uploaded files array
-                uploaded_files.append(file.filename)
+                # Save the file into this session's upload folder
+                save_upload(file)
                 # Update the view
-                return render_template('upload_page.html', form= form, filenames = uploaded_files)
+                return render_template('upload_page.html', form= form, filenames = store.list_uploads(session_id()))
             if form.next.data:
                 # Return a page allowing user to choose the image and the operation required with it
                 # return redirect(url_for('choose_operation', filename= secure_filename(file.filename)))
@@ -56,7 +94,7 @@ def home():
     
 
     # Return upload page and the form
-    return render_template('upload_page.html', form= form)
+    return render_template('upload_page.html', form= form, filenames = store.list_uploads(session_id()))
 
 #############################################################################################
 
@@ -68,7 +106,7 @@ def choose_operations_get():
     form = ChooseOperationsForm()
 
     # Fill in the Form data
-    operations_data = [{'imageName': uploaded_img, 'operation': ChooseOperationForm()} for uploaded_img in uploaded_files]
+    operations_data = [{'imageName': uploaded_img} for uploaded_img in store.list_uploads(session_id())]
     form.process(data={'operations': operations_data})
 
     # Return the Form
@@ -81,9 +119,13 @@ def choose_operations_post():
     form = ChooseOperationsForm()
 
     # Construct the message
-    global msg
-    msg = [{'image': entry['imageName'], 'operation': entry['operation']} for entry in form.operations.data]
-    zipped_processed_images = process_images(msg)
+    try:
+        msg = build_message((entry['imageName'], ChooseOperationForm.pipeline(entry)) for entry in form.operations.data)
+    except ValueError as e:
+        return str(e), 400
+    # Processing runs in the background, the job page follows its progress
+    job_id = jobs.submit(session_id(), msg)
+    session['last_job'] = job_id
 
     # # Create folder for proccessed images
     # processed_folder = os.path.join(app.static_folder, 'processed_images')
@@ -95,8 +137,8 @@ def choose_operations_post():
     # zipped_processed_images.save(processed_file_path)
 
     
-    # Redirect to 'loading' function
-    return redirect('download_file')
+    # Redirect to the job's progress page
+    return redirect(url_for('job_page', job_id=job_id))
 
 #############################################################################################
 
@@ -107,19 +149,13 @@ def download_file():
     # Create an download form instance
     form = DownloadProcessedImageForm()
     
-#    # print(f"################# {app.static_folder}")
     if form.validate_on_submit(): # What happens when we submit the form
 
-        # Download the file
-        # processed_folder = os.path.join(app.static_folder, 'processed_images')
-        # processed_file_path = os.path.join(processed_folder, filename)
-        # return send_file(path_or_file=processed_file_path, mimetype= 'image/jpg', as_attachment= True)
-        try:
-            return send_file(path_or_file = './static/processed_images/processed_images_zip.rar',
-                             mimetype = 'application/zip',
-                            as_attachment=True)
-        except FileNotFoundError:
+        # Stream the results of this session's last batch, still running or not
+        job_id = session.get('last_job')
+        if job_id is None or jobs.get(job_id, session_id()) is None:
             return "error: couldn't download"
+        return redirect(url_for('job_zip', job_id=job_id))
         
         
     # Return download page and the form
@@ -128,7 +164,154 @@ def download_file():
 
 #############################################################################################
 
+# Background jobs: submit returns at once, progress by polling or Server-Sent Events
+
+def get_job_or_404(job_id):
+    job = jobs.get(job_id, session_id())
+    if job is None:
+        abort(404)
+    return job
+
+def add_image_urls(job):
+    for image in job['images']:
+        if image['file']:
+            image['url'] = url_for('job_image', job_id=job['id'], index=image['index'])
+    return job
+
+# Progress page for one job
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_page(job_id):
+    job = get_job_or_404(job_id)
+    return render_template('job_status.html', job=job)
+
+# Upload one image for API clients: multipart form with a "file" field
+@app.route('/api/uploads', methods=['POST'])
+def upload_image():
+    file = request.files.get('file')
+    filename = save_upload(file) if file else None
+    if filename is None:
+        return jsonify(error="No file given"), 400
+    return jsonify(filename=filename), 201
+
+# This session's uploads
+@app.route('/api/uploads', methods=['GET'])
+def list_uploads():
+    return jsonify(filenames=store.list_uploads(session_id()))
+
+# Submit a batch: {"images": [{"image": <uploaded file name>, "operations": [1, 2, ...]}, ...]}
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    body = request.get_json(silent=True) or {}
+    if not isinstance(body, dict) or not isinstance(body.get('images', []), list):
+        return jsonify(error="Expected a JSON object with a list of images"), 400
+    entries = []
+    for entry in body.get('images', []):
+        if not isinstance(entry, dict):
+            return jsonify(error="Every image must be an object with image and operations"), 400
+        operations = entry.get('operations')
+        if (not isinstance(operations, list) or not operations
+                or not all(type(operation) is int and operation in OPERATION_CODES for operation in operations)):
+            return jsonify(error="operations must be a non-empty list of operation codes "
+                                 f"{sorted(OPERATION_CODES)}"), 400
+        if len(operations) > MAX_PIPELINE_STEPS:
+            return jsonify(error=f"At most {MAX_PIPELINE_STEPS} operations per image"), 400
+        entries.append((entry.get('image', ''), operations))
+    if not entries:
+        return jsonify(error="No images given"), 400
+    try:
+        msg = build_message(entries)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    job_id = jobs.submit(session_id(), msg)
+    session['last_job'] = job_id
+    return jsonify(id=job_id, status_url=url_for('job_status', job_id=job_id),
+                   events_url=url_for('job_events', job_id=job_id)), 202
+
+# Polling
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = add_image_urls(get_job_or_404(job_id))
+    del job['session']
+    return jsonify(job)
+
+# Server-Sent Events: an "image" event whenever an image finishes, "finished" at the end
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    # Resolve the session now, the generator runs after the request context is gone
+    current_session = session_id()
+    get_job_or_404(job_id)
+
+    def events():
+        reported = set()
+        version = None
+        while True:
+            job = jobs.get(job_id, current_session)
+            if job is None:
+                # Expired while it was being followed
+                return
+            add_image_urls(job)
+            for image in job['images']:
+                if image['status'] != PENDING and image['index'] not in reported:
+                    reported.add(image['index'])
+                    yield f"event: image\ndata: {json.dumps(image)}\n\n"
+            if job['state'] == 'finished':
+                summary = {key: job[key] for key in ('total', 'done', 'failed')}
+                yield f"event: finished\ndata: {json.dumps(summary)}\n\n"
+                return
+            if job['version'] == version:
+                yield ": keep-alive\n\n"
+            version = job['version']
+            store.wait_for_change(job_id, version, EVENT_STREAM_KEEPALIVE)
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# The whole job as a ZIP, built while it is sent: every image goes in as soon as it is done
+@app.route('/api/jobs/<job_id>/results.zip', methods=['GET'])
+def job_zip(job_id):
+    current_session = session_id()
+    get_job_or_404(job_id)
+    return Response(stream_zip(jobs.finished_files(job_id, current_session)), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename=processed_images_{job_id[:8]}.zip',
+                             'X-Accel-Buffering': 'no'})
+
+# Download one processed image as soon as it is done
+@app.route('/api/jobs/<job_id>/images/<int:index>', methods=['GET'])
+def job_image(job_id, index):
+    job = get_job_or_404(job_id)
+    if not 0 <= index < len(job['images']):
+        abort(404)
+    path = jobs.result_path(job, index)
+    if path is None:
+        image = job['images'][index]
+        return jsonify(status=image['status'], error=image['error']), 409 if image['error'] else 202
+    return send_file(path, as_attachment=True)
+
+#############################################################################################
+
+# Admin
+
+def require_admin():
+    token = app.config['ADMIN_TOKEN']
+    if token and token not in (request.args.get('token'), request.headers.get('X-Admin-Token')):
+        abort(403)
+
+# Where the processing server spends its time, and what this app process has run
+@app.route('/admin/metrics', methods=['GET'])
+def admin_metrics():
+    require_admin()
+    server_metrics, server_error = None, None
+    try:
+        server_metrics = fetch_server_metrics()
+    except Exception as e:
+        server_error = str(e)
+    if request.args.get('format') == 'json':
+        return jsonify(server=server_metrics, server_error=server_error, app=jobs.statistics())
+    return render_template('admin_metrics.html', server=server_metrics, server_error=server_error,
+                           app_stats=jobs.statistics())
+
+#############################################################################################
+
 # Run the flask application
 if __name__ == '__main__':
     app.run(debug=True)
-
@@ -1,66 +1,153 @@
-from flask import Flask, send_from_directory
-from werkzeug.utils import secure_filename
-import os
-import time
 import json
-import base64
-import cv2
+import logging
+import os
+import socket
+import struct
+import threading
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+
+def process_images(msg, on_result=None):
+    # msg = [{image: , operations: [operation, ...]} , ... ]
+    # on_result(index, image_bytes, output_format, error) is called as each image comes back.
+    # Files go from static/images/ to the processing server's socket with sendfile, so memory
+    # use does not grow with the batch: at most one result is held at a time.
+
+    script_dir = os.path.dirname(__file__)  # Get script's directory
+    paths = [os.path.join(script_dir, 'static/images/', entry['image']) for entry in msg]
+    operations = [entry['operations'] for entry in msg]
+
+    # Collect everything in order when nobody wants the results one by one
+    results = [None] * len(msg)
+    if on_result is None:
+        def on_result(index, image_bytes, output_format, error):
+            results[index] = (image_bytes, output_format, error)
+
+    unanswered = set(range(len(msg)))
+    # A server that stops answering fails the job instead of holding its thread forever
+    with socket.create_connection((PROCESSING_SERVER_HOST, PROCESSING_SERVER_PORT),
+                                  timeout=PROCESSING_TIMEOUT) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Upload from a separate thread so results can stream back while we are still sending
+        send_errors = {}
+        sender = threading.Thread(target=send_images, args=(sock, paths, operations, send_errors), daemon=True)
+        sender.start()
+        while unanswered:
+            frame_type, request_id, output_format, payload = read_frame(sock)
+            if frame_type is None or frame_type == FRAME_END:
+                break
+            unanswered.discard(request_id)
+            if frame_type == FRAME_RESULT:
+                on_result(request_id, payload, output_format, None)
+            else:
+                on_result(request_id, None, None, payload.decode('utf-8', 'replace'))
+        sender.join()
+
+    for request_id in sorted(unanswered):
+        on_result(request_id, None, None, send_errors.get(request_id, "No answer from the processing server"))
+    return results
+
 
+def fetch_server_metrics(timeout=2):
+    # Timing spans, counters and gauges from the processing server's rank 0, see vm_code/metrics.py
+    with urllib.request.urlopen(PROCESSING_METRICS_URL, timeout=timeout) as response:
+        return json.load(response)
 
-def process_images(msg):
-    # msg = [{image: , operation} , ... ]
 
-    request_headers = {
-    'Content-Type': 'application/json'
-    }
+#############################################################################################
 
-    # Construct the JSON object
-    payload_data = {}
-    i = 0
-    for entry in msg:
-        script_dir = os.path.dirname(__file__)  # Get script's directory
-        final_path = os.path.join(script_dir, 'static/images/', entry['image'])
-        encoded_img = get_base64_encoded_image(final_path)
-        img_payload = {'operation': entry['operation'], 'image': encoded_img}
-        payload_data.update({f'image{i}': img_payload})
-        i += 1
+# Framed protocol spoken by the processing server, must match vm_code/wire_protocol.py
+PROCESSING_SERVER_HOST = os.environ.get('PROCESSING_SERVER_HOST', '127.0.0.1')
+PROCESSING_SERVER_PORT = int(os.environ.get('PROCESSING_SERVER_PORT', 55552))
+PROCESSING_METRICS_URL = os.environ.get('PROCESSING_METRICS_URL',
+                                        f'http://{PROCESSING_SERVER_HOST}:9100/metrics.json')
+# Seconds a send or a wait for the next result may take before the batch is given up
+PROCESSING_TIMEOUT = float(os.environ.get('PROCESSING_TIMEOUT', 300))
 
-    image_payload_body={
-                  "number_of_images":i,
-                  "images":payload_data
-                  }
-    
-    zip_folder_processed = process_images_remotely(image_payload_body)
-    return zip_folder_processed
+HEADER = struct.Struct('!2sBBBBBBHHHIQ')
+PIPELINE_STEP = struct.Struct('!BxHHH')
+MAGIC = b'IP'
+VERSION = 2
+FRAME_IMAGE = 1
+FRAME_END = 2
+FRAME_RESULT = 3
+FRAME_ERROR = 4
+OP_PIPELINE = 0
+# Most steps the server accepts in one pipeline
+MAX_PIPELINE_STEPS = 32
+FORMAT_AUTO = 0
+# File extension of each output format a result frame can carry
+FORMAT_EXTENSIONS = {1: 'jpg', 2: 'png', 3: 'webp'}
 
-    # response = requests.post(url=CAMERA_FEED_URL, json=image_payload_body, headers=request_headers, auth=(USERNAME, PASSWORD))
 
-    # return  image
+def pack_header(frame_type, request_id=0, payload_length=0, operation=0):
+    return HEADER.pack(MAGIC, VERSION, frame_type, operation, 0, FORMAT_AUTO, 0, 5, 90, 180,
+                       request_id, payload_length)
 
-def get_base64_encoded_image(image_path):
-    with open(image_path, "rb") as img_file:
-        return base64.b64encode(img_file.read()).decode('utf-8')
-    
 
-def process_images_remotely(image_payload_body):
-    num_of_images = image_payload_body['number_of_images']
-    payload_data = image_payload_body['images']
-    operations = []
-    images = []
+def pack_operations(operations):
+    # A single operation goes as it is, several as a pipeline table in front of the image
+    if len(operations) == 1:
+        return int(operations[0]), b''
+    table = struct.pack('!B', len(operations)) + b''.join(
+        PIPELINE_STEP.pack(int(operation), 5, 90, 180) for operation in operations)
+    return OP_PIPELINE, table
 
-    for i in range(num_of_images):
-        operations.append(payload_data[f'image{i}']['operation'])
-        images.append(payload_data[f'image{i}']['image'])
 
-    # for img_data in payload_data:
-    #     print()
-    #     # operations.append(img_data['operation'])
-    #     # images.append(img_data['image'])
-    
-    for i in range(len(operations)):
-        print(operations[i], images[i])
+def send_images(sock, paths, operations, send_errors):
+    # Only the frame header is built in memory, the file itself is handed to the
+    # kernel with sendfile (or read in chunks where that is not available).
+    # Whatever goes wrong, the socket is shut down for writing at the end so
+    # the server finishes the batch and process_images stops reading.
+    request_id = 0
+    try:
+        for request_id, (path, image_operations) in enumerate(zip(paths, operations)):
+            try:
+                file = open(path, 'rb')
+            except OSError as e:
+                send_errors[request_id] = f"Could not read {os.path.basename(path)}: {e.strerror}"
+                continue
+            with file:
+                size = os.fstat(file.fileno()).st_size
+                operation, table = pack_operations(image_operations)
+                sock.sendall(pack_header(FRAME_IMAGE, request_id, len(table) + size, operation) + table)
+                sent = sock.sendfile(file, count=size)
+                if sent != size:
+                    raise ConnectionError(f"{os.path.basename(path)} changed while it was being sent")
+        sock.sendall(pack_header(FRAME_END))
+    except Exception as e:
+        logger.exception("Error sending images")
+        # This image and the ones after it never reached the server
+        for unsent in range(request_id, len(paths)):
+            send_errors.setdefault(unsent, f"Could not send {os.path.basename(paths[unsent])}: {e}")
+    finally:
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass  # Already closed by the server
 
-    return cv2.imread('connecting-ill.png', cv2.IMREAD_COLOR)
 
+def recv_exact(sock, size):
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError("Processing server closed the connection")
+        received += count
+    return data
 
 
+def read_frame(sock):
+    # Returns (frame type, request id, output format, payload), all None once the server hung up
+    first = sock.recv(HEADER.size)
+    if not first:
+        return None, None, None, None
+    header = HEADER.unpack(bytes(first) + bytes(recv_exact(sock, HEADER.size - len(first))))
+    magic, version, frame_type, _, _, output_format, _, _, _, _, request_id, payload_length = header
+    if magic != MAGIC or version != VERSION:
+        raise ConnectionError("Unexpected reply from the processing server")
+    return frame_type, request_id, output_format, recv_exact(sock, payload_length)
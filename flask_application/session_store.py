@@ -0,0 +1,231 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Per-session upload lists and background job state.  Two backends with the
+# same interface: MemoryStore for a single process, SQLiteStore for several
+# WSGI worker processes sharing one database file, e.g.
+#   SESSION_STORE=sqlite:////tmp/image_app.db gunicorn -w 4 main:app
+# Jobs can then be polled from any worker, whichever one is running them.
+
+# Image states
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+# How often SQLiteStore looks for changes while an event stream waits
+POLL_INTERVAL = 0.2
+# expire(cutoff) drops finished jobs that finished before the cutoff, and the
+# uploads of sessions with no upload or job since then and no job left; it
+# returns the ids of both, so the caller can delete their files.
+
+
+def make_snapshot(job_id, session_id, finished, version, images):
+    done = sum(1 for image in images if image['status'] == DONE)
+    failed = sum(1 for image in images if image['status'] == FAILED)
+    return {
+        'id': job_id,
+        'session': session_id,
+        'state': 'finished' if finished else 'running',
+        'total': len(images),
+        'done': done,
+        'failed': failed,
+        'images': images,
+        'version': version,
+    }
+
+
+class MemoryStore:
+    def __init__(self):
+        self.uploads = {}
+        self.jobs = {}
+        # Last upload or job of every session
+        self.last_active = {}
+        self.changed = threading.Condition()
+
+    def add_upload(self, session_id, filename):
+        with self.changed:
+            self.last_active[session_id] = time.time()
+            files = self.uploads.setdefault(session_id, [])
+            if filename not in files:
+                files.append(filename)
+
+    def list_uploads(self, session_id):
+        with self.changed:
+            return list(self.uploads.get(session_id, []))
+
+    def create_job(self, job_id, session_id, msg):
+        images = [{'index': index, 'name': os.path.basename(entry['image']), 'operations': entry['operations'],
+                   'status': PENDING, 'file': None, 'error': None} for index, entry in enumerate(msg)]
+        with self.changed:
+            self.last_active[session_id] = time.time()
+            self.jobs[job_id] = {'session': session_id, 'finished': None, 'version': 0, 'images': images}
+
+    def update_image(self, job_id, index, status, file=None, error=None):
+        with self.changed:
+            job = self.jobs[job_id]
+            job['images'][index].update(status=status, file=file, error=error)
+            job['version'] += 1
+            self.changed.notify_all()
+
+    def finish_job(self, job_id):
+        with self.changed:
+            job = self.jobs[job_id]
+            job['finished'] = time.time()
+            job['version'] += 1
+            self.changed.notify_all()
+
+    def get_job(self, job_id):
+        with self.changed:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            return make_snapshot(job_id, job['session'], job['finished'], job['version'],
+                                 [dict(image) for image in job['images']])
+
+    def wait_for_change(self, job_id, version, timeout):
+        with self.changed:
+            self.changed.wait_for(lambda: job_id not in self.jobs or self.jobs[job_id]['version'] != version,
+                                  timeout)
+            job = self.jobs.get(job_id)
+            return job['version'] if job else None
+
+    def expire(self, cutoff):
+        with self.changed:
+            job_ids = [job_id for job_id, job in self.jobs.items() if job['finished'] and job['finished'] < cutoff]
+            for job_id in job_ids:
+                del self.jobs[job_id]
+            busy = {job['session'] for job in self.jobs.values()}
+            session_ids = [session_id for session_id, active in self.last_active.items()
+                           if active < cutoff and session_id not in busy]
+            for session_id in session_ids:
+                del self.last_active[session_id]
+                self.uploads.pop(session_id, None)
+            self.changed.notify_all()
+            return job_ids, session_ids
+
+
+class SQLiteStore:
+    # One connection per thread; WAL lets readers in other processes carry on while a job writes
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS uploads (
+            session TEXT NOT NULL, position INTEGER PRIMARY KEY AUTOINCREMENT, filename TEXT NOT NULL,
+            UNIQUE (session, filename));
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY, session TEXT NOT NULL, created REAL NOT NULL, finished REAL,
+            version INTEGER NOT NULL DEFAULT 0);
+        CREATE TABLE IF NOT EXISTS job_images (
+            job_id TEXT NOT NULL, idx INTEGER NOT NULL, name TEXT NOT NULL, operations TEXT NOT NULL,
+            status TEXT NOT NULL, file TEXT, error TEXT, PRIMARY KEY (job_id, idx));
+        CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, last_active REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished);
+    """
+    TOUCH = ('INSERT INTO sessions (id, last_active) VALUES (?, ?) '
+             'ON CONFLICT (id) DO UPDATE SET last_active = excluded.last_active')
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.connection().executescript(self.SCHEMA)
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def add_upload(self, session_id, filename):
+        connection = self.connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute(self.TOUCH, (session_id, time.time()))
+            connection.execute('INSERT OR IGNORE INTO uploads (session, filename) VALUES (?, ?)',
+                               (session_id, filename))
+
+    def list_uploads(self, session_id):
+        rows = self.connection().execute('SELECT filename FROM uploads WHERE session = ? ORDER BY position',
+                                         (session_id,))
+        return [filename for filename, in rows]
+
+    def create_job(self, job_id, session_id, msg):
+        connection = self.connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            connection.execute(self.TOUCH, (session_id, now))
+            connection.execute('INSERT INTO jobs (id, session, created) VALUES (?, ?, ?)',
+                               (job_id, session_id, now))
+            connection.executemany(
+                'INSERT INTO job_images (job_id, idx, name, operations, status) VALUES (?, ?, ?, ?, ?)',
+                [(job_id, index, os.path.basename(entry['image']), json.dumps(entry['operations']), PENDING)
+                 for index, entry in enumerate(msg)])
+
+    def update_image(self, job_id, index, status, file=None, error=None):
+        connection = self.connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('UPDATE job_images SET status = ?, file = ?, error = ? WHERE job_id = ? AND idx = ?',
+                               (status, file, error, job_id, index))
+            connection.execute('UPDATE jobs SET version = version + 1 WHERE id = ?', (job_id,))
+
+    def finish_job(self, job_id):
+        self.connection().execute('UPDATE jobs SET finished = ?, version = version + 1 WHERE id = ?',
+                                  (time.time(), job_id))
+
+    def get_job(self, job_id):
+        connection = self.connection()
+        with connection:
+            # One read transaction, so the images match the version
+            connection.execute('BEGIN')
+            row = connection.execute('SELECT session, finished, version FROM jobs WHERE id = ?',
+                                     (job_id,)).fetchone()
+            if row is None:
+                return None
+            rows = connection.execute('SELECT idx, name, operations, status, file, error FROM job_images '
+                                      'WHERE job_id = ? ORDER BY idx', (job_id,)).fetchall()
+        images = [{'index': index, 'name': name, 'operations': json.loads(operations), 'status': status,
+                   'file': file, 'error': error} for index, name, operations, status, file, error in rows]
+        return make_snapshot(job_id, *row, images)
+
+    def job_version(self, job_id):
+        row = self.connection().execute('SELECT version FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def wait_for_change(self, job_id, version, timeout):
+        # The job may be running in another process, so there is nothing to wait on but the table
+        deadline = time.monotonic() + timeout
+        while True:
+            current = self.job_version(job_id)
+            if current != version or time.monotonic() >= deadline:
+                return current
+            time.sleep(POLL_INTERVAL)
+
+    def expire(self, cutoff):
+        connection = self.connection()
+        with connection:
+            # Whichever process deletes the rows gets the ids, so each folder is removed once
+            connection.execute('BEGIN IMMEDIATE')
+            job_ids = [job_id for job_id, in connection.execute('SELECT id FROM jobs WHERE finished < ?', (cutoff,))]
+            connection.executemany('DELETE FROM job_images WHERE job_id = ?', [(job_id,) for job_id in job_ids])
+            connection.executemany('DELETE FROM jobs WHERE id = ?', [(job_id,) for job_id in job_ids])
+            session_ids = [session_id for session_id, in connection.execute(
+                'SELECT id FROM sessions WHERE last_active < ? AND id NOT IN (SELECT session FROM jobs)', (cutoff,))]
+            connection.executemany('DELETE FROM uploads WHERE session = ?', [(session_id,) for session_id in session_ids])
+            connection.executemany('DELETE FROM sessions WHERE id = ?', [(session_id,) for session_id in session_ids])
+        return job_ids, session_ids
+
+
+def create_store(url):
+    # 'memory' or 'sqlite:///path/to/file.db'
+    if url == 'memory':
+        return MemoryStore()
+    if url.startswith('sqlite:///'):
+        return SQLiteStore(url[len('sqlite:///'):])
+    raise ValueError(f"Unknown session store: {url}")
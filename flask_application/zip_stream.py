@@ -0,0 +1,61 @@
+import os
+import time
+import zipfile
+
+# ZIP archives written straight into a streaming response.  zipfile can
+# write to an unseekable output (sizes and CRCs go into data descriptors
+# after each entry), so every entry is passed on as soon as it is written
+# and nothing but the current chunk is ever held in memory.
+
+CHUNK_SIZE = 64 * 1024
+# Already compressed, deflating them again only burns CPU
+STORED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif', '.zip'}
+
+
+class _Sink:
+    # Write-only file object for ZipFile; the generator drains it after every write
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def compression_for(name):
+    _, extension = os.path.splitext(name)
+    return zipfile.ZIP_STORED if extension.lower() in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+
+def stream_zip(entries):
+    # entries: iterable of (name in the archive, path of a file or bytes), consumed lazily,
+    # so it may block until the next entry exists.  Yields the archive piece by piece.
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w', allowZip64=True) as archive:
+        for name, source in entries:
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            info.compress_type = compression_for(name)
+            if isinstance(source, (bytes, bytearray)):
+                info.file_size = len(source)
+                with archive.open(info, 'w') as entry:
+                    entry.write(source)
+            else:
+                # Known up front, lets zipfile decide on ZIP64 for big entries
+                info.file_size = os.path.getsize(source)
+                with open(source, 'rb') as file, archive.open(info, 'w') as entry:
+                    while True:
+                        chunk = file.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        entry.write(chunk)
+                        yield from sink.drain()
+            yield from sink.drain()
+    # Central directory
+    yield from sink.drain()
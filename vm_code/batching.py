@@ -0,0 +1,85 @@
+import numpy as np
+
+from tasks import newTaskId
+from tiling import haloFor
+from wire_protocol import OP_PIPELINE
+
+# Micro-batching of small images.  For thumbnails the pickled header, the
+# extra MPI messages and the Python call per task cost more than the OpenCV
+# work, so rank 0 ships them to a worker in groups: one message with every
+# image packed back to back, one result message with every answer.  On the
+# worker, same shape images under a per-pixel operation are stacked and
+# processed with a single OpenCV call.
+
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_MAX_WAIT = 0.002
+MAX_BATCH_BYTES = 8 * 1024 * 1024
+
+
+class TaskBatch:
+    # Stands in for a Task in the dispatcher's bookkeeping
+    def __init__(self, tasks):
+        self.task_id = newTaskId()
+        self.tasks = tasks
+        self.count = len(tasks)
+
+
+class Batcher:
+    # Collects small tasks on rank 0 until the batch is full, its oldest
+    # image has waited max_wait, or a worker would otherwise sit idle
+    def __init__(self, max_image_bytes, max_size=DEFAULT_BATCH_SIZE, max_wait=DEFAULT_MAX_WAIT,
+                 max_bytes=MAX_BATCH_BYTES):
+        self.max_image_bytes = max_image_bytes
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.max_bytes = max_bytes
+        self.pending = []
+        self.pending_bytes = 0
+        self.oldest = None
+        self.batches = 0
+        self.batched_tasks = 0
+
+    def accepts(self, task):
+        return task.image is not None and task.image.nbytes <= self.max_image_bytes
+
+    def add(self, task, now):
+        if not self.pending:
+            self.oldest = now
+        self.pending.append(task)
+        self.pending_bytes += task.image.nbytes
+
+    def full(self):
+        return len(self.pending) >= self.max_size or self.pending_bytes >= self.max_bytes
+
+    def due(self, now, worker_idle):
+        return bool(self.pending) and (worker_idle or now - self.oldest >= self.max_wait)
+
+    def take(self):
+        # A lone task is sent as it is, there is nothing to amortise
+        tasks, self.pending, self.pending_bytes, self.oldest = self.pending, [], 0, None
+        if len(tasks) == 1:
+            return tasks[0]
+        self.batches += 1
+        self.batched_tasks += len(tasks)
+        return TaskBatch(tasks)
+
+
+def stackKey(operation, params, image):
+    # Images with the same key can be processed as one tall image; None if
+    # the operation looks at neighbouring pixels, which would bleed across
+    if haloFor(operation, params):
+        return None
+    if operation == OP_PIPELINE:
+        settings = tuple(params['steps'])
+    else:
+        settings = tuple(sorted(params.items()))
+    return operation, settings, image.shape, image.dtype.str
+
+
+def stackImages(images):
+    # (N, H, W[, C]) laid out as a single (N * H, W[, C]) image
+    return np.stack(images).reshape((-1,) + images[0].shape[1:])
+
+
+def unstack(result, count):
+    return list(result.reshape((count, -1) + result.shape[1:]))
@@ -0,0 +1,84 @@
+import argparse
+import queue
+import time
+
+import numpy as np
+from mpi4py import MPI
+
+from batching import Batcher, DEFAULT_BATCH_SIZE
+from dispatcher import Dispatcher, TAG_STOP
+from tasks import Task
+from worker import worker_main
+
+# Thumbnail burst benchmark, per-image dispatch against micro-batches:
+#   mpirun -n 4 python bench_batching.py --mode single
+#   mpirun -n 4 python bench_batching.py --mode batch
+# Each run starts fresh workers, so run the two modes back to back.
+
+THUMBNAIL_SIZES = [(64, 64), (96, 128), (120, 160)]
+
+
+def thumbnailTasks(count, seed, operations):
+    rng = np.random.default_rng(seed)
+    tasks = []
+    for i in range(count):
+        height, width = THUMBNAIL_SIZES[rng.integers(len(THUMBNAIL_SIZES))]
+        image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        operation = int(operations[rng.integers(len(operations))])
+        tasks.append(Task(i, image, operation, {'ksize': 5, 'threshold1': 90, 'threshold2': 180}, None))
+    return tasks
+
+
+def runDispatcher(comm, tasks, batcher):
+    task_queue = queue.Queue()
+    remaining = [len(tasks)]
+    dispatcher = Dispatcher(comm, task_queue, batcher=batcher)
+
+    def onComplete(task, result, error):
+        task.releaseResult(result)
+        remaining[0] -= 1
+        if remaining[0] == 0:
+            dispatcher.stop()
+
+    for task in tasks:
+        task.on_complete = onComplete
+        task_queue.put(task)
+    start = time.perf_counter()
+    dispatcher.run()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-batching benchmark for small images")
+    parser.add_argument('--mode', choices=['single', 'batch'], default='batch')
+    parser.add_argument('--count', type=int, default=5000)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--batch-wait-ms', type=float, default=2)
+    parser.add_argument('--operations', type=int, nargs='+', default=[1, 2, 3, 4])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    comm = MPI.COMM_WORLD
+    if comm.Get_rank() != 0:
+        worker_main(comm)
+        return
+    if comm.Get_size() < 2:
+        raise SystemExit("Run under mpirun with at least 2 ranks")
+
+    tasks = thumbnailTasks(args.count, args.seed, args.operations)
+    batcher = None
+    if args.mode == 'batch':
+        largest = max(height * width * 3 for height, width in THUMBNAIL_SIZES)
+        batcher = Batcher(largest, args.batch_size, args.batch_wait_ms / 1000)
+    elapsed = runDispatcher(comm, tasks, batcher)
+    for rank in range(1, comm.Get_size()):
+        comm.send(None, dest=rank, tag=TAG_STOP)
+
+    print(f"{args.mode}: {args.count} thumbnails on {comm.Get_size() - 1} workers in {elapsed:.2f}s "
+          f"({args.count / elapsed:.1f} images/s)")
+    if batcher is not None and batcher.batches:
+        print(f"  {batcher.batches} batches, {batcher.batched_tasks / batcher.batches:.1f} images per batch")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import argparse
+import queue
+import time
+
+import numpy as np
+from mpi4py import MPI
+
+from dispatcher import Dispatcher, TAG_READY, TAG_TASK, TAG_RESULT, TAG_STOP
+from worker import worker_main
+from tasks import Task
+from transport import BufferPool, receiveResult, sendTask
+
+# Dispatch benchmark with mixed image sizes, run as
+#   mpirun -n 4 python bench_dispatch.py --mode dispatcher
+#   mpirun -n 4 python bench_dispatch.py --mode roundrobin
+# "roundrobin" is the old rank 0 loop: blocking send to every worker, then a
+# blocking recv from each of them in a fixed order.
+
+SIZES = [(240, 320), (480, 640), (1080, 1920), (2160, 3840)]
+
+
+def syntheticTasks(count, seed, on_complete):
+    rng = np.random.default_rng(seed)
+    tasks = []
+    for i in range(count):
+        height, width = SIZES[rng.integers(len(SIZES))]
+        image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        operation = int(rng.integers(1, 5))
+        tasks.append(Task(i, image, operation, {'ksize': 5, 'threshold1': 90, 'threshold2': 180}, on_complete))
+    return tasks
+
+
+def runDispatcher(comm, tasks):
+    task_queue = queue.Queue()
+    remaining = [len(tasks)]
+    dispatcher = Dispatcher(comm, task_queue)
+
+    def onComplete(task, result, error):
+        task.releaseResult(result)
+        remaining[0] -= 1
+        if remaining[0] == 0:
+            dispatcher.stop()
+
+    for task in tasks:
+        task.on_complete = onComplete
+        task_queue.put(task)
+    start = time.perf_counter()
+    dispatcher.run()
+    elapsed = time.perf_counter() - start
+    return elapsed, dispatcher.utilizationReport()
+
+
+def runRoundRobin(comm, tasks):
+    workers = list(range(1, comm.Get_size()))
+    for rank in workers:
+        comm.recv(source=rank, tag=TAG_READY)
+    completed = {rank: 0 for rank in workers}
+    pool = BufferPool()
+    start = time.perf_counter()
+    for offset in range(0, len(tasks), len(workers)):
+        batch = list(zip(workers, tasks[offset:offset + len(workers)]))
+        for rank, task in batch:
+            requests, _ = sendTask(comm, task, rank, TAG_TASK)
+            MPI.Request.Waitall(requests)
+        for rank, task in batch:
+            header = comm.recv(source=rank, tag=TAG_RESULT)
+            pool.release(receiveResult(comm, header, rank, pool)[1])
+            completed[rank] += 1
+    elapsed = time.perf_counter() - start
+    return elapsed, {rank: {'completed': count} for rank, count in completed.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rank 0 dispatch benchmark")
+    parser.add_argument('--mode', choices=['dispatcher', 'roundrobin'], default='dispatcher')
+    parser.add_argument('--count', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    comm = MPI.COMM_WORLD
+    if comm.Get_rank() != 0:
+        worker_main(comm)
+        return
+    if comm.Get_size() < 2:
+        raise SystemExit("Run under mpirun with at least 2 ranks")
+
+    tasks = syntheticTasks(args.count, args.seed, None)
+    if args.mode == 'dispatcher':
+        elapsed, report = runDispatcher(comm, tasks)
+    else:
+        elapsed, report = runRoundRobin(comm, tasks)
+    for rank in range(1, comm.Get_size()):
+        comm.send(None, dest=rank, tag=TAG_STOP)
+
+    print(f"{args.mode}: {args.count} images on {comm.Get_size() - 1} workers in {elapsed:.2f}s "
+          f"({args.count / elapsed:.1f} images/s)")
+    for rank, entry in report.items():
+        details = ', '.join(f"{key} {value:.0%}" if isinstance(value, float) else f"{key} {value}"
+                            for key, value in entry.items())
+        print(f"  rank {rank}: {details}")
+
+
+if __name__ == "__main__":
+    main()
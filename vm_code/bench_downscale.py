@@ -0,0 +1,73 @@
+import argparse
+import time
+
+import cv2
+
+from bench_suite import parseResolution, syntheticImage
+from image_codec import REDUCED_FLAGS, decodeImage, encodeImage, fitImage, planDecode
+from worker import ImageWorker
+from wire_protocol import OP_BLUR, OP_EDGES, OP_GRAYSCALE, OP_INVERT
+
+# What a target size saves per request: the whole decode -> operation ->
+# encode path at full resolution and downscaled at the end, against the
+# reduced decode with the downscale pushed to the front.
+#   python bench_downscale.py --resolutions 6000x4000 --targets 256x256 1280x1280
+
+OPERATIONS = {OP_EDGES: 'edges', OP_BLUR: 'blur', OP_GRAYSCALE: 'grayscale', OP_INVERT: 'invert'}
+FORMATS = {'jpeg': '.jpg', 'png': '.png'}
+
+
+def fullPath(worker, payload, operation, target):
+    # What the server did before: decode everything, shrink only the result
+    image = decodeImage(payload)
+    peak = image.nbytes
+    result = fitImage(worker.perform_operation(image, operation), target)
+    return encodeImage(result), peak
+
+
+def earlyPath(worker, payload, operation, target):
+    # What happens with a target size; the biggest array is the one the decoder produced
+    decoded = decodeImage(payload, REDUCED_FLAGS[planDecode(payload, target).reduction])
+    image = fitImage(decoded, target)
+    return encodeImage(worker.perform_operation(image, operation)), decoded.nbytes
+
+
+def timed(function, repeat, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _, peak = function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-request savings of reduced decoding and early downscale")
+    parser.add_argument('--resolutions', nargs='+', default=['6000x4000', '1920x1080'], help="WIDTHxHEIGHT")
+    parser.add_argument('--targets', nargs='+', default=['256x256', '1280x1280'], help="WIDTHxHEIGHT box")
+    parser.add_argument('--formats', nargs='+', choices=list(FORMATS), default=list(FORMATS))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    worker = ImageWorker(0, None, None, None)
+    print(f"{'input':>10} {'format':>6} {'target':>10} {'operation':>10} {'reduction':>9} "
+          f"{'full ms':>8} {'early ms':>8} {'saved ms':>8} {'full MB':>8} {'early MB':>8}")
+    for resolution in args.resolutions:
+        image = syntheticImage(*parseResolution(resolution), seed=0)
+        for format_name in args.formats:
+            payload = cv2.imencode(FORMATS[format_name], image)[1].tobytes()
+            for target_text in args.targets:
+                target = parseResolution(target_text)
+                reduction = planDecode(payload, target).reduction
+                for operation, name in OPERATIONS.items():
+                    full_seconds, full_peak = timed(fullPath, args.repeat, worker, payload, operation, target)
+                    early_seconds, early_peak = timed(earlyPath, args.repeat, worker, payload, operation, target)
+                    print(f"{resolution:>10} {format_name:>6} {target_text:>10} {name:>10} {'1/' + str(reduction):>9} "
+                          f"{full_seconds * 1000:8.1f} {early_seconds * 1000:8.1f} "
+                          f"{(full_seconds - early_seconds) * 1000:8.1f} "
+                          f"{full_peak / 1e6:8.1f} {early_peak / 1e6:8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import argparse
+import json
+import threading
+import time
+
+import cv2
+
+from bench_suite import ServerProcess, clientRun, metadata, parseResolution, summarize, syntheticImage, treePeakRss
+from engines import ENGINES
+
+# The same load against every execution engine with the same number of
+# workers: MPI worker ranks under mpirun, the local process pool and local
+# threads.
+#   python bench_engines.py --workers 2 --clients 1 4 --output engines.json
+# Each MPI rank gets one thread so the comparison is worker for worker.
+# --local-under-mpirun starts the local engines with mpirun -n 1, the way
+# --engine auto ends up with them for a single rank; their pool processes
+# must then stay out of the MPI job.
+
+
+def startServer(engine, args):
+    server_args = ['--engine', engine, '--cache-mb', '0', '--metrics-port', '0'] + args.server_args
+    if engine == 'mpi':
+        return ServerProcess(args.mpirun, args.workers + 1, args.port, server_args + ['--worker-threads', '1'])
+    return ServerProcess(args.mpirun, 1 if args.local_under_mpirun else None, args.port,
+                         server_args + ['--local-workers', str(args.workers)])
+
+
+def benchEngine(engine, args, payloads):
+    server = startServer(engine, args)
+    results = []
+    try:
+        server.waitUntilListening()
+        # Warm up: every worker is started and has imported everything
+        clientRun(args.port, payloads, [1, 2, 3, 4] * 2, [], [])
+        for clients in args.clients:
+            latencies, errors = [], []
+            operations = [1 + i % 4 for i in range(args.images)]
+            threads = [threading.Thread(target=clientRun,
+                                        args=(args.port, [payloads[(client + i) % len(payloads)]
+                                                          for i in range(args.images)],
+                                              operations, latencies, errors))
+                       for client in range(clients)]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            entry = {'name': f'engine={engine}/workers={args.workers}/clients={clients}', 'engine': engine,
+                     'workers': args.workers, 'clients': clients, 'resolution': args.resolution,
+                     'errors': len(errors)}
+            entry.update(summarize(latencies, elapsed, len(latencies)))
+            entry['peak_rss_max_bytes'], entry['peak_rss_total_bytes'] = treePeakRss(server.process.pid)
+            results.append(entry)
+            rss = entry['peak_rss_total_bytes']
+            print(f"{entry['name']:<40} p50 {entry.get('p50_ms', 0):8.2f} ms  "
+                  f"p99 {entry.get('p99_ms', 0):8.2f} ms  {entry['images_per_second'] or 0:8.1f} images/s  "
+                  f"{rss / 2**20 if rss else 0:7.1f} MiB peak RSS  {len(errors)} errors")
+    finally:
+        server.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput and latency of each execution engine")
+    parser.add_argument('--engines', nargs='+', choices=ENGINES, default=list(ENGINES))
+    parser.add_argument('--workers', type=int, default=2, help="worker ranks, processes or threads")
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4], help="concurrent connections")
+    parser.add_argument('--images', type=int, default=50, help="images per client")
+    parser.add_argument('--resolution', default='1920x1080')
+    parser.add_argument('--port', type=int, default=55573)
+    parser.add_argument('--mpirun', default='mpirun --oversubscribe')
+    parser.add_argument('--local-under-mpirun', action='store_true',
+                        help="start the processes and threads engines under mpirun -n 1 instead of on their own")
+    parser.add_argument('--server-args', default='', help="extra server.py arguments, e.g. --server-args=--decode-on-worker")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    args = parser.parse_args()
+    args.server_args = args.server_args.split()
+
+    width, height = parseResolution(args.resolution)
+    # A few distinct images, and the result cache is off anyway
+    payloads = [cv2.imencode('.jpg', syntheticImage(width, height, seed))[1].tobytes() for seed in range(8)]
+    report = {'meta': metadata(), 'engines': [entry for engine in args.engines
+                                               for entry in benchEngine(engine, args, payloads)]}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
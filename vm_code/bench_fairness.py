@@ -0,0 +1,140 @@
+import argparse
+import json
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from bench_suite import ServerProcess, metadata, parseResolution, summarize, syntheticImage
+from image_client import ImageClient
+from wire_protocol import OP_BLUR, OP_INVERT
+
+# Tail latency of small interactive requests while another client floods the
+# server with large images, once per scheduler:
+#   python bench_fairness.py --schedulers fifo fair --output fairness.json
+# The bulk client pipelines large blurs for as long as the run lasts, the
+# interactive client sends one small inversion at a time and waits for it,
+# the way a user of the web front end would.
+
+BULK_WINDOW = 64          # Bulk images in flight on their connection
+BULK_HEAD_START = 1.0     # Seconds the bulk client has to fill the queue before measuring
+INTERACTIVE_PAUSE = 0.02  # Think time between two interactive requests
+TAIL_PERCENTILES = [50, 95, 99]
+
+
+def encode(image):
+    return cv2.imencode('.jpg', image)[1].tobytes()
+
+
+def bulkRun(port, payload, stop, counts, priority):
+    # Keeps BULK_WINDOW large images outstanding until told to stop
+    with ImageClient(port=port) as client:
+        window = threading.Semaphore(BULK_WINDOW)
+
+        def sender():
+            while not stop.is_set():
+                if window.acquire(timeout=0.1):
+                    client.submit(payload, OP_BLUR, priority=priority)
+            client.finish()
+
+        send_thread = threading.Thread(target=sender, daemon=True)
+        send_thread.start()
+        for _, _, error in client.results():
+            counts['errors' if error is not None else 'done'] += 1
+            window.release()
+        send_thread.join()
+
+
+def interactiveRun(port, payload, requests, duration, latencies, errors, priority):
+    # Stops after requests answers or duration seconds, a starved client could otherwise take forever
+    deadline = time.perf_counter() + duration
+    with ImageClient(port=port) as client:
+        results = client.results()
+        for _ in range(requests):
+            if time.perf_counter() > deadline:
+                break
+            started = time.perf_counter()
+            client.submit(payload, OP_INVERT, priority=priority)
+            _, _, error = next(results)
+            if error is not None:
+                errors.append(error)
+            else:
+                latencies.append(time.perf_counter() - started)
+            time.sleep(INTERACTIVE_PAUSE)
+        client.finish()
+        for _ in results:
+            pass
+
+
+def benchScheduler(scheduler, args):
+    server = ServerProcess(args.mpirun, args.ranks, args.port,
+                           ['--scheduler', scheduler, '--cache-mb', '0', '--metrics-port', '0'] + args.server_args)
+    try:
+        server.waitUntilListening()
+        small = encode(syntheticImage(*parseResolution(args.small_resolution), seed=1))
+        large = encode(syntheticImage(*parseResolution(args.large_resolution), seed=2))
+        report = {}
+        for loaded in (False, True):
+            stop = threading.Event()
+            counts = {'done': 0, 'errors': 0}
+            bulk_threads = [threading.Thread(target=bulkRun, args=(args.port, large, stop, counts, args.bulk_priority))
+                            for _ in range(args.bulk_clients if loaded else 0)]
+            for thread in bulk_threads:
+                thread.start()
+            if bulk_threads:
+                time.sleep(BULK_HEAD_START)
+            latencies, errors = [], []
+            started = time.perf_counter()
+            interactiveRun(args.port, small, args.requests, args.duration, latencies, errors,
+                           args.interactive_priority)
+            elapsed = time.perf_counter() - started
+            stop.set()
+            for thread in bulk_threads:
+                thread.join()
+            summary = summarize(latencies, elapsed, len(latencies))
+            if latencies:
+                summary.update({f'p{p}_ms': float(np.percentile(latencies, p) * 1000) for p in TAIL_PERCENTILES})
+            summary['errors'] = len(errors)
+            if loaded:
+                summary['bulk_images'] = counts['done']
+                summary['bulk_errors'] = counts['errors']
+            name = 'under_bulk' if loaded else 'alone'
+            report[name] = summary
+            tails = "  ".join(f"p{p} {summary.get(f'p{p}_ms', float('nan')):8.1f} ms" for p in TAIL_PERCENTILES)
+            print(f"{scheduler:5s} {name:10s} {tails}  errors {len(errors)}"
+                  + (f"  bulk images {counts['done']}" if loaded else ""))
+        return report
+    finally:
+        server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Small request latency under bulk load, per scheduler")
+    parser.add_argument('--schedulers', nargs='+', choices=['fifo', 'fair'], default=['fifo', 'fair'])
+    parser.add_argument('--ranks', type=int, default=3, help="mpirun -n, rank 0 included")
+    parser.add_argument('--bulk-clients', type=int, default=1)
+    parser.add_argument('--requests', type=int, default=100, help="interactive requests per run")
+    parser.add_argument('--duration', type=float, default=60, help="most seconds per run")
+    parser.add_argument('--small-resolution', default='320x240')
+    parser.add_argument('--large-resolution', default='3840x2160')
+    parser.add_argument('--bulk-priority', choices=['bulk', 'interactive'], default=None,
+                        help="class the bulk client asks for (default: let the server decide)")
+    parser.add_argument('--interactive-priority', choices=['bulk', 'interactive'], default=None)
+    parser.add_argument('--port', type=int, default=55572)
+    parser.add_argument('--mpirun', default='mpirun --oversubscribe')
+    parser.add_argument('--server-args', default='', help="extra server.py arguments, e.g. --server-args=--decode-on-worker")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    args = parser.parse_args()
+    args.server_args = args.server_args.split()
+
+    report = {'meta': metadata(), 'fairness': {scheduler: benchScheduler(scheduler, args)
+                                               for scheduler in args.schedulers}}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
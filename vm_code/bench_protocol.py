@@ -0,0 +1,116 @@
+import argparse
+import io
+import os
+import socket
+import threading
+import time
+
+from wire_protocol import FRAME_IMAGE, FRAME_END, FrameReader, configureSocket, packHeader, sendFrame
+
+# Throughput of the ingest socket only: no decoding and no MPI, the server
+# side just receives each image and drops it.  Compares the old sentinel
+# protocol from handle_client with the length-prefixed one in wire_protocol.py.
+
+SENTINEL_SENT = b"###%Image_Sent%"
+SENTINEL_END = b"###%Image_End%"
+BUFFER_SIZE = 4096
+
+
+def sentinelServer(server_socket, counts):
+    client_socket, _ = server_socket.accept()
+    with client_socket:
+        buffer = b""
+        while True:
+            chunk = client_socket.recv(BUFFER_SIZE)
+            if not chunk:
+                break
+            buffer += chunk
+            # The whole accumulated buffer has to be searched, the sentinel may straddle chunks
+            if SENTINEL_SENT in buffer:
+                image, _, buffer = buffer.partition(SENTINEL_SENT)
+                client_socket.sendall(b"File received")
+                buffer += client_socket.recv(BUFFER_SIZE)  # operation code
+                counts.append(len(image))
+            if SENTINEL_END in buffer:
+                break
+
+
+def sentinelClient(port, images):
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        for image in images:
+            stream = io.BytesIO(image)
+            chunk = stream.read(BUFFER_SIZE)
+            while chunk:
+                sock.sendall(chunk)
+                chunk = stream.read(BUFFER_SIZE)
+            sock.sendall(SENTINEL_SENT)
+            sock.recv(BUFFER_SIZE)  # "File received"
+            sock.sendall(b"1")
+        sock.sendall(SENTINEL_END)
+
+
+def framedServer(server_socket, counts):
+    client_socket, _ = server_socket.accept()
+    with client_socket:
+        configureSocket(client_socket)
+        reader = FrameReader(client_socket)
+        while True:
+            header, payload = reader.readFrame()
+            if header is None or header.frame_type == FRAME_END:
+                break
+            counts.append(len(payload))
+
+
+def framedClient(port, images):
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        configureSocket(sock)
+        for request_id, image in enumerate(images):
+            sendFrame(sock, packHeader(FRAME_IMAGE, request_id, len(image), 1), image)
+        sendFrame(sock, packHeader(FRAME_END))
+
+
+def runOnce(server, client, images):
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen()
+    port = server_socket.getsockname()[1]
+    counts = []
+    server_thread = threading.Thread(target=server, args=(server_socket, counts))
+    server_thread.start()
+    start = time.perf_counter()
+    client(port, images)
+    server_thread.join()
+    elapsed = time.perf_counter() - start
+    server_socket.close()
+    return elapsed, len(counts)
+
+
+def randomImages(count, size):
+    # Random bytes stand in for JPEG data; regenerate any image that happens to contain a sentinel
+    images = []
+    while len(images) < count:
+        data = os.urandom(size)
+        if SENTINEL_SENT not in data and SENTINEL_END not in data:
+            images.append(data)
+    return images
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest protocol throughput benchmark")
+    parser.add_argument('--count', type=int, default=50, help="images per run")
+    parser.add_argument('--sizes-kb', type=int, nargs='+', default=[64, 512, 2048, 8192])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'size':>8} {'protocol':>9} {'images/s':>10} {'MB/s':>9}")
+    for size_kb in args.sizes_kb:
+        images = randomImages(args.count, size_kb * 1024)
+        for name, server, client in (('sentinel', sentinelServer, sentinelClient),
+                                     ('framed', framedServer, framedClient)):
+            best = min(runOnce(server, client, images)[0] for _ in range(args.repeat))
+            megabytes = args.count * size_kb / 1024
+            print(f"{size_kb:>6}KB {name:>9} {args.count / best:>10.1f} {megabytes / best:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
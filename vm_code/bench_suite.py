@@ -0,0 +1,343 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from image_client import ImageClient
+from transport import BufferPool
+from wire_protocol import FORMAT_AUTO
+from worker import ImageWorker
+
+# Regression benchmarks, results go to JSON so two runs can be compared:
+#   python bench_suite.py ops --output ops.json
+#   python bench_suite.py e2e --ranks 2 3 5 --concurrency 1 4 16 --output e2e.json
+#   python bench_suite.py compare before.json after.json
+# "ops" times every ImageWorker operation on its own, in this process.
+# "e2e" starts server.py under mpirun on localhost for every rank count and
+# measures the whole socket -> MPI -> result path from concurrent clients.
+
+RESOLUTIONS = ['320x240', '1280x720', '1920x1080', '3840x2160']
+OPERATIONS = {
+    1: ('edgeDetection', lambda worker, image: worker.edgeDetection(image)),
+    2: ('imageBlur', lambda worker, image: worker.imageBlur(image)),
+    3: ('convertToGrayscale', lambda worker, image: worker.convertToGrayscale(image)),
+    4: ('colorInversion', lambda worker, image: worker.colorInversion(image)),
+}
+PERCENTILES = [50, 90, 99]
+SERVER_START_TIMEOUT = 60
+MPI_ENV_PREFIXES = ('OMPI_', 'PMIX_', 'PRTE_', 'OPAL_')
+# A change this much worse than the baseline counts as a regression
+DEFAULT_THRESHOLD = 0.10
+
+
+def parseResolution(text):
+    width, height = (int(value) for value in text.lower().split('x'))
+    return width, height
+
+
+def syntheticImage(width, height, seed):
+    # Gradients and shapes plus a little noise: compresses like a photo, unlike pure noise
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[..., 0] = x
+    image[..., 1] = y
+    image[..., 2] = (x + y) / 2
+    for _ in range(12):
+        center = (int(rng.integers(width)), int(rng.integers(height)))
+        radius = int(rng.integers(max(2, min(width, height) // 20), max(3, min(width, height) // 4)))
+        colour = tuple(int(value) for value in rng.integers(0, 256, 3))
+        cv2.circle(image, center, radius, colour, -1)
+    noise = rng.integers(-8, 9, image.shape, dtype=np.int16)
+    return np.clip(image.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+def summarize(latencies, elapsed, count):
+    latencies = np.asarray(latencies, dtype=np.float64) * 1000
+    summary = {f'p{p}_ms': float(np.percentile(latencies, p)) for p in PERCENTILES} if len(latencies) else {}
+    summary.update({
+        'mean_ms': float(latencies.mean()) if len(latencies) else None,
+        'images': count,
+        'seconds': elapsed,
+        'images_per_second': count / elapsed if elapsed > 0 else None,
+    })
+    return summary
+
+
+def peakRss():
+    # Linux reports kilobytes, macOS bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak * 1024 if sys.platform != 'darwin' else peak
+
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'host': platform.node(),
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'commit': commit,
+    }
+
+
+#### Operations in isolation
+
+def benchOperations(resolutions, repeat, warmup):
+    worker = ImageWorker(0, None, None, BufferPool())  # Never started, only its methods are used
+    results = []
+    for text in resolutions:
+        width, height = parseResolution(text)
+        image = syntheticImage(width, height, 0)
+        for operation, (name, run) in OPERATIONS.items():
+            for _ in range(warmup):
+                run(worker, image)
+            latencies = []
+            started = time.perf_counter()
+            for _ in range(repeat):
+                start = time.perf_counter()
+                run(worker, image)
+                latencies.append(time.perf_counter() - start)
+            entry = {'name': f'{name}@{text}', 'operation': operation, 'resolution': text}
+            entry.update(summarize(latencies, time.perf_counter() - started, repeat))
+            entry['megapixels_per_second'] = width * height * repeat / 1e6 / entry['seconds']
+            results.append(entry)
+            print(f"{entry['name']:<32} p50 {entry['p50_ms']:8.2f} ms  p99 {entry['p99_ms']:8.2f} ms  "
+                  f"{entry['images_per_second']:9.1f} images/s")
+    return results, peakRss()
+
+
+#### Whole path under mpirun
+
+def processTree(root_pid):
+    # Pids of root_pid and everything below it, from /proc
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as file:
+                # The command name may contain spaces, the parent pid follows the closing parenthesis
+                parent = int(file.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+    pids, pending = [], [root_pid]
+    while pending:
+        pid = pending.pop()
+        pids.append(pid)
+        pending.extend(children.get(pid, []))
+    return pids
+
+
+def treePeakRss(root_pid):
+    # Peak resident set of every process under mpirun: (largest single process, sum), in bytes.
+    # A high water mark since the server started, so it covers the earlier concurrency levels too.
+    peaks = []
+    for pid in processTree(root_pid):
+        try:
+            with open(f'/proc/{pid}/status') as file:
+                for line in file:
+                    if line.startswith('VmHWM:'):
+                        peaks.append(int(line.split()[1]) * 1024)
+        except OSError:
+            continue
+    if not peaks:
+        return None, None  # No /proc, e.g. not Linux
+    return max(peaks), sum(peaks)
+
+
+class ServerProcess:
+    def __init__(self, mpirun, ranks, port, server_args):
+        # ranks None starts server.py on its own, without mpirun, for the local engines
+        command = [sys.executable, 'server.py', '--port', str(port)]
+        if ranks is not None:
+            command = mpirun.split() + ['-n', str(ranks)] + command
+            if os.geteuid() == 0 and '--allow-run-as-root' not in command:
+                command.insert(1, '--allow-run-as-root')
+        self.port = port
+        self.log = open(os.path.join(tempfile.gettempdir(), f'bench_server_{ranks or "local"}.log'), 'w')
+        # Importing worker made this process an MPI singleton; mpirun must not think it runs under it
+        env = {name: value for name, value in os.environ.items() if not name.startswith(MPI_ENV_PREFIXES)}
+        self.process = subprocess.Popen(command + server_args, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                        env=env, stdout=self.log, stderr=subprocess.STDOUT, start_new_session=True)
+
+    def waitUntilListening(self):
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Server exited with {self.process.returncode}, see {self.log.name}")
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError(f"Server did not start listening within {SERVER_START_TIMEOUT}s")
+
+    def stop(self):
+        # The server has no shutdown message, mpirun passes the signal on to every rank
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            self.process.wait(timeout=20)
+        except ProcessLookupError:
+            pass
+        except subprocess.TimeoutExpired:
+            os.killpg(self.process.pid, signal.SIGKILL)
+            self.process.wait()
+        self.log.close()
+
+
+def clientRun(port, payloads, operations, latencies, errors):
+    # One connection, every image pipelined; latency is submit to result
+    submitted = {}
+    with ImageClient(port=port) as client:
+        def sender():
+            for payload, operation in zip(payloads, operations):
+                # Stamped before sending, the result may be back before submit returns
+                submitted[client.next_request_id] = time.perf_counter()
+                client.submit(payload, operation, output_format=FORMAT_AUTO)
+            client.finish()
+
+        send_thread = threading.Thread(target=sender, daemon=True)
+        send_thread.start()
+        for request_id, _, error in client.results():
+            now = time.perf_counter()
+            if error is not None:
+                errors.append(error)
+            else:
+                latencies.append(now - submitted[request_id])
+        send_thread.join()
+
+
+def benchEndToEnd(ranks, concurrency, images_per_client, resolution, port, mpirun, server_args):
+    width, height = parseResolution(resolution)
+    # A few distinct images, so results do not all come out of the server's result cache
+    payloads = [cv2.imencode('.jpg', syntheticImage(width, height, seed))[1].tobytes() for seed in range(8)]
+    results = []
+    for rank_count in ranks:
+        server = ServerProcess(mpirun, rank_count, port, server_args)
+        try:
+            server.waitUntilListening()
+            # Warm up: every worker rank has said READY and imported everything
+            clientRun(port, payloads, [1, 2, 3, 4] * 2, [], [])
+            for clients in concurrency:
+                latencies, errors = [], []
+                batches = [[payloads[(client + i) % len(payloads)] for i in range(images_per_client)]
+                           for client in range(clients)]
+                operations = [1 + i % 4 for i in range(images_per_client)]
+                threads = [threading.Thread(target=clientRun, args=(port, batch, operations, latencies, errors))
+                           for batch in batches]
+                started = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed = time.perf_counter() - started
+                entry = {'name': f'e2e@{resolution}/ranks={rank_count}/clients={clients}', 'ranks': rank_count,
+                         'clients': clients, 'resolution': resolution, 'errors': len(errors)}
+                entry.update(summarize(latencies, elapsed, len(latencies)))
+                entry['peak_rss_max_bytes'], entry['peak_rss_total_bytes'] = treePeakRss(server.process.pid)
+                results.append(entry)
+                rss = entry['peak_rss_total_bytes']
+                print(f"{entry['name']:<40} p50 {entry.get('p50_ms', 0):8.2f} ms  "
+                      f"p99 {entry.get('p99_ms', 0):8.2f} ms  {entry['images_per_second'] or 0:8.1f} images/s  "
+                      f"{rss / 2**20 if rss else 0:7.1f} MiB peak RSS  {len(errors)} errors")
+        finally:
+            server.stop()
+    return results
+
+
+#### Comparing runs
+
+# Per metric, whether bigger numbers are better
+METRICS = {'p50_ms': False, 'p99_ms': False, 'images_per_second': True, 'peak_rss_total_bytes': False}
+
+
+def compareRuns(before, after, threshold):
+    old = {entry['name']: entry for section in ('operations', 'end_to_end') for entry in before.get(section, [])}
+    regressions = 0
+    print(f"{'benchmark':<44} {'metric':<22} {'before':>12} {'after':>12} {'change':>8}")
+    for section in ('operations', 'end_to_end'):
+        for entry in after.get(section, []):
+            baseline = old.get(entry['name'])
+            if baseline is None:
+                continue
+            for metric, higher_is_better in METRICS.items():
+                was, now = baseline.get(metric), entry.get(metric)
+                if not was or now is None:
+                    continue
+                change = (now - was) / was
+                worse = -change if higher_is_better else change
+                flag = ' REGRESSION' if worse > threshold else ''
+                regressions += bool(flag)
+                print(f"{entry['name']:<44} {metric:<22} {was:>12.2f} {now:>12.2f} {change:>+7.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Operation and end-to-end benchmark suite")
+    commands = parser.add_subparsers(dest='command', required=True)
+    ops = commands.add_parser('ops', help="time each ImageWorker operation on its own")
+    ops.add_argument('--resolutions', nargs='+', default=RESOLUTIONS, help="WIDTHxHEIGHT")
+    ops.add_argument('--repeat', type=int, default=20)
+    ops.add_argument('--warmup', type=int, default=2)
+    ops.add_argument('--output', help="write the results to this JSON file")
+    e2e = commands.add_parser('e2e', help="time the socket -> MPI -> result path under mpirun")
+    e2e.add_argument('--ranks', type=int, nargs='+', default=[2, 3], help="mpirun -n values, rank 0 included")
+    e2e.add_argument('--concurrency', type=int, nargs='+', default=[1, 4], help="simultaneous client connections")
+    e2e.add_argument('--images', type=int, default=50, help="images per client")
+    e2e.add_argument('--resolution', default='1280x720')
+    e2e.add_argument('--port', type=int, default=55562)
+    e2e.add_argument('--mpirun', default='mpirun --oversubscribe')
+    e2e.add_argument('--server-args', default='--cache-mb 0', help="extra server.py arguments")
+    e2e.add_argument('--output', help="write the results to this JSON file")
+    compare = commands.add_parser('compare', help="compare two result files")
+    compare.add_argument('before')
+    compare.add_argument('after')
+    compare.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                         help="fraction worse that counts as a regression")
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open(args.before) as file:
+            before = json.load(file)
+        with open(args.after) as file:
+            after = json.load(file)
+        regressions = compareRuns(before, after, args.threshold)
+        print(f"{regressions} regressions beyond {args.threshold:.0%}")
+        raise SystemExit(1 if regressions else 0)
+
+    report = {'meta': metadata()}
+    if args.command == 'ops':
+        report['operations'], report['meta']['peak_rss_bytes'] = benchOperations(args.resolutions, args.repeat,
+                                                                                 args.warmup)
+    else:
+        report['end_to_end'] = benchEndToEnd(args.ranks, args.concurrency, args.images, args.resolution, args.port,
+                                             args.mpirun, args.server_args.split())
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
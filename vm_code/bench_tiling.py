@@ -0,0 +1,88 @@
+import argparse
+import queue
+import time
+
+import numpy as np
+from mpi4py import MPI
+
+from dispatcher import Dispatcher
+from tasks import Task
+from worker import worker_main
+
+# Single image latency with and without striping, run as
+#   mpirun -n 5 python bench_tiling.py --megapixels 40
+# Also checks that the stitched output is identical to whole image processing.
+
+OPERATIONS = {1: 'edges', 2: 'blur', 3: 'grayscale', 4: 'invert'}
+
+
+def syntheticImage(megapixels, seed):
+    # Smooth gradients plus noise so Canny finds plenty of connected edges
+    rng = np.random.default_rng(seed)
+    height = int((megapixels * 1_000_000 * 3 / 4) ** 0.5)
+    width = int(height * 4 / 3)
+    rows = np.linspace(0, 8 * np.pi, height)[:, None, None]
+    cols = np.linspace(0, 6 * np.pi, width)[None, :, None]
+    phase = np.array([0, 2, 4])[None, None, :]
+    image = 127 + 100 * np.sin(rows + phase) * np.cos(cols - phase)
+    image += rng.normal(0, 12, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def runOne(dispatcher, image, operation, params):
+    outcome = {}
+
+    def onComplete(task, result, error):
+        outcome['result'], outcome['error'], outcome['task'] = result, error, task
+        dispatcher.stop()
+
+    dispatcher.stopping = False
+    start = time.perf_counter()
+    dispatcher.task_queue.put(Task(0, image, operation, params, onComplete))
+    dispatcher.run()
+    return time.perf_counter() - start, outcome
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tiled single image latency benchmark")
+    parser.add_argument('--megapixels', type=float, default=40)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    comm = MPI.COMM_WORLD
+    if comm.Get_rank() != 0:
+        worker_main(comm)
+        return
+
+    dispatcher = Dispatcher(comm, queue.Queue())
+    while len(dispatcher.ranks) < comm.Get_size() - 1:
+        dispatcher.pollMessages()
+    capacity = sum(stats.capacity for stats in dispatcher.ranks.values())
+    image = syntheticImage(args.megapixels, 0)
+    params = {'ksize': 5, 'threshold1': 90, 'threshold2': 180}
+    print(f"{image.shape[1]}x{image.shape[0]} image, {len(dispatcher.ranks)} worker ranks, capacity {capacity}")
+    print(f"{'operation':>10} {'whole s':>9} {'tiled s':>9} {'speedup':>8} {'identical':>10}")
+
+    for operation, name in OPERATIONS.items():
+        timings = {}
+        outputs = {}
+        for mode, min_pixels in (('whole', 0), ('tiled', 1)):
+            dispatcher.tile_min_pixels = min_pixels
+            best = None
+            for _ in range(args.repeat):
+                elapsed, outcome = runOne(dispatcher, image, operation, params)
+                if outcome['error'] is not None:
+                    raise SystemExit(f"{name} {mode} failed: {outcome['error']}")
+                best = elapsed if best is None else min(best, elapsed)
+            outputs[mode] = outcome
+            timings[mode] = best
+        identical = np.array_equal(outputs['whole']['result'], outputs['tiled']['result'])
+        outputs['whole']['task'].releaseResult(outputs['whole']['result'])
+        print(f"{name:>10} {timings['whole']:>9.3f} {timings['tiled']:>9.3f} "
+              f"{timings['whole'] / timings['tiled']:>7.2f}x {str(identical):>10}")
+
+    dispatcher.shutdownWorkers()
+
+
+if __name__ == "__main__":
+    main()
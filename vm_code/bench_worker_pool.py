@@ -0,0 +1,60 @@
+import argparse
+import queue
+import time
+
+import numpy as np
+
+from transport import BufferPool, KIND_ARRAY
+from worker import ImageWorker, availableCores, configureOpenCVThreads
+
+# Throughput of a single worker rank's pool, without MPI in the way.
+# Feeds the same synthetic workload to pools of growing size.
+
+
+def runPool(size, images, operations):
+    configureOpenCVThreads(size)
+    task_queue = queue.Queue()
+    result_queue = queue.Queue()
+    buffers = BufferPool()
+    threads = [ImageWorker(0, task_queue, result_queue, buffers) for _ in range(size)]
+    for thread in threads:
+        thread.start()
+    start = time.perf_counter()
+    for task_id, (image, operation) in enumerate(zip(images, operations)):
+        task_queue.put((task_id, KIND_ARRAY, image, operation, {}, None))
+    for _ in images:
+        result_queue.get()
+    elapsed = time.perf_counter() - start
+    for _ in threads:
+        task_queue.put(None)
+    for thread in threads:
+        thread.join()
+    return elapsed
+
+
+def main():
+    cores = availableCores()
+    parser = argparse.ArgumentParser(description="Per-rank worker pool scaling benchmark")
+    parser.add_argument('--count', type=int, default=64)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=sorted({1, 2, 4, cores // 2 or 1, cores}))
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 256, (args.height, args.width, 3), dtype=np.uint8) for _ in range(args.count)]
+    operations = [1 + i % 4 for i in range(args.count)]
+
+    print(f"{cores} cores available")
+    print(f"{'threads':>8} {'images/s':>10} {'speedup':>8}")
+    baseline = None
+    for size in args.sizes:
+        elapsed = runPool(size, images, operations)
+        throughput = args.count / elapsed
+        baseline = baseline or throughput
+        print(f"{size:>8} {throughput:>10.1f} {throughput / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
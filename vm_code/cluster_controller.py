@@ -0,0 +1,338 @@
+import math
+import threading
+import time
+
+# Background health checking and autoscaling of the worker fleet.  Nothing
+# here runs on the dispatcher's thread: the controller refreshes instance
+# health in one batched query per TTL, keeps the answer cached for
+# healthyRanks(), and launches or terminates instances without waiting for
+# them to boot or shut down.  Clouds plug in through InstanceProvider;
+# FakeProvider keeps everything in memory so the controller runs offline.
+#
+# An instance only adds capacity once a worker rank on it has said READY,
+# and an MPI job cannot grow after mpirun started it, so a launched
+# instance may never get that far.  Until it does, no further instance is
+# launched, and one that has not registered within register_timeout is
+# terminated again.  Scaling in goes the other way round: the rank is
+# stopped through the dispatcher first, and its instance is only terminated
+# once the rank has confirmed it is gone, as killing a live rank would take
+# the whole MPI job down with it.
+
+# Instance states as the controller sees them
+HEALTHY = 'healthy'
+STARTING = 'starting'
+UNHEALTHY = 'unhealthy'
+GONE = 'gone'
+
+# describe_instance_status takes at most this many instance ids per call
+DESCRIBE_BATCH = 100
+
+# Same instance settings createNewInstance used to launch workers with
+LAUNCH_CONFIG = {
+    'ImageId': 'ami-0abcdef1234567890',
+    'InstanceType': 't2.micro',
+    'KeyName': 'my-key-pair',
+    'SecurityGroupIds': ['sg-0abcdef1234567890'],
+    'SubnetId': 'subnet-0abcdef1234567890',
+    'TagSpecifications': [{'ResourceType': 'instance', 'Tags': [{'Key': 'Name', 'Value': 'MPI-Worker'}]}],
+}
+
+
+class InstanceProvider:
+    # The few cloud calls the controller needs.  They may block, the
+    # controller only ever calls them from its own thread.
+    def describe(self, instance_ids):
+        # Returns {instance_id: HEALTHY | STARTING | UNHEALTHY | GONE}
+        raise NotImplementedError
+
+    def launch(self, count):
+        # Starts count instances and returns their ids without waiting for them to boot
+        raise NotImplementedError
+
+    def terminate(self, instance_ids):
+        raise NotImplementedError
+
+
+class EC2Provider(InstanceProvider):
+    def __init__(self, launch_config=None, region=None, client=None):
+        if client is None:
+            import boto3
+            client = boto3.client('ec2', region_name=region)
+        # One client for the lifetime of the controller
+        self.client = client
+        self.launch_config = launch_config or LAUNCH_CONFIG
+
+    @staticmethod
+    def instanceState(status):
+        state = status['InstanceState']['Name']
+        if state == 'pending':
+            return STARTING
+        if state != 'running':
+            return GONE
+        checks = (status.get('InstanceStatus', {}).get('Status'), status.get('SystemStatus', {}).get('Status'))
+        if all(check == 'ok' for check in checks):
+            return HEALTHY
+        if 'impaired' in checks:
+            return UNHEALTHY
+        return STARTING  # Status checks still initializing
+
+    def describe(self, instance_ids):
+        states = {instance_id: GONE for instance_id in instance_ids}
+        for start in range(0, len(instance_ids), DESCRIBE_BATCH):
+            request = {'InstanceIds': list(instance_ids[start:start + DESCRIBE_BATCH]), 'IncludeAllInstances': True}
+            while True:
+                response = self.client.describe_instance_status(**request)
+                for status in response.get('InstanceStatuses', []):
+                    states[status['InstanceId']] = self.instanceState(status)
+                if not response.get('NextToken'):
+                    break
+                request['NextToken'] = response['NextToken']
+        return states
+
+    def launch(self, count):
+        response = self.client.run_instances(MinCount=count, MaxCount=count, **self.launch_config)
+        return [instance['InstanceId'] for instance in response['Instances']]
+
+    def terminate(self, instance_ids):
+        self.client.terminate_instances(InstanceIds=list(instance_ids))
+
+
+class FakeProvider(InstanceProvider):
+    # In-memory cloud: launched instances turn healthy after boot_seconds
+    def __init__(self, instance_ids=(), boot_seconds=0.0):
+        self.boot_seconds = boot_seconds
+        self.instances = {instance_id: {'state': HEALTHY, 'ready_at': 0.0} for instance_id in instance_ids}
+        self.next_id = 0
+        self.describe_calls = 0
+        self.lock = threading.Lock()
+
+    def describe(self, instance_ids):
+        now = time.monotonic()
+        with self.lock:
+            self.describe_calls += 1
+            states = {}
+            for instance_id in instance_ids:
+                instance = self.instances.get(instance_id)
+                if instance is None:
+                    states[instance_id] = GONE
+                elif instance['state'] == STARTING and now >= instance['ready_at']:
+                    instance['state'] = states[instance_id] = HEALTHY
+                else:
+                    states[instance_id] = instance['state']
+            return states
+
+    def launch(self, count):
+        with self.lock:
+            instance_ids = []
+            for _ in range(count):
+                self.next_id += 1
+                instance_id = f"i-fake{self.next_id:08d}"
+                self.instances[instance_id] = {'state': STARTING, 'ready_at': time.monotonic() + self.boot_seconds}
+                instance_ids.append(instance_id)
+            return instance_ids
+
+    def terminate(self, instance_ids):
+        with self.lock:
+            for instance_id in instance_ids:
+                self.instances.pop(instance_id, None)
+
+    def setState(self, instance_id, state):
+        # Lets a test degrade or revive an instance
+        with self.lock:
+            self.instances[instance_id]['state'] = state
+
+
+class ClusterController:
+    # load() returns the dispatcher's view of the work, see Dispatcher.loadReport
+    def __init__(self, provider, load=None, min_instances=0, max_instances=8, health_ttl=30, interval=1.0,
+                 queue_per_worker=8, latency_slo=2.0, cooldown=60, boot_timeout=600, register_timeout=900,
+                 retire_rank=None):
+        self.provider = provider
+        self.load = load
+        # Asks the dispatcher to stop a rank once it is idle, see Dispatcher.retireRank
+        self.retire_rank = retire_rank
+        self.min_instances = min_instances
+        self.max_instances = max_instances
+        self.health_ttl = health_ttl
+        self.interval = interval
+        # Scale out when more than this many images wait per healthy worker rank
+        self.queue_per_worker = queue_per_worker
+        # ... or when the 95th percentile time from submit to result exceeds this
+        self.latency_slo = latency_slo
+        self.cooldown = cooldown
+        self.boot_timeout = boot_timeout
+        # A launched instance without a worker rank after this many seconds is given up on
+        self.register_timeout = register_timeout
+        self.ranks = {}        # rank -> instance id, None for ranks outside the provider (e.g. local)
+        self.health = {}       # instance id -> state, as of the last refresh
+        self.launched = {}     # instance id -> launch time, for instances this controller started
+        self.draining = {}     # rank -> instance id being scaled in once the rank has stopped
+        self.stopped_ranks = set()  # draining ranks that have confirmed they are gone
+        # Launched instances given up on since one last joined; while there are any, scale out one at a time
+        self.failed_joins = 0
+        self.last_refresh = None  # None: refresh on the next step
+        self.last_scale = 0.0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def registerRank(self, rank, info):
+        # Called by the dispatcher when a worker rank announces itself
+        with self.lock:
+            self.ranks[rank] = info.get('instance')
+            if info.get('instance') in self.launched:
+                self.failed_joins = 0
+            self.last_refresh = None  # Check the newcomer on the next round
+
+    def rankStopped(self, rank):
+        # Called by the dispatcher once a rank it was asked to retire has shut down
+        with self.lock:
+            self.stopped_ranks.add(rank)
+
+    def healthyRanks(self):
+        # Cached answer, never talks to the cloud.  Ranks are trusted until the first check says otherwise.
+        with self.lock:
+            return {rank for rank, instance_id in self.ranks.items() if rank not in self.draining
+                    and (instance_id is None or self.health.get(instance_id, HEALTHY) == HEALTHY)}
+
+    def knownInstances(self):
+        with self.lock:
+            instance_ids = {instance_id for instance_id in self.ranks.values() if instance_id is not None}
+            return sorted(instance_ids | set(self.launched))
+
+    def refreshHealth(self, now):
+        instance_ids = self.knownInstances()
+        states = self.provider.describe(instance_ids) if instance_ids else {}
+        stuck = []
+        with self.lock:
+            self.health = states
+            self.last_refresh = now
+            registered = set(self.ranks.values())
+            for instance_id, launched_at in list(self.launched.items()):
+                state = states.get(instance_id)
+                if state == GONE:
+                    del self.launched[instance_id]  # Went away underneath us
+                elif state == STARTING and now - launched_at > self.boot_timeout:
+                    del self.launched[instance_id]
+                    stuck.append((instance_id, "did not boot in time"))
+                elif instance_id not in registered and now - launched_at > self.register_timeout:
+                    del self.launched[instance_id]
+                    self.failed_joins += 1
+                    stuck.append((instance_id, "never joined as a worker rank"))
+        for instance_id, reason in stuck:
+            self.provider.terminate([instance_id])
+            with self.lock:
+                self.health[instance_id] = GONE
+            print(f"Instance {instance_id} {reason}, terminated")
+
+    def liveInstances(self):
+        with self.lock:
+            return [instance_id for instance_id in set(self.ranks.values()) | set(self.launched)
+                    if instance_id is not None and self.health.get(instance_id, STARTING) != GONE]
+
+    def pending(self):
+        # Launched instances that are still on their way and have no worker rank yet
+        with self.lock:
+            registered = set(self.ranks.values())
+            return [instance_id for instance_id in self.launched
+                    if instance_id not in registered and self.health.get(instance_id, STARTING) != GONE]
+
+    def scale(self, now):
+        live = self.liveInstances()
+        if len(live) < self.min_instances:
+            self.scaleOut(self.min_instances - len(live), now, "below the minimum")
+            return
+        if self.load is None:
+            return
+        self.finishDraining()
+        if now - self.last_scale < self.cooldown:
+            return
+        load = self.load()
+        pending = self.pending()
+        # An instance on its way counts as the worker it is meant to become
+        workers = max(1, len(self.healthyRanks()) + len(pending))
+        latency = load['latency_p95']
+        if load['queued'] > self.queue_per_worker * workers or (latency is not None and latency > self.latency_slo):
+            if pending:
+                return  # Let the last scale out land, or time out, first
+            wanted = math.ceil(load['queued'] / self.queue_per_worker) - workers
+            if self.failed_joins:
+                wanted = 1  # The last ones never joined, don't pay for a whole batch of those again
+            self.scaleOut(min(max(1, wanted), self.max_instances - len(live)), now,
+                          f"{load['queued']} queued, p95 latency {latency or 0:.2f}s")
+        elif load['queued'] == 0 and (latency is None or latency < self.latency_slo / 2):
+            self.scaleIn(now)
+
+    def scaleOut(self, count, now, reason):
+        if count <= 0:
+            return
+        instance_ids = self.provider.launch(count)
+        with self.lock:
+            for instance_id in instance_ids:
+                self.launched[instance_id] = now
+                self.health[instance_id] = STARTING
+        self.last_scale = now
+        print(f"Scaling out by {len(instance_ids)} ({reason}): {', '.join(instance_ids)}")
+
+    def scaleIn(self, now):
+        # Only instances this controller launched, newest first, and never below the minimum
+        if len(self.liveInstances()) <= self.min_instances:
+            return
+        with self.lock:
+            candidates = sorted((launched_at, instance_id) for instance_id, launched_at in self.launched.items()
+                                if instance_id not in self.draining.values())
+            if not candidates:
+                return
+            instance_id = candidates[-1][1]
+            ranks = [rank for rank, rank_instance in self.ranks.items() if rank_instance == instance_id]
+            if ranks and self.retire_rank is None:
+                return  # Nothing to stop its ranks with, and terminating them would abort the job
+            for rank in ranks:
+                # Stop giving it work, terminate once the rank has finished what it has and exited
+                self.draining[rank] = instance_id
+        self.last_scale = now
+        for rank in ranks:
+            self.retire_rank(rank)
+        if not ranks:
+            self.terminate(instance_id, "idle")
+
+    def finishDraining(self):
+        # An instance goes once every rank on it has confirmed it stopped
+        with self.lock:
+            done = set()
+            for rank in [rank for rank in self.draining if rank in self.stopped_ranks]:
+                done.add(self.draining.pop(rank))
+                self.stopped_ranks.discard(rank)
+                self.ranks.pop(rank, None)
+            ready = [instance_id for instance_id in done if instance_id not in self.draining.values()]
+        for instance_id in ready:
+            self.terminate(instance_id, "its worker ranks stopped")
+
+    def terminate(self, instance_id, reason):
+        self.provider.terminate([instance_id])
+        with self.lock:
+            self.launched.pop(instance_id, None)
+            self.health[instance_id] = GONE
+        print(f"Scaling in ({reason}): terminated {instance_id}")
+
+    def step(self, now):
+        if self.last_refresh is None or now - self.last_refresh >= self.health_ttl:
+            self.refreshHealth(now)
+        self.scale(now)
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.step(time.monotonic())
+            except Exception as e:
+                print(f"Cluster controller error: {e}")
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='cluster-controller', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,498 @@
+import queue
+import time
+from collections import deque
+
+from mpi4py import MPI
+
+from batching import TaskBatch
+from metrics import Metrics
+from tiling import TiledTask, shouldTile
+from transport import INVALID_TASK, BufferPool, receiveBatchResult, receiveResult, sendBatch, sendTask
+
+# Message tags between rank 0 and the worker ranks
+TAG_READY = 10      # worker -> 0: worker is up, payload is {'capacity', 'host', 'instance'}
+TAG_TASK = 11       # 0 -> worker: task header, pixels follow as TAG_TASK_DATA
+TAG_RESULT = 12     # worker -> 0: result header, pixels follow as TAG_RESULT_DATA
+TAG_STOP = 13       # 0 -> worker: shut down
+TAG_BATCH = 14      # 0 -> worker: header for several small tasks, packed pixels follow as TAG_TASK_DATA
+TAG_BATCH_RESULT = 15  # worker -> 0: header for a whole batch's results, packed data follows as TAG_RESULT_DATA
+TAG_STOPPED = 16    # worker -> 0: shut down after TAG_STOP, nothing of it runs any more
+
+# Tasks kept in flight per unit of worker capacity, so a worker already has
+# its next image by the time it finishes the current one
+WINDOW_PER_SLOT = 2
+IDLE_SLEEP = 0.0005
+MAX_IDLE_SLEEP = 0.005
+REPORT_INTERVAL = 60
+# Completion latencies older than this are left out of loadReport, and at most this many are kept
+LATENCY_WINDOW = 60
+LATENCY_SAMPLES = 10000
+# A task not answered within this many seconds of being sent is given to another rank
+DEFAULT_TASK_TIMEOUT = 30
+# Sends per task before its error goes back to the client
+DEFAULT_MAX_ATTEMPTS = 3
+DEADLINE_CHECK_INTERVAL = 0.5
+# Failures that another rank then got right, in a row, before a rank is quarantined
+MAX_RANK_FAILURES = 3
+# First quarantine; it doubles every time the same rank is quarantined again
+QUARANTINE_SECONDS = 10
+MAX_QUARANTINE_SECONDS = 300
+
+
+class RankStats:
+    def __init__(self, rank, capacity):
+        self.rank = rank
+        self.capacity = capacity
+        self.window = capacity * WINDOW_PER_SLOT
+        self.inflight = {}
+        self.completed = 0
+        self.compute_time = 0.0
+        self.busy_time = 0.0
+        self.busy_since = None
+        self.deadlines = {}
+        self.failures = 0
+        self.timeouts = 0
+        self.quarantines = 0
+        self.quarantined_until = 0.0
+        # Runs on rank 0's node, so it can read spilled images from their files
+        self.local = False
+        # Being retired: no new work, TAG_STOP once it has answered what it holds
+        self.retiring = False
+        self.stop_sent = False
+
+    def taskSent(self, task, now, timeout):
+        if not self.inflight:
+            self.busy_since = now
+        self.inflight[task.task_id] = task
+        self.deadlines[task.task_id] = now + timeout
+
+    def taskDone(self, task_id, compute_seconds, now):
+        task = self.taskLost(task_id, now)
+        if task is not None:
+            self.completed += task.count
+            self.compute_time += compute_seconds
+        return task
+
+    def taskLost(self, task_id, now):
+        # None when the task was already taken away from this rank, e.g. a result after its deadline
+        task = self.inflight.pop(task_id, None)
+        if task is None:
+            return None
+        del self.deadlines[task_id]
+        if not self.inflight:
+            self.busy_time += now - self.busy_since
+            self.busy_since = None
+        return task
+
+    def expired(self, now):
+        # Every task gets the same timeout, so deadlines are in send order
+        expired = []
+        for task_id, deadline in self.deadlines.items():
+            if deadline > now:
+                break
+            expired.append(task_id)
+        return expired
+
+    def quarantine(self, now):
+        seconds = min(QUARANTINE_SECONDS * 2 ** self.quarantines, MAX_QUARANTINE_SECONDS)
+        self.quarantines += 1
+        self.quarantined_until = now + seconds
+        self.failures = 0
+        return seconds
+
+    def quarantined(self, now):
+        return now < self.quarantined_until
+
+    def freeSlots(self):
+        return self.window - len(self.inflight)
+
+
+class Dispatcher:
+    # Pull based dispatcher for rank 0.  A worker announces itself with
+    # TAG_READY and from then on always gets work as soon as it has a free
+    # slot in its window, so fast ranks take more images than slow ones and
+    # nobody waits on a particular rank.  Results are matched from any source.
+    # Every task sent has a deadline; a rank that misses one is quarantined
+    # and everything it holds goes to other ranks, so one wedged node slows
+    # the server down instead of stopping it.
+    def __init__(self, comm, task_queue, health_check=None, health_interval=1, tile_min_pixels=0, batcher=None,
+                 on_ready=None, on_stopped=None, task_timeout=DEFAULT_TASK_TIMEOUT, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 metrics=None):
+        self.comm = comm
+        self.task_queue = task_queue
+        # Returns the ranks that may get work, or None for all of them.  It must answer
+        # from a cache (see ClusterController.healthyRanks), it runs on the dispatch loop.
+        self.health_check = health_check
+        self.health_interval = health_interval
+        self.last_health_check = 0
+        self.healthy = None
+        # Called with (rank, ready info) when a worker rank announces itself
+        self.on_ready = on_ready
+        # Called with the rank once a rank retired through retireRank has shut down
+        self.on_stopped = on_stopped
+        # Ranks to retire, appended to from other threads
+        self.retire_requests = deque()
+        # (completed at, seconds from submit to result) for recent tasks
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.ranks = {}
+        self.hostname = MPI.Get_processor_name()
+        self.send_requests = []
+        self.result_pool = BufferPool()
+        # Tasks already taken off task_queue, e.g. the stripes of a tiled image
+        self.ready = deque()
+        # Images with at least this many pixels are split across ranks, 0 disables tiling
+        self.tile_min_pixels = tile_min_pixels
+        # Groups small images into one message per worker, None sends every image on its own
+        self.batcher = batcher
+        self.task_timeout = task_timeout
+        self.max_attempts = max_attempts
+        # Tasks to send again, each to a rank it has not failed on yet
+        self.retries = deque()
+        self.retried = 0
+        self.last_deadline_check = 0
+        self.metrics = metrics or Metrics(enabled=False)
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.stopping = False
+
+    def availableRanks(self):
+        now = time.monotonic()
+        ranks = [stats for stats in self.ranks.values()
+                 if stats.freeSlots() > 0 and not stats.quarantined(now) and not stats.retiring]
+        if self.healthy is not None:
+            ranks = [stats for stats in ranks if stats.rank in self.healthy]
+        return ranks
+
+    def refreshHealth(self, now):
+        if self.health_check is None or now - self.last_health_check < self.health_interval:
+            return
+        self.last_health_check = now
+        try:
+            healthy = self.health_check()
+            self.healthy = None if healthy is None else set(healthy)
+        except Exception as e:
+            print(f"Health check error: {e}")
+
+    def pollMessages(self):
+        # Drain everything that has arrived, without blocking
+        handled = 0
+        status = MPI.Status()
+        while True:
+            message = self.comm.improbe(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+            if message is None:
+                return handled
+            source, tag = status.Get_source(), status.Get_tag()
+            data = message.recv()
+            handled += 1
+            if tag == TAG_READY:
+                self.workerReady(source, data)
+            elif tag == TAG_RESULT:
+                task_id, result, error, timings = receiveResult(self.comm, data, source, self.result_pool)
+                stats = self.ranks[source]
+                task = stats.taskDone(task_id, sum(timings.values()), time.monotonic())
+                if task is None:
+                    # Too late, the task has been given to another rank
+                    self.result_pool.release(result)
+                    continue
+                self.metrics.observeSpans(timings)
+                task.result_pool = self.result_pool
+                self.taskAnswered(task, stats, result, error)
+            elif tag == TAG_BATCH_RESULT:
+                batch_id, results, timings = receiveBatchResult(self.comm, data, source)
+                stats = self.ranks[source]
+                batch = stats.taskDone(batch_id, sum(timings.values()), time.monotonic())
+                if batch is None:
+                    continue
+                self.metrics.observeSpans(timings, batch.count)
+                for task in batch.tasks:
+                    result, error = results.get(task.task_id, (None, "Missing from the batch result"))
+                    self.taskAnswered(task, stats, result, error)
+            elif tag == TAG_STOPPED:
+                self.rankStopped(source)
+
+    def taskAnswered(self, task, stats, result, error):
+        if error is None and result is None:
+            error = f"Worker {stats.rank} failed to process the image"
+        if error is not None:
+            self.retryOrFail(task, stats.rank, error)
+            return
+        now = time.monotonic()
+        stats.failures = 0
+        # Ranks that failed this image although it was fine are the ones to worry about
+        for rank in task.failed_ranks:
+            self.rankFailed(self.ranks[rank], now, "failed images other ranks processed")
+        self.latencies.append((now, now - task.created))
+        task.complete(result)
+
+    def retryOrFail(self, task, rank, error):
+        if error.startswith(INVALID_TASK):
+            # Any other rank would refuse it just the same, and this one is not to blame
+            task.complete(error=error)
+            return
+        task.failed_ranks.add(rank)
+        # Without another rank to try, the image itself is the likely problem
+        if task.attempts >= self.max_attempts or not self.eligibleRanks(task):
+            self.giveUp(task, error)
+            return
+        task.last_error = error
+        self.retried += 1
+        self.metrics.inc('image_retries_total')
+        self.retries.append(task)
+
+    def eligibleRanks(self, task):
+        # Ranks that may still take the task some time, busy or quarantined ones included
+        return [stats for stats in self.ranks.values() if stats.rank not in task.failed_ranks and not stats.retiring]
+
+    def giveUp(self, task, error):
+        if task.attempts > 1:
+            error = f"{error} (gave up after {task.attempts} attempts)"
+        task.complete(error=error)
+
+    def rankFailed(self, stats, now, reason):
+        if stats.quarantined(now):
+            return
+        stats.failures += 1
+        if stats.failures >= MAX_RANK_FAILURES:
+            self.quarantineRank(stats, now, f"{stats.failures} {reason}")
+
+    def quarantineRank(self, stats, now, reason):
+        seconds = stats.quarantine(now)
+        self.metrics.inc('worker_quarantines_total')
+        print(f"Worker {stats.rank} quarantined for {seconds}s: {reason}")
+
+    def checkDeadlines(self, now):
+        if now - self.last_deadline_check < DEADLINE_CHECK_INTERVAL:
+            return
+        self.last_deadline_check = now
+        for stats in self.ranks.values():
+            expired = stats.expired(now)
+            if not expired:
+                continue
+            stats.timeouts += len(expired)
+            self.metrics.inc('task_timeouts_total', amount=len(expired))
+            self.quarantineRank(stats, now, f"{len(expired)} task(s) past their {self.task_timeout}s deadline")
+            # Whatever else it holds is stuck behind them
+            for task_id in list(stats.inflight):
+                work = stats.taskLost(task_id, now)
+                for task in work.tasks if isinstance(work, TaskBatch) else [work]:
+                    self.retryOrFail(task, stats.rank, f"Timed out on worker {stats.rank}")
+
+    def workerReady(self, rank, info):
+        if not isinstance(info, dict):
+            info = {'capacity': info}  # Older workers only send their capacity
+        capacity = max(1, int(info.get('capacity', 1)))
+        self.ranks[rank] = stats = RankStats(rank, capacity)
+        stats.local = info.get('host') == self.hostname
+        where = f" on {info['host']}" if info.get('host') else ""
+        instance = f" ({info['instance']})" if info.get('instance') else ""
+        print(f"Worker {rank} ready with capacity {capacity}{where}{instance}")
+        if self.on_ready is not None:
+            self.on_ready(rank, info)
+        self.last_health_check = 0  # Pick the newcomer up straight away
+
+    def retireRank(self, rank):
+        # Safe to call from another thread, e.g. the autoscaler scaling in
+        self.retire_requests.append(rank)
+
+    def stopRetiredRanks(self):
+        while self.retire_requests:
+            stats = self.ranks.get(self.retire_requests.popleft())
+            if stats is not None:
+                stats.retiring = True
+        for stats in self.ranks.values():
+            if stats.retiring and not stats.stop_sent and not stats.inflight:
+                self.comm.send(None, dest=stats.rank, tag=TAG_STOP)
+                stats.stop_sent = True
+
+    def rankStopped(self, rank):
+        stats = self.ranks.pop(rank, None)
+        if stats is None or not stats.retiring:
+            return  # Answer to shutdownWorkers
+        print(f"Worker {rank} retired")
+        if self.on_stopped is not None:
+            self.on_stopped(rank)
+
+    def assignWork(self):
+        assigned = self.assignRetries()
+        while True:
+            ranks = self.availableRanks()
+            if not ranks:
+                return assigned
+            task = self.nextTask(ranks)
+            if task is None:
+                return assigned
+            self.sendWork(task, ranks)
+            assigned += 1
+
+    def assignRetries(self):
+        assigned = 0
+        for _ in range(len(self.retries)):
+            task = self.retries.popleft()
+            if not self.eligibleRanks(task):
+                # The ranks it could have gone to retired or left since it failed
+                self.giveUp(task, task.last_error)
+                continue
+            ranks = [stats for stats in self.availableRanks() if stats.rank not in task.failed_ranks]
+            if not ranks:
+                self.retries.append(task)  # Wait for one of the others to have room
+                continue
+            self.sendWork(task, ranks)
+            assigned += 1
+        return assigned
+
+    def sendWork(self, task, ranks):
+        # Least loaded rank relative to its window gets the task
+        stats = min(ranks, key=lambda s: (len(s.inflight) / s.window, s.completed))
+        now = time.monotonic()
+        if isinstance(task, TaskBatch):
+            requests, data = sendBatch(self.comm, task, stats.rank, TAG_BATCH)
+            members = task.tasks
+        else:
+            requests, data = sendTask(self.comm, task, stats.rank, TAG_TASK, stats.local)
+            members = [task]
+        for member in members:
+            if not member.attempts:
+                self.metrics.observe('queue_wait', now - member.created)
+            member.attempts += 1
+        self.send_requests.append((requests, data, now))
+        stats.taskSent(task, now, self.task_timeout)
+
+    def nextTask(self, ranks):
+        # The next unit of work: a task, a batch of small tasks, or None for now
+        if self.ready:
+            return self.ready.popleft()
+        now = time.monotonic()
+        # A batch that has waited long enough goes first, under steady load the queue may never run dry
+        if self.batcher is not None and self.batcher.due(now, False):
+            return self.batcher.take()
+        while True:
+            try:
+                task = self.task_queue.get_nowait()
+            except queue.Empty:
+                break
+            if self.splitLargeImage(task):
+                return self.ready.popleft()
+            if self.batcher is None or not self.batcher.accepts(task):
+                return task
+            self.batcher.add(task, now)
+            if self.batcher.full():
+                return self.batcher.take()
+        # Don't hold small images back while a worker has nothing at all to do
+        if self.batcher is not None and self.batcher.due(now, any(not stats.inflight for stats in ranks)):
+            return self.batcher.take()
+        return None
+
+    def splitLargeImage(self, task):
+        capacity = sum(stats.capacity for stats in self.ranks.values())
+        if not shouldTile(task, self.tile_min_pixels, capacity):
+            return False
+        # Stripes jump the queue so the image finishes as soon as possible
+        self.ready.extendleft(reversed(TiledTask(task, capacity).subtasks()))
+        return True
+
+    def reapSends(self):
+        if not self.send_requests:
+            return
+        # Each entry is (requests, array, sent at), the array has to outlive its Isend.
+        # Completion is only noticed once per loop, so mpi_send is a little high for small messages.
+        now = time.monotonic()
+        pending = []
+        for entry in self.send_requests:
+            if MPI.Request.Testall(entry[0]):
+                self.metrics.observe('mpi_send', now - entry[2])
+            else:
+                pending.append(entry)
+        self.send_requests = pending
+
+    def inflight(self):
+        return sum(len(stats.inflight) for stats in self.ranks.values())
+
+    def workerCount(self):
+        return len(self.ranks)
+
+    def quarantinedCount(self):
+        now = time.monotonic()
+        return sum(1 for stats in list(self.ranks.values()) if stats.quarantined(now))
+
+    def queued(self):
+        pending = len(self.batcher.pending) if self.batcher is not None else 0
+        return self.task_queue.qsize() + len(self.ready) + len(self.retries) + pending
+
+    def latencyPercentile(self, fraction, now):
+        samples = sorted(latency for completed, latency in list(self.latencies) if now - completed <= LATENCY_WINDOW)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+    def loadReport(self):
+        # What the autoscaler needs to know, safe to call from another thread
+        ranks = list(self.ranks.values())
+        return {
+            'queued': self.queued(),
+            'inflight': sum(len(stats.inflight) for stats in ranks),
+            'capacity': sum(stats.capacity for stats in ranks),
+            'latency_p95': self.latencyPercentile(0.95, time.monotonic()),
+        }
+
+    def waitForWork(self, idle_sleep):
+        if self.inflight() or not self.ranks or self.ready or self.retries or (self.batcher and self.batcher.pending):
+            time.sleep(idle_sleep)
+            return
+        # Nothing outstanding anywhere: block on the queue instead of spinning
+        try:
+            task = self.task_queue.get(timeout=0.1)
+        except queue.Empty:
+            return
+        if not self.splitLargeImage(task):
+            self.ready.append(task)
+
+    def run(self):
+        idle_sleep = IDLE_SLEEP
+        while not self.stopping:
+            now = time.monotonic()
+            self.refreshHealth(now)
+            self.checkDeadlines(now)
+            self.stopRetiredRanks()
+            progress = self.pollMessages() + self.assignWork()
+            self.reapSends()
+            if now - self.last_report > REPORT_INTERVAL:
+                self.printUtilization()
+                self.last_report = now
+            if progress:
+                idle_sleep = IDLE_SLEEP
+            else:
+                self.waitForWork(idle_sleep)
+                idle_sleep = min(idle_sleep * 2, MAX_IDLE_SLEEP)
+
+    def stop(self):
+        self.stopping = True
+
+    def shutdownWorkers(self):
+        for rank in range(1, self.comm.Get_size()):
+            self.comm.send(None, dest=rank, tag=TAG_STOP)
+
+    def utilizationReport(self):
+        now = time.monotonic()
+        elapsed = max(now - self.started, 1e-9)
+        report = {}
+        for rank, stats in sorted(self.ranks.items()):
+            busy = stats.busy_time + (now - stats.busy_since if stats.busy_since is not None else 0)
+            report[rank] = {
+                'completed': stats.completed,
+                'inflight': len(stats.inflight),
+                'busy_fraction': busy / elapsed,
+                'compute_fraction': stats.compute_time / (elapsed * stats.capacity),
+                'timeouts': stats.timeouts,
+                'quarantined': stats.quarantined(now),
+            }
+        return report
+
+    def printUtilization(self):
+        for rank, entry in self.utilizationReport().items():
+            print(f"Rank {rank}: {entry['completed']} images, {entry['inflight']} in flight, "
+                  f"busy {entry['busy_fraction']:.0%}, computing {entry['compute_fraction']:.0%}, "
+                  f"{entry['timeouts']} timeouts{', quarantined' if entry['quarantined'] else ''}")
+        if self.retried:
+            print(f"Retried {self.retried} images on another rank")
+        if self.batcher is not None and self.batcher.batches:
+            print(f"Batched {self.batcher.batched_tasks} small images into {self.batcher.batches} messages")
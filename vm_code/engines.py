@@ -0,0 +1,279 @@
+import multiprocessing
+import os
+import queue
+import time
+from collections import deque
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# The pool processes of ProcessBackend import server.py first, which keeps
+# them from initialising MPI before this module pulls in mpi4py
+from dispatcher import LATENCY_SAMPLES, LATENCY_WINDOW, MAX_IDLE_SLEEP, REPORT_INTERVAL, WINDOW_PER_SLOT
+from metrics import Metrics
+from staging import mapSpilled, spillLocation
+from transport import KIND_ARRAY, KIND_ENCODED
+from worker import ImageWorker, availableCores, configureOpenCVThreads
+
+# Execution engines: what runs the images once the ingest server has queued
+# them.  All of them take tasks off task_queue, call Task.complete and answer
+# the same questions for the gauges and the autoscaler, so server.py does not
+# care which one it drives:
+#   mpi        Dispatcher, worker ranks started by mpirun, one machine or many
+#   processes  LocalEngine over a process pool on this machine, images handed
+#              over in shared memory
+#   threads    LocalEngine over threads in this process, nothing copied at all
+# Every backend runs ImageWorker.runTask, so operations and results are
+# identical whichever one is used.
+
+ENGINES = ('mpi', 'processes', 'threads')
+
+
+def chooseEngine(engine, world_size):
+    # 'auto' is MPI under mpirun and a local process pool otherwise
+    if engine != 'auto':
+        return engine
+    return 'mpi' if world_size > 1 else 'processes'
+
+
+class ThreadBackend:
+    name = 'threads'
+
+    def __init__(self, size):
+        self.size = size
+        configureOpenCVThreads(size)
+        # Only its operations are used, the thread itself is never started
+        self.worker = ImageWorker('local', None, None, None)
+        self.executor = ThreadPoolExecutor(size, thread_name_prefix='image-engine')
+
+    def submit(self, task):
+        kind = KIND_ENCODED if task.encoded else KIND_ARRAY
+        return self.executor.submit(self.worker.runTask, kind, task.image, task.operation, task.params, task.output)
+
+    def release(self, future):
+        pass
+
+    def restart(self):
+        self.executor = ThreadPoolExecutor(self.size, thread_name_prefix='image-engine')
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# The pool process' own ImageWorker, created by initProcess
+_process_worker = None
+
+
+def initProcess(size):
+    global _process_worker
+    configureOpenCVThreads(size)
+    _process_worker = ImageWorker(os.getpid(), None, None, None)
+
+
+def runShared(location, shape, dtype, kind, operation, params, output):
+    # Runs in a pool process.  location is ('shm', block name) for an image the
+    # parent copied into shared memory, or ('file', path, offset) for a spilled one.
+    block = None
+    if location[0] == 'file':
+        data = mapSpilled(location[1], location[2], shape, dtype)
+    else:
+        # Spawned pool processes share the parent's resource tracker, which unlinks
+        # the block if the parent dies before freeing it; only the parent unregisters it
+        block = shared_memory.SharedMemory(name=location[1])
+        data = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    try:
+        result, error, timings, result_kind = _process_worker.runTask(kind, data, operation, params, output)
+        if result is not None and np.may_share_memory(result, data):
+            result = result.copy()
+        return result, error, timings, result_kind
+    finally:
+        del data
+        if block is not None:
+            block.close()
+
+
+class ProcessBackend:
+    name = 'processes'
+
+    def __init__(self, size):
+        self.size = size
+        self.blocks = {}  # future -> shared memory block to free once it is done
+        self.executor = self.createExecutor()
+
+    def createExecutor(self):
+        # spawn, not fork: rank 0 has threads and possibly an MPI runtime that must not be duplicated
+        return ProcessPoolExecutor(self.size, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=initProcess, initargs=(self.size,))
+
+    def submit(self, task):
+        kind = KIND_ENCODED if task.encoded else KIND_ARRAY
+        location = spillLocation(task.image)
+        block = None
+        if location is not None:
+            image = task.image
+            location = ('file',) + location
+        else:
+            image = np.ascontiguousarray(task.image)
+            block = shared_memory.SharedMemory(create=True, size=max(1, image.nbytes))
+            shared = np.ndarray(image.shape, dtype=image.dtype, buffer=block.buf)
+            shared[...] = image
+            del shared
+            location = ('shm', block.name)
+        try:
+            future = self.executor.submit(runShared, location, image.shape, image.dtype.str, kind, task.operation,
+                                          task.params, task.output)
+        except BaseException:
+            if block is not None:
+                self.freeBlock(block)
+            raise
+        if block is not None:
+            self.blocks[future] = block
+        return future
+
+    @staticmethod
+    def freeBlock(block):
+        block.close()
+        block.unlink()
+
+    def release(self, future):
+        block = self.blocks.pop(future, None)
+        if block is not None:
+            self.freeBlock(block)
+
+    def restart(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = self.createExecutor()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        for block in self.blocks.values():
+            self.freeBlock(block)
+        self.blocks.clear()
+
+
+def createBackend(engine, size=None):
+    size = size or availableCores()
+    return ProcessBackend(size) if engine == 'processes' else ThreadBackend(size)
+
+
+class LocalEngine:
+    # Single machine counterpart of Dispatcher, same calls from server.py.
+    # There is no tiling, batching or retrying on other workers here: all of
+    # that exists to spread work over ranks and amortise MPI messages.
+    def __init__(self, task_queue, backend, metrics=None):
+        self.task_queue = task_queue
+        self.backend = backend
+        self.metrics = metrics or Metrics(enabled=False)
+        self.window = backend.size * WINDOW_PER_SLOT
+        self.running = {}  # future -> task
+        self.done = queue.Queue()
+        # (completed at, seconds from submit to result) for recent tasks
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.completed = 0
+        self.failed = 0
+        self.compute_time = 0.0
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.stopping = False
+
+    def submit(self, task):
+        self.metrics.observe('queue_wait', time.monotonic() - task.created)
+        try:
+            future = self.backend.submit(task)
+        except BrokenExecutor as e:
+            # A pool process died, e.g. killed by the OOM killer; start over with a fresh pool
+            print(f"Engine {self.backend.name} error: {e}")
+            self.backend.restart()
+            future = self.backend.submit(task)
+        self.running[future] = task
+        future.add_done_callback(self.done.put)
+
+    def finish(self, future):
+        task = self.running.pop(future)
+        self.backend.release(future)
+        try:
+            result, error, timings, kind = future.result()
+        except Exception as e:
+            result, error, timings, kind = None, f"Engine {self.backend.name} error: {e}", {}, KIND_ARRAY
+        self.metrics.observeSpans(timings)
+        self.compute_time += timings.get('compute', 0.0)
+        if error is None and result is None:
+            error = "Failed to process the image"
+        if error is not None:
+            self.failed += 1
+            task.complete(error=error)
+            return
+        if kind == KIND_ENCODED:
+            result = bytearray(result)  # What the ingest server expects of an encoded result
+        now = time.monotonic()
+        self.completed += 1
+        self.latencies.append((now, now - task.created))
+        task.complete(result)
+
+    def fill(self):
+        while len(self.running) < self.window:
+            try:
+                task = self.task_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.submit(task)
+
+    def run(self):
+        print(f"Engine {self.backend.name} running {self.backend.size} workers")
+        try:
+            while not self.stopping:
+                self.fill()
+                if not self.running:
+                    # Nothing outstanding anywhere: block on the queue instead of spinning
+                    try:
+                        self.submit(self.task_queue.get(timeout=0.1))
+                    except queue.Empty:
+                        pass
+                    continue
+                try:
+                    self.finish(self.done.get(timeout=MAX_IDLE_SLEEP))
+                    while True:
+                        self.finish(self.done.get_nowait())
+                except queue.Empty:
+                    pass
+                now = time.monotonic()
+                if now - self.last_report > REPORT_INTERVAL:
+                    self.printUtilization()
+                    self.last_report = now
+        finally:
+            self.backend.shutdown()
+
+    def stop(self):
+        self.stopping = True
+
+    def queued(self):
+        return self.task_queue.qsize()
+
+    def inflight(self):
+        return len(self.running)
+
+    def workerCount(self):
+        return self.backend.size
+
+    def quarantinedCount(self):
+        return 0
+
+    def latencyPercentile(self, fraction, now):
+        samples = sorted(latency for completed, latency in list(self.latencies) if now - completed <= LATENCY_WINDOW)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+    def loadReport(self):
+        return {
+            'queued': self.queued(),
+            'inflight': self.inflight(),
+            'capacity': self.backend.size,
+            'latency_p95': self.latencyPercentile(0.95, time.monotonic()),
+        }
+
+    def printUtilization(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        print(f"Engine {self.backend.name}: {self.completed} images, {self.failed} failed, "
+              f"{len(self.running)} in flight, computing {self.compute_time / (elapsed * self.backend.size):.0%}")
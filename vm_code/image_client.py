@@ -0,0 +1,111 @@
+import socket
+import threading
+
+from wire_protocol import (FRAME_IMAGE, FRAME_END, FRAME_RESULT, FRAME_ERROR, OP_PIPELINE, FORMAT_AUTO,
+                           DEFAULT_KSIZE, DEFAULT_THRESHOLD1, DEFAULT_THRESHOLD2,
+                           FrameReader, ProtocolError, configureSocket, packHeader, packOptions, packPipeline,
+                           sendFrame)
+
+
+class ImageProcessingError(Exception):
+    def __init__(self, request_id, message):
+        super().__init__(f"Request {request_id} failed: {message}")
+        self.request_id = request_id
+
+
+class ImageClient:
+    # Client side of the framed ingest protocol in wire_protocol.py.
+    # Images are pipelined: submit() never waits for the server.
+    def __init__(self, host='127.0.0.1', port=55552, timeout=None):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        configureSocket(self.sock)
+        self.reader = FrameReader(self.sock)
+        self.next_request_id = 0
+
+    def submit(self, image_bytes, operation, ksize=DEFAULT_KSIZE,
+               threshold1=DEFAULT_THRESHOLD1, threshold2=DEFAULT_THRESHOLD2, output_format=FORMAT_AUTO, quality=0,
+               priority=None, deadline_ms=None, target_size=None):
+        # output_format / quality: how the result comes back, see FORMAT_* in wire_protocol.py
+        # priority: 'interactive', 'bulk' or None to let the server decide
+        # deadline_ms: fail the request instead of processing it once it has waited this long
+        # target_size: (width, height) box the result is scaled down to fit, None for full size
+        flags, prefix = packOptions(priority, deadline_ms, target_size)
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        header = packHeader(FRAME_IMAGE, request_id, len(prefix) + len(image_bytes), operation, flags,
+                            ksize=ksize, threshold1=threshold1, threshold2=threshold2,
+                            output_format=output_format, quality=quality)
+        sendFrame(self.sock, header + prefix, image_bytes)
+        return request_id
+
+    def submitPipeline(self, image_bytes, steps, output_format=FORMAT_AUTO, quality=0, priority=None,
+                       deadline_ms=None, target_size=None):
+        # steps: operation codes, PipelineStep tuples or dicts, applied in order on the worker
+        flags, prefix = packOptions(priority, deadline_ms, target_size)
+        table = packPipeline(steps)
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        header = packHeader(FRAME_IMAGE, request_id, len(prefix) + len(table) + len(image_bytes), OP_PIPELINE,
+                            flags, output_format=output_format, quality=quality)
+        sendFrame(self.sock, header + prefix + table, image_bytes)
+        return request_id
+
+    def finish(self):
+        # Tell the server the batch is complete
+        sendFrame(self.sock, packHeader(FRAME_END))
+
+    def results(self):
+        # Yields (request_id, image_bytes, error) until the server ends the stream.
+        # image_bytes is copied out of the receive buffer so it can be kept.
+        while True:
+            header, payload = self.reader.readFrame()
+            if header is None or header.frame_type == FRAME_END:
+                return
+            if header.frame_type == FRAME_RESULT:
+                yield header.request_id, bytes(payload), None
+            elif header.frame_type == FRAME_ERROR:
+                yield header.request_id, None, bytes(payload).decode('utf-8', 'replace')
+            else:
+                raise ProtocolError(f"Unexpected frame type from server: {header.frame_type}")
+
+    def processBatch(self, images):
+        # images: iterable of (image_bytes, operation) or (image_bytes, operation, params dict),
+        # where operation may also be a list of pipeline steps.  For pipelines params may
+        # only hold output_format, quality, priority, deadline_ms and target_size.
+        # Sending runs on its own thread so results can stream back while
+        # we are still uploading, which keeps both socket buffers from filling up.
+        request_ids = []
+        send_errors = []
+
+        def sender():
+            try:
+                for item in images:
+                    image_bytes, operation = item[0], item[1]
+                    params = item[2] if len(item) > 2 else {}
+                    if isinstance(operation, (list, tuple)):
+                        request_ids.append(self.submitPipeline(image_bytes, operation, **params))
+                    else:
+                        request_ids.append(self.submit(image_bytes, operation, **params))
+                self.finish()
+            except Exception as e:
+                send_errors.append(e)
+                self.sock.shutdown(socket.SHUT_WR)
+
+        send_thread = threading.Thread(target=sender, daemon=True)
+        send_thread.start()
+        results = {}
+        for request_id, image_bytes, error in self.results():
+            results[request_id] = image_bytes if error is None else ImageProcessingError(request_id, error)
+        send_thread.join()
+        if send_errors:
+            raise send_errors[0]
+        return [results.get(request_id) for request_id in request_ids]
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,143 @@
+import struct
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from wire_protocol import FORMAT_AUTO, FORMAT_JPEG, FORMAT_PNG, FORMAT_WEBP, ProtocolError
+
+# Encoding of results straight into memory, wherever the result is produced:
+# on the worker for whole images, on rank 0 for stitched stripes.
+
+EXTENSIONS = {FORMAT_JPEG: '.jpg', FORMAT_PNG: '.png', FORMAT_WEBP: '.webp'}
+QUALITY_FLAGS = {FORMAT_JPEG: cv2.IMWRITE_JPEG_QUALITY, FORMAT_PNG: cv2.IMWRITE_PNG_COMPRESSION,
+                 FORMAT_WEBP: cv2.IMWRITE_WEBP_QUALITY}
+QUALITY_RANGES = {FORMAT_JPEG: (1, 100), FORMAT_PNG: (1, 9), FORMAT_WEBP: (1, 100)}
+# Edge maps are mostly zeros, a fast PNG level already squeezes them well
+DEFAULT_PNG_COMPRESSION = 3
+
+# JPEG can be decoded at 1/2, 1/4 or 1/8 scale straight from the DCT
+# coefficients, which skips most of the work.  Other formats gain nothing
+# from the reduced modes and are decoded in full, then downscaled.
+REDUCED_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4,
+                 8: cv2.IMREAD_REDUCED_COLOR_8}
+# JPEG start of frame markers, the ones that carry the image size
+JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# How an image with a target size is decoded: the reduction factor, and the
+# sizes (width, height) in the file and after the early downscale
+DecodePlan = namedtuple('DecodePlan', ['reduction', 'full_size', 'output_size'])
+
+
+def outputFormat(output_format, quality, edges):
+    # Resolves FORMAT_AUTO and checks the quality, returns the pair the encoder gets
+    if output_format == FORMAT_AUTO:
+        output_format = FORMAT_PNG if edges else FORMAT_JPEG
+    if output_format not in EXTENSIONS:
+        raise ProtocolError(f"Unknown output format: {output_format}")
+    low, high = QUALITY_RANGES[output_format]
+    if quality and not low <= quality <= high:
+        raise ProtocolError(f"Quality {quality} out of range {low}-{high} for format {output_format}")
+    if not quality and output_format == FORMAT_PNG:
+        quality = DEFAULT_PNG_COMPRESSION
+    return output_format, quality
+
+
+def encodeImage(image, output_format=FORMAT_JPEG, quality=0):
+    # Returns the encoded file as a flat uint8 array
+    params = [QUALITY_FLAGS[output_format], quality] if quality else []
+    ok, encoded = cv2.imencode(EXTENSIONS[output_format], image, params)
+    if not ok:
+        raise ValueError("Could not encode result")
+    return encoded.reshape(-1)
+
+
+def decodeImage(payload, flags=cv2.IMREAD_COLOR):
+    return cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), flags)
+
+
+def jpegSize(data):
+    position = 2
+    while position + 9 <= len(data):
+        if data[position] != 0xFF:
+            return None
+        marker = data[position + 1]
+        if marker == 0xFF:
+            position += 1  # Fill byte
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            position += 2  # No length field
+            continue
+        if marker in JPEG_SOF:
+            height, width = struct.unpack_from('>HH', data, position + 5)
+            return width, height
+        position += 2 + struct.unpack_from('>H', data, position + 2)[0]
+    return None
+
+
+def webpSize(data):
+    chunk = bytes(data[12:16])
+    if chunk == b'VP8 ' and len(data) >= 30:
+        width, height = struct.unpack_from('<HH', data, 26)
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L' and len(data) >= 25:
+        bits, = struct.unpack_from('<I', data, 21)
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8X' and len(data) >= 30:
+        return (int.from_bytes(data[24:27], 'little') + 1, int.from_bytes(data[27:30], 'little') + 1)
+    return None
+
+
+def imageSize(payload):
+    # (width, height) from the file header without decoding anything, and
+    # whether it is a JPEG; None for a size this does not know how to read
+    data = memoryview(payload).cast('B')
+    if bytes(data[:2]) == b'\xff\xd8':
+        return jpegSize(data), True
+    if bytes(data[:8]) == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        return struct.unpack_from('>II', data, 16), False
+    if bytes(data[:4]) == b'RIFF' and bytes(data[8:12]) == b'WEBP':
+        return webpSize(data), False
+    return None, False
+
+
+def fitSize(size, target):
+    # Largest size with the same aspect ratio inside the target box, never bigger than size
+    width, height = size
+    scale = min(target[0] / width, target[1] / height, 1.0)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def planDecode(payload, target):
+    # Picks the largest reduction that still leaves at least the output size.
+    # The file may say to rotate the image, so the size must do either way round.
+    size, jpeg = imageSize(payload)
+    if size is None or not size[0] or not size[1]:
+        return DecodePlan(1, None, None)
+    output = fitSize(size, target)
+    rotated = fitSize(size[::-1], target)
+    needed = max(output[0] / size[0], rotated[0] / size[1])
+    reduction = 1
+    if jpeg:
+        for factor in (8, 4, 2):
+            if needed * factor <= 1:
+                reduction = factor
+                break
+    return DecodePlan(reduction, tuple(size), output)
+
+
+def fitImage(image, target):
+    # The early downscale: done straight after decoding, before anything else touches the pixels
+    height, width = image.shape[:2]
+    size = fitSize((width, height), target)
+    if size == (width, height):
+        return image
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+def decodeScaled(payload, target, reduction=1):
+    # Decodes at 1/reduction and fits the result into target, None if it cannot be decoded
+    image = decodeImage(payload, REDUCED_FLAGS[reduction])
+    if image is None or target is None:
+        return image
+    return fitImage(image, target)
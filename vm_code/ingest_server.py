@@ -0,0 +1,363 @@
+import asyncio
+import os
+import queue
+import resource
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from image_codec import decodeImage, decodeScaled, encodeImage, outputFormat, planDecode
+from metrics import Metrics
+from pipeline import checkStep, planPipeline
+from result_cache import cacheKey
+from scheduler import priorityFromFlags
+from tasks import Task
+from tiling import endsInEdges
+from wire_protocol import (HEADER_SIZE, FRAME_IMAGE, FRAME_END, FRAME_RESULT, FRAME_ERROR, OP_PIPELINE,
+                           PipelineStep, ProtocolError, configureSocket, operationParams, packHeader,
+                           splitDeadline, splitPipelinePayload, splitTargetSize, unpackHeader)
+
+# Results waiting to be written are flushed together, up to this many bytes per drain
+WRITE_BATCH_BYTES = 4 * 1024 * 1024
+
+# Admitted but not yet answered tasks across all connections.  This is what
+# bounds rank 0 memory: once it is reached connections simply stop reading
+# from their sockets and TCP pushes back on the clients.
+MAX_PENDING_TASKS = 256
+# Share of those one connection can hold, so a bulk upload cannot take every
+# slot and keep other clients' frames from even being read
+MAX_PENDING_PER_CLIENT = 128
+REPORT_INTERVAL = 60
+
+
+def raiseFileLimit():
+    # Every client connection is a file descriptor
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def encodeAndCache(result, output, cache, key):
+    # Only stitched stripe results still arrive as pixels, everything else
+    # was already encoded on the worker
+    if not isinstance(result, (bytes, bytearray)):
+        result = encodeImage(result, *output).tobytes()
+    if cache is not None and key is not None:
+        cache.put(key, result)
+    return result
+
+
+def lookupCache(cache, payload, operation, params, output, target_size):
+    key = cacheKey(payload, operation, params, output, target_size)
+    return key, cache.get(key)
+
+
+def decodeAndStage(payload, target_size, plan, staging):
+    # Rank 0 decode, as small as the request allows, then into the staging area
+    if target_size is None:
+        image = decodeImage(payload)
+    else:
+        image = decodeScaled(payload, target_size, plan.reduction)
+    if image is None or staging is None:
+        return image
+    return staging.stage(image)
+
+
+def taskParams(header, payload):
+    # Returns the parameters for the task and the bytes of the image itself
+    if header.operation != OP_PIPELINE:
+        # Refused here rather than retried on every rank, none of them could run it
+        checkStep(PipelineStep(header.operation, header.ksize, header.threshold1, header.threshold2))
+        return operationParams(header), payload
+    steps, image_bytes = splitPipelinePayload(payload)
+    return {'steps': planPipeline(steps)}, image_bytes
+
+
+class ClientConnection:
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.peer = writer.get_extra_info('peername')
+        # Who the scheduler shares the cluster fairly between: this connection, or its host
+        self.client = self.peer[0] if server.fair_share_by == 'host' and self.peer else self.peer
+        self.slots = asyncio.Semaphore(server.max_pending_per_client)
+        # Requests with a target size, and the decoded pixel bytes that saved
+        self.downscaled = 0
+        self.bytes_saved = 0
+        self.results = asyncio.Queue()
+        self.outstanding = 0
+        self.finished_reading = False
+        self.closed = False
+
+    async def readFrames(self):
+        loop = asyncio.get_running_loop()
+        metrics = self.server.metrics
+        while not self.closed:
+            try:
+                header = unpackHeader(await self.reader.readexactly(HEADER_SIZE))
+            except asyncio.IncompleteReadError as e:
+                if e.partial:
+                    raise ProtocolError("Connection closed in the middle of a header")
+                return
+            arrived = time.monotonic()
+            if header.frame_type == FRAME_END:
+                return
+            if header.frame_type != FRAME_IMAGE:
+                raise ProtocolError(f"Unexpected frame type from client: {header.frame_type}")
+
+            # Take a slot before buffering the payload
+            await self.slots.acquire()
+            try:
+                await self.server.admission.acquire()
+            except BaseException:
+                self.slots.release()
+                raise
+            self.outstanding += 1
+            try:
+                admitted = time.monotonic()
+                payload = await self.reader.readexactly(header.payload_length)
+                metrics.observe('receive', time.monotonic() - admitted)
+                try:
+                    deadline_ms, payload = splitDeadline(header, payload)
+                    target_size, payload = splitTargetSize(header, payload)
+                    params, payload = taskParams(header, payload)
+                    output = outputFormat(header.output_format, header.quality,
+                                          endsInEdges(header.operation, params))
+                except ProtocolError as e:
+                    self.onComplete(None, header.request_id, None, str(e), arrived=arrived)
+                    continue
+                key = None
+                if self.server.cache is not None:
+                    # A hit skips decoding and the cluster altogether
+                    key, cached = await loop.run_in_executor(self.server.executor, lookupCache, self.server.cache,
+                                                             payload, header.operation, params, output,
+                                                             target_size)
+                    if cached is not None:
+                        self.onComplete(None, header.request_id, cached, None, output[0], arrived)
+                        continue
+                # Only the header is parsed here, the decode itself may happen on the worker
+                plan = planDecode(payload, target_size) if target_size is not None else None
+                if self.server.decode_on_worker:
+                    image = np.frombuffer(payload, dtype=np.uint8)
+                    if plan is not None:
+                        params = dict(params, decode=(plan.reduction, target_size))
+                    if self.server.staging is not None:
+                        image = await loop.run_in_executor(self.server.executor, self.server.staging.stage, image)
+                else:
+                    decode_start = time.monotonic()
+                    image = await loop.run_in_executor(self.server.executor, decodeAndStage, payload,
+                                                       target_size, plan, self.server.staging)
+                    metrics.observe('decode', time.monotonic() - decode_start)
+            except BaseException:
+                self.releaseSlot()
+                raise
+            if image is None:
+                self.onComplete(None, header.request_id, None, "Could not decode image", arrived=arrived)
+                continue
+            task = Task(header.request_id, image, header.operation, params,
+                        self.server.completionCallback(self), encoded=self.server.decode_on_worker)
+            task.received = arrived
+            task.cache_key = key
+            task.output = output
+            task.client = self.client
+            task.priority = priorityFromFlags(header.flags)
+            task.decode_plan = plan
+            if deadline_ms is not None:
+                task.deadline = arrived + deadline_ms / 1000
+            self.server.task_queue.put_nowait(task)
+
+    def releaseSlot(self):
+        self.outstanding -= 1
+        self.slots.release()
+        self.server.admission.release()
+
+    def onComplete(self, task, request_id, result, error, output_format=None, arrived=None):
+        # Runs on the event loop; arrived is when the request's frame started to arrive
+        if self.closed:
+            # Nobody left to send it to
+            self.releaseSlot()
+        else:
+            self.results.put_nowait((task, request_id, result, error, output_format, arrived, time.monotonic()))
+
+    async def writeResult(self, item):
+        # Queues one frame on the transport, returns its size
+        task, request_id, result, error, output_format, _, _ = item
+        if error is None:
+            if isinstance(result, bytes) or (isinstance(result, bytearray) and task.cache_key is None):
+                data = result  # From the cache, or encoded on the worker
+            else:
+                encode_start = time.monotonic()
+                try:
+                    data = await asyncio.get_running_loop().run_in_executor(
+                        self.server.executor, encodeAndCache, result, task.output,
+                        self.server.cache, task.cache_key)
+                finally:
+                    task.releaseResult(result)
+                if not isinstance(result, (bytes, bytearray)):
+                    self.server.metrics.observe('encode', time.monotonic() - encode_start)
+            self.writer.writelines([packHeader(FRAME_RESULT, request_id, len(data), output_format=output_format),
+                                    data])
+            return HEADER_SIZE + len(data)
+        message = str(error).encode('utf-8')
+        self.writer.writelines([packHeader(FRAME_ERROR, request_id, len(message)), message])
+        return HEADER_SIZE + len(message)
+
+    async def writeResults(self):
+        # Results go out in the order they complete, each tagged with its request id.
+        # Whatever has piled up meanwhile is written before a single drain.
+        while not (self.finished_reading and self.outstanding == 0):
+            item = await self.results.get()
+            batch = []
+            try:
+                pending_bytes = 0
+                while True:
+                    if item is not None:
+                        batch.append(item)
+                        pending_bytes += await self.writeResult(item)
+                    if pending_bytes >= WRITE_BATCH_BYTES or self.results.empty():
+                        break
+                    item = self.results.get_nowait()
+                await self.writer.drain()
+                self.recordWritten(batch)
+            finally:
+                # Free the slots only once the results have left rank 0
+                for _ in batch:
+                    self.releaseSlot()
+        self.writer.write(packHeader(FRAME_END))
+        await self.writer.drain()
+
+    def recordWritten(self, items):
+        metrics = self.server.metrics
+        now = time.monotonic()
+        for task, _, _, error, _, arrived, completed in items:
+            metrics.observe('return', now - completed)
+            if arrived is not None:
+                metrics.observe('total', now - arrived)
+            metrics.inc('image_results_total', 'error' if error is not None else 'cached' if task is None else 'ok')
+            if task is not None and task.decode_plan is not None and task.decode_plan.full_size is not None:
+                self.recordDownscale(task.decode_plan, now - arrived if arrived is not None else None)
+
+    def recordDownscale(self, plan, seconds):
+        # Pixels that were never decoded, shipped over MPI or processed, at 3 bytes each.  The time
+        # avoided would take the full decode to see, bench_downscale.py measures it; counted here is
+        # the time these requests took end to end, to set against the 'total' span of the others.
+        full_width, full_height = plan.full_size
+        width, height = plan.output_size
+        saved = 3 * (full_width * full_height - width * height)
+        self.downscaled += 1
+        self.bytes_saved += saved
+        metrics = self.server.metrics
+        metrics.inc('image_downscaled_total')
+        metrics.inc('image_downscale_bytes_saved_total', amount=saved)
+        if seconds is not None:
+            metrics.inc('image_downscaled_seconds_total', amount=seconds)
+        if plan.reduction > 1:
+            metrics.inc('image_reduced_decodes_total')
+
+    def abandon(self):
+        # The client went away, drop whatever was waiting to be written
+        self.closed = True
+        while not self.results.empty():
+            if self.results.get_nowait() is not None:
+                self.releaseSlot()
+
+    async def serve(self):
+        print(f"Client {self.peer} connected.")
+        writer_task = asyncio.create_task(self.writeResults())
+        try:
+            await self.readFrames()
+        except (ProtocolError, ConnectionError, asyncio.IncompleteReadError) as e:
+            print(f"Client handling error: {e}")
+        self.finished_reading = True
+        self.results.put_nowait(None)  # Wake the writer in case everything was already answered
+        try:
+            await writer_task
+        except Exception as e:
+            print(f"Error sending processed images to {self.peer}: {e}")
+            self.abandon()
+        finally:
+            self.writer.close()
+        if self.downscaled:
+            print(f"Client {self.peer} done, {self.downscaled} images downscaled early, "
+                  f"{self.bytes_saved / 1e6:.1f} MB of pixels saved.")
+        else:
+            print(f"Client {self.peer} done.")
+
+
+class IngestServer:
+    # asyncio front end for the framed protocol.  It owns the sockets and
+    # hands decoded tasks to the dispatch layer through task_queue; results
+    # come back through Task.complete on the dispatcher thread.
+    def __init__(self, task_queue, host='0.0.0.0', port=55552,
+                 max_pending=MAX_PENDING_TASKS, decode_threads=None, decode_on_worker=False, cache=None,
+                 metrics=None, max_pending_per_client=MAX_PENDING_PER_CLIENT, fair_share_by='connection',
+                 staging=None):
+        self.task_queue = task_queue
+        self.cache = cache
+        # Bounds the memory taken by images waiting for a worker, None keeps them all in memory
+        self.staging = staging
+        self.metrics = metrics or Metrics(enabled=False)
+        # Ship the encoded bytes and let the worker decode, instead of decoding on rank 0
+        self.decode_on_worker = decode_on_worker
+        self.host = host
+        self.port = port
+        self.max_pending = max_pending
+        self.max_pending_per_client = max_pending_per_client
+        self.fair_share_by = fair_share_by
+        self.executor = ThreadPoolExecutor(max_workers=decode_threads or os.cpu_count() or 1,
+                                           thread_name_prefix='ingest-codec')
+        self.loop = None
+        self.admission = None
+        self.thread = None
+        self.started = threading.Event()
+
+    def completionCallback(self, connection):
+        loop = self.loop
+
+        def onComplete(task, result, error):
+            output_format = task.output[0] if task.output else None
+            loop.call_soon_threadsafe(connection.onComplete, task, task.request_id, result, error, output_format,
+                                      task.received)
+        return onComplete
+
+    async def handleConnection(self, reader, writer):
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            configureSocket(sock)
+        await ClientConnection(self, reader, writer).serve()
+
+    async def serveForever(self):
+        self.loop = asyncio.get_running_loop()
+        self.admission = asyncio.Semaphore(self.max_pending)
+        server = await asyncio.start_server(self.handleConnection, self.host, self.port, backlog=4096)
+        print("Server is waiting for connections...")
+        self.started.set()
+        if self.cache is not None:
+            asyncio.create_task(self.reportCacheStats())
+        async with server:
+            await server.serve_forever()
+
+    async def reportCacheStats(self):
+        while True:
+            await asyncio.sleep(REPORT_INTERVAL)
+            stats = self.cache.stats()
+            print("Result cache: " + ", ".join(f"{name} {value}" for name, value in stats.items()))
+
+    def start(self):
+        # The event loop gets its own thread so rank 0's main thread stays free for MPI
+        raiseFileLimit()
+        self.thread = threading.Thread(target=asyncio.run, args=(self.serveForever(),),
+                                       name='ingest-server', daemon=True)
+        self.thread.start()
+        self.started.wait()
+
+
+def boundedTaskQueue(max_pending=MAX_PENDING_TASKS):
+    # Never fills up in practice, admission control in IngestServer keeps it below max_pending
+    return queue.Queue(maxsize=max_pending)
@@ -0,0 +1,168 @@
+import bisect
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Timing spans and counters for the hot path, aggregated on rank 0 and
+# exported in the Prometheus text format.  Recording a span is a bisect and
+# three additions under a lock, cheap enough to leave on in production;
+# workers only measure and ship their spans back with each result.
+
+# Where an image's time goes, in the order it happens
+SPANS = {
+    'receive': "reading the image frame off the client socket",
+    'decode': "decoding the image file, on rank 0 or on the worker",
+    'queue_wait': "waiting on rank 0 for a free worker slot",
+    'mpi_send': "from posting the MPI send of a task or batch until it completed",
+    'compute': "running the operation on the worker",
+    'encode': "encoding the result, usually on the worker",
+    'return': "from the result reaching the ingest loop until it was written to the client",
+    'total': "from the first byte of the frame until the result was written",
+}
+# Seconds, about 2.5x apart from 100 microseconds to a minute
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+           5.0, 10.0, 25.0, 60.0)
+SPAN_METRIC = 'image_span_seconds'
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value, count=1):
+        self.counts[bisect.bisect_left(self.buckets, value)] += count
+        self.sum += value * count
+        self.count += count
+
+    def quantile(self, fraction):
+        # Upper bound of the bucket the quantile falls in, like histogram_quantile without interpolation.
+        # None when there is nothing yet or it lies beyond the last bucket, which has no upper bound.
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+
+class Metrics:
+    # One per process.  enabled=False turns every call into a no-op.
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.spans = {span: Histogram() for span in SPANS}
+        self.counters = {}   # (name, label value) -> count
+        self.readings = {}   # name -> (help, function returning the current value, 'gauge' or 'counter')
+
+    def observe(self, span, seconds, count=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.spans[span].observe(seconds, count)
+
+    def observeSpans(self, timings, count=1):
+        # timings: {span: seconds} as measured by a worker, for count images
+        if not self.enabled or not timings:
+            return
+        with self.lock:
+            for span, seconds in timings.items():
+                self.spans[span].observe(seconds / count, count)
+
+    def inc(self, name, label=None, amount=1):
+        if not self.enabled:
+            return
+        key = (name, label)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge(self, name, help, function):
+        self.readings[name] = (help, function, 'gauge')
+
+    def counter(self, name, help, function):
+        # A count that only goes up but is kept elsewhere, e.g. by the result cache
+        self.readings[name] = (help, function, 'counter')
+
+    def readingValues(self, kind):
+        values = {}
+        for name, (_, function, reading_kind) in self.readings.items():
+            if reading_kind != kind:
+                continue
+            try:
+                values[name] = function()
+            except Exception as e:
+                print(f"Metrics {kind} {name} error: {e}")
+        return values
+
+    def snapshot(self):
+        # Plain data for the JSON endpoint and the admin page
+        with self.lock:
+            spans = {span: {'count': histogram.count, 'sum': histogram.sum,
+                            'mean': histogram.sum / histogram.count if histogram.count else None,
+                            'p50': histogram.quantile(0.5), 'p95': histogram.quantile(0.95),
+                            'p99': histogram.quantile(0.99), 'help': SPANS[span]}
+                     for span, histogram in self.spans.items()}
+            counters = {}
+            for (name, label), count in self.counters.items():
+                counters.setdefault(name, {})[label or ''] = count
+        for name, count in self.readingValues('counter').items():
+            counters[name] = {'': count}
+        return {'enabled': self.enabled, 'spans': spans, 'counters': counters, 'gauges': self.readingValues('gauge')}
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = [f'# HELP {SPAN_METRIC} Time spent per image in each stage of the pipeline',
+                 f'# TYPE {SPAN_METRIC} histogram']
+        with self.lock:
+            for span, histogram in self.spans.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{SPAN_METRIC}_bucket{{span="{span}",le="{bound}"}} {cumulative}')
+                lines.append(f'{SPAN_METRIC}_sum{{span="{span}"}} {histogram.sum}')
+                lines.append(f'{SPAN_METRIC}_count{{span="{span}"}} {histogram.count}')
+            counters = sorted(self.counters.items(), key=lambda item: (item[0][0], item[0][1] or ''))
+        typed = set()
+        for (name, label), count in counters:
+            if name not in typed:
+                lines.append(f'# TYPE {name} counter')
+                typed.add(name)
+            lines.append(f'{name}{{outcome="{label}"}} {count}' if label else f'{name} {count}')
+        for kind in ('counter', 'gauge'):
+            for name, value in self.readingValues(kind).items():
+                lines.append(f'# HELP {name} {self.readings[name][0]}')
+                lines.append(f'# TYPE {name} {kind}')
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def startExporter(metrics, port, host='0.0.0.0'):
+    # /metrics for Prometheus, /metrics.json for the Flask admin page
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, content_type = metrics.render().encode(), 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body, content_type = json.dumps(metrics.snapshot()).encode(), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scraped every few seconds, not worth a line each time
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-exporter', daemon=True).start()
+    print(f"Metrics on http://{host}:{port}/metrics")
+    return server
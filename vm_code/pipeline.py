@@ -0,0 +1,86 @@
+import cv2
+
+from wire_protocol import OP_EDGES, OP_BLUR, OP_GRAYSCALE, OP_INVERT, OP_PIPELINE, PipelineStep, ProtocolError
+
+# Multi-step operation pipelines, run on the worker in one pass over an
+# in-memory ndarray.  planPipeline drops steps that cannot change the
+# result, runPipeline reuses the intermediate buffers between steps.
+
+KNOWN_OPERATIONS = (OP_EDGES, OP_BLUR, OP_GRAYSCALE, OP_INVERT)
+
+
+def checkStep(step):
+    # Parameters no worker could run, whichever rank gets them
+    if step.operation not in KNOWN_OPERATIONS:
+        raise ProtocolError(f"Unknown operation code: {step.operation}")
+    if step.operation == OP_BLUR and (step.ksize < 1 or step.ksize % 2 == 0):
+        raise ProtocolError(f"Blur kernel size must be odd, got {step.ksize}")
+
+
+def checkTask(operation, params):
+    # Same check for a task as it reaches a worker, params as built by ingest_server.taskParams
+    if operation == OP_PIPELINE:
+        for step in params['steps']:
+            checkStep(step)
+    else:
+        checkStep(PipelineStep(operation, *(params[name] for name in ('ksize', 'threshold1', 'threshold2')
+                                            if name in params)))
+
+
+def planPipeline(steps):
+    # Only rewrites that give bit-identical output
+    planned = []
+    gray = False  # Whether the image is single channel at this point
+    for step in steps:
+        step = PipelineStep(*step)
+        checkStep(step)
+        if step.operation == OP_GRAYSCALE and gray:
+            continue  # Already single channel
+        if step.operation == OP_EDGES and planned and planned[-1].operation == OP_GRAYSCALE:
+            planned.pop()  # Edge detection converts to gray itself
+        if step.operation == OP_INVERT and planned and planned[-1].operation == OP_INVERT:
+            planned.pop()  # Two inversions cancel out
+            continue
+        gray = gray or step.operation in (OP_EDGES, OP_GRAYSCALE)
+        planned.append(step)
+    return planned
+
+
+def toGray(image, dst=None):
+    if image.ndim == 2:
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=dst)
+
+
+def runPipeline(image, steps, owned=False):
+    # owned: the caller lets us overwrite image, e.g. a pooled receive buffer
+    current = image
+    spare = None  # Same shape buffer the next blur can write into
+    writable = owned
+    for step in steps:
+        if step.operation == OP_GRAYSCALE:
+            current, spare, writable = toGray(current), None, True
+        elif step.operation == OP_INVERT:
+            if writable:
+                cv2.bitwise_not(current, dst=current)
+            else:
+                current, writable = cv2.bitwise_not(current), True
+        elif step.operation == OP_BLUR:
+            if spare is not None and (spare.shape != current.shape or spare.dtype != current.dtype):
+                spare = None
+            blurred = cv2.GaussianBlur(current, (step.ksize, step.ksize), 0, dst=spare)
+            # Ping-pong: the old buffer becomes the target of the next blur
+            spare = current if writable else None
+            current, writable = blurred, True
+        elif step.operation == OP_EDGES:
+            if current.ndim == 2:
+                gray, gray_writable = current, writable
+            else:
+                gray, gray_writable = toGray(current), True
+            target = spare if spare is not None and spare.shape == gray.shape and spare.dtype == gray.dtype else None
+            current = cv2.Canny(gray, step.threshold1, step.threshold2, edges=target)
+            spare = gray if gray_writable else None
+            writable = True
+    if current is image and not owned:
+        current = current.copy()
+    return current
@@ -0,0 +1,158 @@
+import hashlib
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+# Content addressed cache of encoded results.  The key is a hash of the
+# uploaded (still encoded) bytes plus the operation, the parameters it
+# actually uses and the output encoding, so re-submitting the same image and operation never has to
+# reach the cluster.  Two tiers: an LRU in memory bounded by bytes, and an
+# optional directory on disk that memory evictions are demoted to.
+
+# Which parameters change the output of each operation
+OPERATION_PARAMS = {
+    1: ('threshold1', 'threshold2'),
+    2: ('ksize',),
+    3: (),
+    4: (),
+}
+
+
+def cacheKey(payload, operation, params, output=(0, 0), target_size=None):
+    digest = hashlib.blake2b(payload, digest_size=20)
+    digest.update(struct.pack('!BBB', operation, *output))
+    if target_size is not None:
+        digest.update(struct.pack('!HH', *target_size))
+    for name in OPERATION_PARAMS.get(operation, sorted(params)):
+        digest.update(f"{name}={params.get(name)};".encode('utf-8'))
+    return digest.hexdigest()
+
+
+class DiskTier:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self.loadIndex()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def loadIndex(self):
+        # Oldest first, so a restart keeps the previous LRU order roughly intact
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                stat = os.stat(os.path.join(root, name))
+                found.append((stat.st_mtime, name, stat.st_size))
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.total_bytes += size
+        self.evict()
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        try:
+            with open(self.path(key), 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            self.total_bytes -= self.entries.pop(key)
+            return None
+        self.entries.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        if key in self.entries or len(data) > self.max_bytes:
+            return
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary, 'wb') as file:
+            file.write(data)
+        os.replace(temporary, path)
+        self.entries[key] = len(data)
+        self.total_bytes += len(data)
+        self.evict()
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+
+class ResultCache:
+    def __init__(self, max_memory_bytes=256 * 1024 * 1024, disk_directory=None, max_disk_bytes=2 * 1024 ** 3):
+        self.max_memory_bytes = max_memory_bytes
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.disk = DiskTier(disk_directory, max_disk_bytes) if disk_directory else None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.memory_evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return data
+            data = self.disk.get(key) if self.disk else None
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self.storeInMemory(key, data)
+            return data
+
+    def put(self, key, data):
+        with self.lock:
+            if key not in self.memory:
+                self.storeInMemory(key, bytes(data))
+
+    def storeInMemory(self, key, data):
+        if len(data) > self.max_memory_bytes:
+            if self.disk:
+                self.disk.put(key, data)
+            return
+        self.memory[key] = data
+        self.memory_bytes += len(data)
+        while self.memory_bytes > self.max_memory_bytes:
+            old_key, old_data = self.memory.popitem(last=False)
+            self.memory_bytes -= len(old_data)
+            self.memory_evictions += 1
+            if self.disk:
+                self.disk.put(old_key, old_data)
+
+    def stats(self):
+        with self.lock:
+            stats = {
+                'hits': self.hits,
+                'misses': self.misses,
+                'memory_entries': len(self.memory),
+                'memory_bytes': self.memory_bytes,
+                'memory_evictions': self.memory_evictions,
+            }
+            if self.disk:
+                stats.update({
+                    'disk_hits': self.disk_hits,
+                    'disk_entries': len(self.disk.entries),
+                    'disk_bytes': self.disk.total_bytes,
+                    'disk_evictions': self.disk.evictions,
+                })
+            return stats
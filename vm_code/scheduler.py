@@ -0,0 +1,200 @@
+import heapq
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+
+from wire_protocol import FLAG_BULK, FLAG_INTERACTIVE, OP_BLUR, OP_EDGES, OP_GRAYSCALE, OP_INVERT, OP_PIPELINE
+
+# Fair share scheduling of tasks between clients, in place of one FIFO
+# queue.  Every client gets a queue per priority class and the next task is
+# picked by start-time fair queuing: each task is stamped with a virtual
+# start and finish time, finish = start + cost / weight, and the queue whose
+# head has the lowest start goes next.  A client sending ten thousand
+# images therefore only gets its share, a cheap request from anyone else is
+# served next, and interactive queues get INTERACTIVE_WEIGHT times the share
+# of bulk ones.  Tasks with a deadline that is about to pass jump the line;
+# those already past it are failed instead of processed.
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_BULK: 'bulk'}
+INTERACTIVE_WEIGHT = 8
+# Without an explicit class, a client with this many images already waiting counts as bulk
+AUTO_BULK_THRESHOLD = 8
+# A task whose deadline is this close is served before anything else
+URGENT_SECONDS = 0.05
+# Relative cost per pixel, so a large blur is charged more than an inversion of a thumbnail
+OPERATION_COST = {OP_EDGES: 4.0, OP_BLUR: 3.0, OP_GRAYSCALE: 1.0, OP_INVERT: 1.0}
+# An encoded image is roughly this many times bigger once decoded
+ENCODED_EXPANSION = 10
+
+
+def priorityFromFlags(flags):
+    # Priority class asked for on an image frame, None if the client left it to us
+    if flags & FLAG_INTERACTIVE:
+        return PRIORITY_INTERACTIVE
+    if flags & FLAG_BULK:
+        return PRIORITY_BULK
+    return None
+
+
+def taskCost(task):
+    pixels = task.image.nbytes * (ENCODED_EXPANSION if task.encoded else 1) / 3
+    if task.operation == OP_PIPELINE:
+        factor = sum(OPERATION_COST.get(step.operation, 1.0) for step in task.params['steps'])
+    else:
+        factor = OPERATION_COST.get(task.operation, 1.0)
+    return max(pixels, 1.0) * factor / 1e6
+
+
+class Flow:
+    # One client's queue for one priority class
+    def __init__(self, key, weight):
+        self.key = key
+        self.weight = weight
+        self.tasks = deque()   # (start tag, task)
+        self.last_finish = 0.0
+
+
+class FairScheduler:
+    # Same calls as the queue.Queue it replaces: put_nowait, get_nowait, get and qsize.
+    # Tasks carry client, priority (None picks the class automatically) and deadline (monotonic, or None).
+    def __init__(self, interactive_weight=INTERACTIVE_WEIGHT, auto_bulk_threshold=AUTO_BULK_THRESHOLD):
+        self.weights = {PRIORITY_INTERACTIVE: interactive_weight, PRIORITY_BULK: 1}
+        self.auto_bulk_threshold = auto_bulk_threshold
+        self.client_weights = {}
+        self.flows = {}
+        self.ready = []        # (head start tag, sequence, flow), one entry per non-empty flow
+        self.deadlines = []    # (deadline, sequence, task)
+        self.waiting = {}      # client -> tasks queued
+        self.sequence = itertools.count()
+        self.virtual_time = 0.0
+        self.size = 0
+        self.expired = 0
+        self.served = {PRIORITY_INTERACTIVE: 0, PRIORITY_BULK: 0}
+        self.changed = threading.Condition()
+
+    def setWeight(self, client, weight):
+        # Share of a client relative to the default of 1
+        with self.changed:
+            self.client_weights[client] = weight
+
+    def priorityOf(self, task):
+        if task.priority is not None:
+            return task.priority
+        waiting = self.waiting.get(task.client, 0)
+        return PRIORITY_BULK if waiting >= self.auto_bulk_threshold else PRIORITY_INTERACTIVE
+
+    def put_nowait(self, task):
+        with self.changed:
+            priority = self.priorityOf(task)
+            task.priority_class = priority
+            key = (task.client, priority)
+            flow = self.flows.get(key)
+            if flow is None:
+                flow = self.flows[key] = Flow(key, self.weights[priority] * self.client_weights.get(task.client, 1))
+            # A queue that sat idle starts from now, it does not get credit for the time it was empty
+            start = max(self.virtual_time, flow.last_finish)
+            flow.last_finish = start + taskCost(task) / flow.weight
+            if not flow.tasks:
+                heapq.heappush(self.ready, (start, next(self.sequence), flow))
+            flow.tasks.append((start, task))
+            if task.deadline is not None:
+                heapq.heappush(self.deadlines, (task.deadline, next(self.sequence), task))
+            task.scheduled = False
+            self.waiting[task.client] = self.waiting.get(task.client, 0) + 1
+            self.size += 1
+            self.changed.notify()
+
+    def put(self, task, block=True, timeout=None):
+        self.put_nowait(task)
+
+    def takeUrgent(self, now):
+        while self.deadlines:
+            deadline, _, task = self.deadlines[0]
+            if task.scheduled:
+                heapq.heappop(self.deadlines)
+                continue
+            if deadline - now > URGENT_SECONDS:
+                return None
+            heapq.heappop(self.deadlines)
+            return task
+        return None
+
+    def takeFair(self):
+        while self.ready:
+            _, _, flow = heapq.heappop(self.ready)
+            while flow.tasks and flow.tasks[0][1].scheduled:
+                flow.tasks.popleft()  # Already served ahead of its turn
+            if not flow.tasks:
+                # Emptied by urgent or expired tasks, forgotten like any other idle queue
+                del self.flows[flow.key]
+                continue
+            start, task = flow.tasks.popleft()
+            self.virtual_time = max(self.virtual_time, start)
+            while flow.tasks and flow.tasks[0][1].scheduled:
+                flow.tasks.popleft()
+            if flow.tasks:
+                heapq.heappush(self.ready, (flow.tasks[0][0], next(self.sequence), flow))
+            else:
+                # Idle queues are forgotten, a client coming back starts at the current virtual time
+                del self.flows[flow.key]
+            return task
+        return None
+
+    def take(self, expired):
+        # The next task to run; those whose deadline has passed on the way go to expired
+        now = time.monotonic()
+        while self.size:
+            task = self.takeUrgent(now) or self.takeFair()
+            if task is None:
+                break
+            task.scheduled = True
+            self.size -= 1
+            waiting = self.waiting[task.client] - 1
+            if waiting:
+                self.waiting[task.client] = waiting
+            else:
+                del self.waiting[task.client]
+            if task.deadline is not None and task.deadline < now:
+                self.expired += 1
+                expired.append(task)
+                continue
+            self.served[task.priority_class] += 1
+            return task
+        if not self.size:
+            # Whatever is left are tasks already served out of turn; drop them rather than the images they hold
+            self.flows.clear()
+            self.ready.clear()
+            self.deadlines.clear()
+        return None
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def get(self, block=True, timeout=None):
+        expired = []
+        with self.changed:
+            if block:
+                self.changed.wait_for(lambda: self.size, timeout)
+            task = self.take(expired)
+        for late in expired:
+            late.complete(error="Deadline passed before the image could be processed")
+        if task is None:
+            raise queue.Empty
+        return task
+
+    def qsize(self):
+        return self.size
+
+    def stats(self):
+        with self.changed:
+            return {
+                'queued': self.size,
+                'clients': len(self.waiting),
+                'served_interactive': self.served[PRIORITY_INTERACTIVE],
+                'served_bulk': self.served[PRIORITY_BULK],
+                'expired': self.expired,
+            }
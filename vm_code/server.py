@@ -1,230 +1,197 @@
-import threading
-import queue
+import multiprocessing
+import mpi4py
+if multiprocessing.current_process().name != 'MainProcess':
+    # A pool process of the local process engine re-imports this module as
+    # __mp_main__ before it knows its parent; it only runs images and must not
+    # start an MPI runtime of its own, which under mpirun would try to join the job
+    mpi4py.rc.initialize = False
+    mpi4py.rc.finalize = False
 from mpi4py import MPI  # MPI for distributed computing
-import io  
-import os
-import socket
-import cv2
-import numpy as np
-from PIL import Image
-import boto3
-import time
+import argparse
+import signal
+import sys
+from ingest_server import IngestServer, boundedTaskQueue
+from scheduler import FairScheduler, INTERACTIVE_WEIGHT
+from dispatcher import Dispatcher, DEFAULT_MAX_ATTEMPTS, DEFAULT_TASK_TIMEOUT
+from cluster_controller import ClusterController, EC2Provider, FakeProvider
+from batching import Batcher, DEFAULT_BATCH_SIZE
+from result_cache import ResultCache
+from metrics import Metrics, startExporter
+from staging import StagingArea
+from engines import ENGINES, LocalEngine, chooseEngine, createBackend
+from worker import worker_main
 
 # Constants
-BUFFER_SIZE = 4096
-
-class ImageWorker(threading.Thread):
-    def __init__(self, comm, task_queue):
-        super().__init__()
-        self.task_queue = task_queue
-        self.comm = comm
-
-    def run(self):
-        while True:
-            try:
-                task = self.task_queue.get()
-                if task is None:  # Termination signal
-                    break
-                image, operation_code = task
-                result = self.perform_operation(image, operation_code)
-                print(f"Worker {self.comm.Get_rank()} processed the image")
-                self.comm.send(result, dest=0)
-            except Exception as e:
-                print(f"Error in worker {self.comm.Get_rank()}: {e}")
-                continue
-
-    def perform_operation(self, image, operation_code):
-        try:
-            if operation_code == 1:
-                return self.edgeDetection(image)
-            elif operation_code == 2:
-                return self.imageBlur(image)
-            elif operation_code == 3:
-                return self.convertToGrayscale(image)
-            elif operation_code == 4:
-                return self.colorInversion(image)
-            else:
-                raise ValueError(f"Unknown operation code: {operation_code}")
-        except Exception as e:
-            print(f"Error during image processing: {e}")
-            return None
-        
-    def imageBlur(self, img, ksize=(5, 5)):
-        try:
-            blurred_image = cv2.GaussianBlur(img, ksize, 0)
-            return Image.fromarray(blurred_image)
-        except Exception as e:
-            print(f"Blurring error: {e}")
-            return None
-
-    def edgeDetection(self, img, threshold1=90, threshold2=180):
-        try:
-            gray_image = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            edges = cv2.Canny(gray_image, threshold1, threshold2)
-            return Image.fromarray(edges)
-        except Exception as e:
-            print(f"Edge detection error: {e}")
-            return None
-        
-    def colorInversion(self, img):
-        try:
-            inverted_image = cv2.bitwise_not(img)
-            return Image.fromarray(inverted_image)
-        except Exception as e:
-            print(f"Color inversion error: {e}")
-            return None
-
-    def convertToGrayscale(self, img):
-        try:
-            gray_image = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            return Image.fromarray(gray_image)
-        except Exception as e:
-            print(f"Grayscale conversion error: {e}")
-            return None
-
-
-def handle_client(client_socket, task_queue):
-    try:
-        recv_data = client_socket.recv(BUFFER_SIZE)
-        file_stream = io.BytesIO(recv_data)
-       
-        while b'###%Image_End%' not in recv_data:
-            recv_data = client_socket.recv(BUFFER_SIZE)
-            file_stream.write(recv_data)
-            if b"###%Image_Sent%" in recv_data:
-                task_data = recv_data.split(b"###")
-                if task_data[0]:
-                    file_stream.write(task_data[0])
-                client_socket.send(b"File received")
-                operation = client_socket.recv(BUFFER_SIZE)
-                image_data = np.frombuffer(file_stream.getvalue(), dtype=np.uint8)
-                image = cv2.imdecode(image_data, cv2.IMREAD_COLOR)
-                task_queue.put((image, int(operation)))
-                file_stream = io.BytesIO()
-               
-        task_queue.put(None)  # Signal completion
-    except Exception as e:
-        print(f"Client handling error: {e}")
-
-def main():
+HEALTH_CHECK_INTERVAL = 30  # Seconds between batched instance health queries
+FAKE_BOOT_SECONDS = 5  # How long a --provider fake instance takes to come up
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description="Distributed image processing server")
+    parser.add_argument('--port', type=int, default=55552,
+                        help="TCP port clients connect to")
+    parser.add_argument('--engine', choices=('auto',) + ENGINES, default='auto',
+                        help="what runs the images: MPI worker ranks, a local process pool or local threads "
+                             "(auto: MPI under mpirun with more than one rank, processes otherwise)")
+    parser.add_argument('--local-workers', type=int, default=None,
+                        help="processes or threads of the local engines (default: one per available core)")
+    parser.add_argument('--decode-on-worker', action='store_true',
+                        help="ship the encoded image bytes and decode on the worker instead of rank 0")
+    parser.add_argument('--worker-threads', type=int, default=None,
+                        help="image threads per worker rank (default: one per available core)")
+    parser.add_argument('--tile-megapixels', type=float, default=0,
+                        help="split images of at least this many megapixels into stripes across ranks (0 disables)")
+    parser.add_argument('--cache-mb', type=int, default=256,
+                        help="in-memory result cache size in megabytes (0 disables the cache)")
+    parser.add_argument('--cache-dir', default=None,
+                        help="directory for the on-disk result cache tier (default: memory only)")
+    parser.add_argument('--cache-disk-mb', type=int, default=2048,
+                        help="on-disk result cache size in megabytes")
+    parser.add_argument('--batch-image-kb', type=int, default=64,
+                        help="send images of at most this many kilobytes to workers in batches (0 disables)")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="most images per batch")
+    parser.add_argument('--batch-wait-ms', type=float, default=2,
+                        help="longest a small image waits for its batch to fill up")
+    parser.add_argument('--task-timeout', type=float, default=DEFAULT_TASK_TIMEOUT,
+                        help="seconds a worker gets for an image before it goes to another worker")
+    parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help="times an image is sent to a worker before its error is returned")
+    parser.add_argument('--metrics-port', type=int, default=9100,
+                        help="port of the Prometheus /metrics endpoint (0 disables it)")
+    parser.add_argument('--no-metrics', action='store_true',
+                        help="do not record timing spans and counters at all")
+    parser.add_argument('--stage-memory-mb', type=int, default=1024,
+                        help="memory for images waiting on rank 0, the rest is spilled to memory-mapped files")
+    parser.add_argument('--stage-dir', default=None,
+                        help="where spill files go (default: the system temp directory); must be on a local disk")
+    parser.add_argument('--scheduler', choices=['fair', 'fifo'], default='fair',
+                        help="order images are sent to workers in: fair share between clients, or arrival order")
+    parser.add_argument('--interactive-weight', type=float, default=INTERACTIVE_WEIGHT,
+                        help="share of the cluster an interactive client gets relative to a bulk one")
+    parser.add_argument('--fair-share-by', choices=['connection', 'host'], default='connection',
+                        help="what counts as one client for the fair share")
+    parser.add_argument('--provider', choices=['none', 'ec2', 'fake'], default='none',
+                        help="where worker instances are health checked and scaled (none: use every rank as is)")
+    parser.add_argument('--min-instances', type=int, default=0,
+                        help="instances the autoscaler keeps running")
+    parser.add_argument('--max-instances', type=int, default=8,
+                        help="instances the autoscaler never goes beyond")
+    parser.add_argument('--queue-per-worker', type=int, default=8,
+                        help="scale out when more images than this wait per healthy worker rank")
+    parser.add_argument('--latency-slo-ms', type=float, default=2000,
+                        help="scale out when the 95th percentile image latency goes above this")
+    parser.add_argument('--scale-cooldown', type=float, default=60,
+                        help="seconds between two scaling decisions")
+    parser.add_argument('--health-ttl', type=float, default=HEALTH_CHECK_INTERVAL,
+                        help="seconds instance health is cached for")
+    return parser.parse_args()
+
+def main(default_engine='auto'):
+    args = parseArguments()
     comm = MPI.COMM_WORLD
     rank = comm.Get_rank()
     hostname = MPI.Get_processor_name()
     print(f"Rank: {rank}, Hostname: {hostname}")
+    if args.engine == 'auto':
+        args.engine = default_engine
+    args.engine = chooseEngine(args.engine, comm.Get_size())
 
     try:
         if rank == 0:
-            server_main(comm)
+            server_main(comm, args)
+        elif args.engine == 'mpi':
+            worker_main(comm, args.worker_threads)
         else:
-            worker_main(comm)
+            print(f"Rank {rank} has nothing to do with --engine {args.engine}")
     except Exception as e:
         print(f"Main error: {e}")
 
-def server_main(comm):
-    task_queue = queue.Queue()
-    processed_images = []
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind(('0.0.0.0', 55552))
-    server_socket.listen()
-    print("Server is waiting for connections...")
-
-    while True:
-        try:
-            client_socket, _ = server_socket.accept()
-            print(f"Client {client_socket.getpeername()} connected.")
-            threading.Thread(target=handle_client, args=(client_socket, task_queue)).start()
-           
-            num_workers = comm.Get_size()
-            healthy_workers = [i for i in range(1, num_workers) if checkInstanceHealth(i)]
-            if not healthy_workers:
-                createNewInstance()
-                num_workers = comm.Get_size()
-                healthy_workers = [i for i in range(1, num_workers) if checkInstanceHealth(i)]
-
-            while not task_queue.empty():
-                for worker in healthy_workers:
-                    task = task_queue.get()
-                    if task is None:
-                        break
-                    comm.send(task, dest=worker)
-                    print(f"Task sent to worker {worker}")
-
-            for worker in healthy_workers:
-                image = comm.recv(source=worker)
-                processed_images.append(image)
-                image.save(f'processed_image_{worker}.jpeg', format='JPEG')
-                print(f"Processed image from worker {worker} saved.")
-
-            sendProcessedImages(client_socket, processed_images)
-        except Exception as e:
-            print(f"Server main loop error: {e}")
-
-def worker_main(comm):
-    try:
-        while True:
-            task = comm.recv(source=0)
-            if task is None:
-                break
-            processor = ImageWorker(comm, task)
-            processor.start()
-            processor.join()
-    except Exception as e:
-        print(f"Worker error: {e}")
-
-def sendProcessedImages(client_socket, images):
+def server_main(comm, args):
+    if args.scheduler == 'fair':
+        task_queue = FairScheduler(interactive_weight=args.interactive_weight)
+    else:
+        task_queue = boundedTaskQueue()
+    cache = None
+    if args.cache_mb > 0:
+        cache = ResultCache(args.cache_mb * 1024 * 1024, args.cache_dir, args.cache_disk_mb * 1024 * 1024)
+    metrics = Metrics(enabled=not args.no_metrics)
+    staging = StagingArea(args.stage_memory_mb * 1024 * 1024, args.stage_dir)
+    ingest = IngestServer(task_queue, port=args.port, decode_on_worker=args.decode_on_worker, cache=cache,
+                          metrics=metrics, fair_share_by=args.fair_share_by, staging=staging)
+    ingest.start()
+    controller = createController(args)
+    engine = createEngine(comm, args, task_queue, metrics, controller)
+    registerGauges(metrics, engine, cache, task_queue, staging)
+    if args.metrics_port:
+        startExporter(metrics, args.metrics_port)
+    if controller is not None:
+        controller.load = engine.loadReport
+        controller.retire_rank = engine.retireRank
+        controller.start()
+    # mpirun passes SIGTERM on to every rank; unwind so spill files are removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     try:
-        for idx, img in enumerate(images):
-            with open(f'processed_image_{idx}.jpeg', 'rb') as file:
-                file_data = file.read(BUFFER_SIZE)
-                while file_data:
-                    client_socket.send(file_data)
-                    file_data = file.read(BUFFER_SIZE)
-                client_socket.send(b"###%Image_Sent%")
-                if client_socket.recv(BUFFER_SIZE) == b"I got the file":
-                    print(f"Processed image {idx + 1} sent back to client.")
-    except Exception as e:
-        print(f"Error sending processed images: {e}")
-
-def createNewInstance():
-    ec2 = boto3.resource('ec2')
-    instance = ec2.create_instances(
-        ImageId='ami-0abcdef1234567890',  # Here we're passing our AMI ID
-        InstanceType='t2.micro',  # Here we're passing our desired instance type (t2.micro as it's the free tier eligible)
-        MinCount=1,
-        MaxCount=1,
-        KeyName='my-key-pair',  # Here we're passing our key-pair name
-        SecurityGroupIds=['sg-0abcdef1234567890'],  # Here we're passing our security group ID
-        SubnetId='subnet-0abcdef1234567890',  # Here we're passing our subnet ID
-        TagSpecifications=[
-            {
-                'ResourceType': 'instance',
-                'Tags': [
-                    {
-                        'Key': 'Name',
-                        'Value': 'MPI-Worker'
-                    },
-                ]
-            },
-        ],
-    )
-    instance_id = instance[0].id
-    print(f'Created EC2 instance with ID: {instance_id}')
-   
-    # Wait until the instance is running
-    instance[0].wait_until_running()
-    instance[0].reload()
-    print(f'Instance {instance_id} is running')
-
-def checkInstanceHealth(instance_id):
-    ec2 = boto3.client('ec2')
-    response = ec2.describe_instance_status(InstanceIds=[instance_id])
-    instance_statuses = response.get('InstanceStatuses', [])
-    if not instance_statuses:
-        return False
-    instance_status = instance_statuses[0]
-    return (instance_status['InstanceState']['Name'] == 'running' and
-            instance_status['InstanceStatus']['Status'] == 'ok' and
-            instance_status['SystemStatus']['Status'] == 'ok')
+        engine.run()
+    finally:
+        if controller is not None:
+            controller.stop()
+        engine.printUtilization()
+        staging.close()
+
+def createEngine(comm, args, task_queue, metrics, controller):
+    # Same task queue and the same calls afterwards, whichever engine runs the images
+    if args.engine != 'mpi':
+        return LocalEngine(task_queue, createBackend(args.engine, args.local_workers), metrics)
+    batcher = None
+    if args.batch_image_kb > 0 and args.batch_size > 1:
+        batcher = Batcher(args.batch_image_kb * 1024, args.batch_size, args.batch_wait_ms / 1000)
+    return Dispatcher(comm, task_queue,
+                      health_check=controller.healthyRanks if controller else None,
+                      on_ready=controller.registerRank if controller else None,
+                      on_stopped=controller.rankStopped if controller else None,
+                      tile_min_pixels=int(args.tile_megapixels * 1_000_000), batcher=batcher,
+                      task_timeout=args.task_timeout, max_attempts=args.max_attempts, metrics=metrics)
+
+def registerGauges(metrics, engine, cache, task_queue, staging):
+    metrics.gauge('image_tasks_queued', "images on rank 0 waiting for a worker", engine.queued)
+    metrics.gauge('image_tasks_inflight', "tasks and batches sent to workers and not answered yet",
+                  engine.inflight)
+    metrics.gauge('worker_ranks', "worker ranks that have reported ready, or local workers", engine.workerCount)
+    metrics.gauge('worker_ranks_quarantined', "worker ranks currently quarantined", engine.quarantinedCount)
+    if cache is not None:
+        for name, help in (('hits', "lookups answered from the result cache"),
+                           ('misses', "lookups the result cache could not answer"),
+                           ('memory_evictions', "results evicted from the in-memory result cache")):
+            metrics.counter(f'result_cache_{name}_total', help, lambda name=name: cache.stats()[name])
+        if cache.disk is not None:
+            metrics.counter('result_cache_disk_evictions_total', "results evicted from the on-disk result cache",
+                            lambda: cache.stats()['disk_evictions'])
+        metrics.gauge('result_cache_memory_bytes', "bytes held in the in-memory result cache",
+                      lambda: cache.stats()['memory_bytes'])
+    for name, help in (('memory_bytes', "bytes of waiting images held in memory on rank 0"),
+                       ('spilled_bytes', "bytes of waiting images spilled to memory-mapped files"),
+                       ('spilled_files', "spill files currently on disk")):
+        metrics.gauge(f'staging_{name}', help, lambda name=name: staging.stats()[name])
+    metrics.counter('staging_spills_total', "images spilled to disk", lambda: staging.stats()['spills'])
+    if isinstance(task_queue, FairScheduler):
+        metrics.gauge('scheduler_clients', "clients with images waiting in the scheduler",
+                      lambda: task_queue.stats()['clients'])
+        for name, help in (('served_interactive', "images scheduled from interactive queues"),
+                           ('served_bulk', "images scheduled from bulk queues"),
+                           ('expired', "images failed because their deadline passed while queued")):
+            metrics.counter(f'scheduler_{name}_total', help, lambda name=name: task_queue.stats()[name])
+
+def createController(args):
+    # Health checks and scaling run on their own thread, never in the accept or dispatch loop
+    if args.provider == 'none':
+        return None
+    if args.engine != 'mpi':
+        print(f"--provider {args.provider} needs --engine mpi, autoscaling is off")
+        return None
+    provider = EC2Provider() if args.provider == 'ec2' else FakeProvider(boot_seconds=FAKE_BOOT_SECONDS)
+    return ClusterController(provider, min_instances=args.min_instances, max_instances=args.max_instances,
+                             health_ttl=args.health_ttl, queue_per_worker=args.queue_per_worker,
+                             latency_slo=args.latency_slo_ms / 1000, cooldown=args.scale_cooldown)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,112 @@
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+
+import numpy as np
+
+# Bounded staging of images on rank 0 between ingest and the workers.  Up to
+# the memory budget images stay ordinary arrays; past it they are written to
+# a spill file and kept only as a read-only np.memmap, which costs no memory
+# until its pages are read.  A worker on the same node maps the file itself,
+# one on another node gets the bytes read with pread-like np.fromfile, so
+# rank 0 never keeps mapped pages around either way.
+
+DEFAULT_MEMORY_BUDGET = 1024 * 1024 * 1024
+SPILL_SUFFIX = '.raw'
+
+# Spill file -> address its mapping starts at on rank 0, for locating views into it
+_spill_files = {}
+_spill_lock = threading.Lock()
+
+
+def spillLocation(array):
+    # (path, offset) of a contiguous array that lives in a spill file, None for one in memory
+    if not isinstance(array, np.memmap) or not array.flags.c_contiguous:
+        return None
+    with _spill_lock:
+        start = _spill_files.get(array.filename)
+    if start is None:
+        return None
+    return array.filename, array.ctypes.data - start
+
+
+def inMemory(array):
+    # The array itself, or its bytes read from the spill file without mapping them in
+    location = spillLocation(array)
+    if location is None:
+        return np.ascontiguousarray(array)
+    path, offset = location
+    return np.fromfile(path, dtype=array.dtype, count=array.size, offset=offset).reshape(array.shape)
+
+
+def mapSpilled(path, offset, shape, dtype):
+    # Worker side of a spilled task on the same node
+    return np.memmap(path, dtype=np.dtype(dtype), mode='r', offset=offset, shape=tuple(shape))
+
+
+class StagingArea:
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET, directory=None):
+        self.memory_budget = memory_budget
+        self.directory = tempfile.mkdtemp(prefix='image-staging-', dir=directory)
+        self.lock = threading.Lock()
+        self.memory_bytes = 0
+        self.spilled_bytes = 0
+        self.spilled_files = 0
+        self.spills = 0
+
+    def stage(self, image):
+        # Called from the ingest codec threads; returns what the task should hold on to.
+        # Either way the bytes are accounted for until the last reference to them is gone.
+        nbytes = image.nbytes
+        with self.lock:
+            fits = self.memory_bytes + nbytes <= self.memory_budget
+            if fits:
+                self.memory_bytes += nbytes
+        if fits:
+            weakref.finalize(image, self.released, nbytes)
+            return image
+        return self.spill(image)
+
+    def spill(self, image):
+        fd, path = tempfile.mkstemp(suffix=SPILL_SUFFIX, dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                np.ascontiguousarray(image).tofile(file)
+            mapped = np.memmap(path, dtype=image.dtype, mode='r', shape=image.shape)
+        except BaseException:
+            os.unlink(path)
+            raise
+        with _spill_lock:
+            _spill_files[path] = mapped.ctypes.data
+        with self.lock:
+            self.spilled_bytes += image.nbytes
+            self.spilled_files += 1
+            self.spills += 1
+        weakref.finalize(mapped, self.removed, path, image.nbytes)
+        return mapped
+
+    def released(self, nbytes):
+        with self.lock:
+            self.memory_bytes -= nbytes
+
+    def removed(self, path, nbytes):
+        # The task is answered and every view is gone, a worker still reading keeps its own mapping
+        with _spill_lock:
+            _spill_files.pop(path, None)
+        try:
+            os.unlink(path)
+        except OSError as e:
+            print(f"Staging cleanup error: {e}")
+        with self.lock:
+            self.spilled_bytes -= nbytes
+            self.spilled_files -= 1
+
+    def stats(self):
+        with self.lock:
+            return {'memory_bytes': self.memory_bytes, 'spilled_bytes': self.spilled_bytes,
+                    'spilled_files': self.spilled_files, 'spills': self.spills}
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,54 @@
+import itertools
+import time
+
+_task_ids = itertools.count(1)
+
+
+def newTaskId():
+    # Ids of everything a worker can have in flight, tasks and batches alike
+    return next(_task_ids)
+
+
+class Task:
+    # One image submitted by a client, as it travels from the ingest
+    # front end through the dispatch layer and back.
+    count = 1  # Client images carried by this unit of work
+
+    def __init__(self, request_id, image, operation, params, on_complete, encoded=False):
+        self.task_id = newTaskId()
+        self.request_id = request_id
+        # Decoded ndarray, or the still encoded file bytes as a uint8 array when encoded is set
+        self.image = image
+        self.encoded = encoded
+        self.operation = operation
+        self.params = params
+        self.on_complete = on_complete
+        self.created = time.monotonic()
+        # When its frame started to arrive, set by the ingest server
+        self.received = self.created
+        self.result_pool = None
+        # (format, quality) the worker encodes the result with, None to get the pixels back
+        self.output = None
+        # Set by the ingest server when the encoded result should be cached
+        self.cache_key = None
+        # Times sent to a worker, the ranks it failed or timed out on and the last such error
+        self.attempts = 0
+        self.failed_ranks = set()
+        self.last_error = None
+        # Scheduling, set by the ingest server: who sent it, its priority class
+        # (None to let the scheduler decide) and a monotonic deadline or None
+        self.client = None
+        self.priority = None
+        self.deadline = None
+        # image_codec.DecodePlan when the client asked for a smaller result
+        self.decode_plan = None
+
+    def complete(self, result=None, error=None):
+        # Called by the dispatch layer exactly once, from the dispatcher thread
+        self.image = None
+        self.on_complete(self, result, error)
+
+    def releaseResult(self, result):
+        # Hand a result buffer back to the pool it was received into, once consumed
+        if self.result_pool is not None and result is not None:
+            self.result_pool.release(result)
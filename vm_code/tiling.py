@@ -0,0 +1,128 @@
+import threading
+
+import cv2
+import numpy as np
+
+from tasks import Task
+from wire_protocol import OP_PIPELINE, OP_EDGES, OP_BLUR
+
+# Splitting one large image into horizontal stripes so several ranks can
+# work on it at once.  Each stripe carries a halo of extra rows from its
+# neighbours, wide enough that every row it owns is computed exactly as it
+# would be on the whole image; the halo rows are cropped off on rank 0.
+#
+# Canny is the one operation that is not local: hysteresis follows weak
+# edges arbitrarily far from a strong one.  For stripes the worker only
+# classifies pixels (see edgeCandidates) and rank 0 runs the hysteresis
+# over the stitched map, which gives exactly cv2.Canny's output.
+
+# Sobel 3x3 for the gradient plus the 3x3 non-maximum suppression around it
+CANNY_HALO = 2
+# Don't bother cutting stripes thinner than this
+MIN_STRIPE_ROWS = 64
+
+EDGE_NONE = 0
+EDGE_WEAK = 1
+EDGE_STRONG = 2
+
+
+def haloFor(operation, params):
+    if operation == OP_PIPELINE:
+        # Every step widens the neighbourhood a stripe row depends on
+        return sum(haloFor(step.operation, step._asdict()) for step in params['steps'])
+    if operation == OP_EDGES:
+        return CANNY_HALO
+    if operation == OP_BLUR:
+        return params.get('ksize', 5) // 2
+    return 0  # Grayscale and inversion are per pixel
+
+
+def endsInEdges(operation, params):
+    if operation == OP_PIPELINE:
+        steps = params['steps']
+        return bool(steps) and steps[-1].operation == OP_EDGES
+    return operation == OP_EDGES
+
+
+def edgeCandidates(gray, threshold1, threshold2):
+    # Canny with low == high returns exactly the non-maximum suppressed pixels
+    # above that threshold, so two passes give the weak and strong sets
+    low, high = min(threshold1, threshold2), max(threshold1, threshold2)
+    labels = (cv2.Canny(gray, low, low) > 0).astype(np.uint8)
+    labels += cv2.Canny(gray, high, high) > 0
+    return labels
+
+
+def hysteresis(labels):
+    # Keep every 8-connected weak component that touches a strong pixel
+    count, components = cv2.connectedComponents((labels != EDGE_NONE).view(np.uint8), connectivity=8)
+    keep = np.zeros(count, dtype=np.uint8)
+    keep[components[labels == EDGE_STRONG]] = 255
+    keep[0] = 0
+    return keep[components]
+
+
+def planStripes(height, count, halo):
+    # (first owned row, end of owned rows, first row shipped, end of rows shipped)
+    count = max(1, min(count, height // MIN_STRIPE_ROWS))
+    bounds = [height * i // count for i in range(count + 1)]
+    return [(bounds[i], bounds[i + 1], max(0, bounds[i] - halo), min(height, bounds[i + 1] + halo))
+            for i in range(count)]
+
+
+class TiledTask:
+    # Fans one Task out into stripe subtasks and completes it once all
+    # stripes are back.  Stripe results are copied into the output as they
+    # arrive, so nothing but the final image is kept around.
+    def __init__(self, task, stripe_count):
+        self.task = task
+        self.deferred_edges = endsInEdges(task.operation, task.params)
+        self.stripes = planStripes(task.image.shape[0], stripe_count, haloFor(task.operation, task.params))
+        self.remaining = len(self.stripes)
+        self.output = None
+        self.error = None
+        self.lock = threading.Lock()
+
+    def subtasks(self):
+        params = dict(self.task.params, deferred_hysteresis=True) if self.deferred_edges else self.task.params
+        subtasks = []
+        for stripe in self.stripes:
+            _, _, top, bottom = stripe
+            subtask = Task(self.task.request_id, self.task.image[top:bottom], self.task.operation, params,
+                           self.stripeDone)
+            subtask.stripe = stripe
+            subtasks.append(subtask)
+        return subtasks
+
+    def stripeDone(self, subtask, result, error):
+        start, end, top, _ = subtask.stripe
+        with self.lock:
+            if error is None and self.error is None:
+                if self.output is None:
+                    height = self.task.image.shape[0]
+                    self.output = np.empty((height,) + result.shape[1:], dtype=result.dtype)
+                self.output[start:end] = result[start - top:end - top]
+            elif self.error is None:
+                self.error = error
+            subtask.releaseResult(result)
+            self.remaining -= 1
+            if self.remaining:
+                return
+        if self.error is not None:
+            self.task.complete(error=self.error)
+        elif self.deferred_edges:
+            self.task.complete(hysteresis(self.output))
+        else:
+            self.task.complete(self.output)
+
+
+def shouldTile(task, min_pixels, capacity):
+    if min_pixels <= 0 or capacity < 2 or task.encoded or task.image is None:
+        return False
+    if task.operation == OP_PIPELINE:
+        # Hysteresis can only be deferred to rank 0 when edges are the last step
+        steps = task.params['steps']
+        if any(step.operation == OP_EDGES for step in steps[:-1]):
+            return False
+    height, width = task.image.shape[:2]
+    return height * width >= min_pixels and height >= 2 * MIN_STRIPE_ROWS
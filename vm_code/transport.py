@@ -0,0 +1,216 @@
+import threading
+from collections import namedtuple
+
+import cv2
+import numpy as np
+from mpi4py import MPI
+
+from image_codec import decodeScaled
+from staging import inMemory, mapSpilled, spillLocation
+
+# Typed buffer transport between rank 0 and the workers.  Only a small
+# pickled header goes through comm.send; the pixels travel as a raw byte
+# buffer with Send/Recv straight out of and into ndarray memory.
+TAG_TASK_DATA = 21      # 0 -> worker: raw bytes belonging to the last TAG_TASK header
+TAG_RESULT_DATA = 22    # worker -> 0: raw bytes belonging to the last TAG_RESULT header
+
+# How the task payload is laid out
+KIND_ARRAY = 'array'        # decoded ndarray
+KIND_ENCODED = 'encoded'    # still encoded file bytes, worker decodes / result already encoded
+
+# Start of the error a worker sends for a task whose parameters no rank could
+# process; rank 0 fails such a task straight away instead of retrying it
+INVALID_TASK = "Invalid task: "
+
+# A batch of small tasks on a worker: entries are
+# (task_id, kind, shape, dtype, operation, params, output, offset) into data
+BatchPayload = namedtuple('BatchPayload', ['batch_id', 'entries', 'data'])
+# The answer to it: entries are (task_id, kind, shape, dtype, error, offset) into data
+BatchResult = namedtuple('BatchResult', ['batch_id', 'entries', 'data', 'timings'])
+
+# Keep at most this many bytes of idle buffers around per pool
+MAX_POOLED_BYTES = 256 * 1024 * 1024
+MIN_BUFFER_SIZE = 64 * 1024
+
+
+class BufferPool:
+    # Reusable receive buffers, bucketed by power of two capacity so an image
+    # of a slightly different size can still reuse the last one's memory.
+    def __init__(self, max_pooled_bytes=MAX_POOLED_BYTES):
+        self.max_pooled_bytes = max_pooled_bytes
+        self.free = {}
+        self.pooled_bytes = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def capacityFor(nbytes):
+        return max(MIN_BUFFER_SIZE, 1 << max(nbytes - 1, 0).bit_length())
+
+    def acquire(self, shape, dtype):
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        capacity = self.capacityFor(nbytes)
+        with self.lock:
+            buffers = self.free.get(capacity)
+            storage = buffers.pop() if buffers else None
+            if storage is not None:
+                self.pooled_bytes -= capacity
+        if storage is None:
+            storage = np.empty(capacity, dtype=np.uint8)
+        return storage[:nbytes].view(dtype).reshape(shape)
+
+    def release(self, array):
+        if not isinstance(array, np.ndarray) or isinstance(array, np.memmap):
+            return  # Encoded results come back as plain bytearrays, spilled tasks are mapped files
+        storage = array.base if array.base is not None else array
+        capacity = storage.nbytes
+        if storage.dtype != np.uint8 or storage.ndim != 1 or capacity != self.capacityFor(capacity):
+            return  # Not one of ours
+        with self.lock:
+            if self.pooled_bytes + capacity <= self.max_pooled_bytes:
+                self.free.setdefault(capacity, []).append(storage)
+                self.pooled_bytes += capacity
+
+
+def bufferSpec(array):
+    return [array, MPI.BYTE]
+
+
+def describe(array):
+    return (array.shape, array.dtype.str)
+
+
+def sendTask(comm, task, dest, tag, local=False):
+    # Non-blocking; returns the requests plus the array that has to stay
+    # alive until they complete.  A worker on the same node (local) reads a
+    # spilled image straight from its file, only the location is sent.
+    kind = KIND_ENCODED if task.encoded else KIND_ARRAY
+    location = spillLocation(task.image) if local else None
+    if location is not None:
+        header = (task.task_id, kind, *describe(task.image), task.operation, task.params, task.output, location)
+        return [comm.isend(header, dest=dest, tag=tag)], None
+    data = inMemory(task.image)
+    header = (task.task_id, kind, *describe(data), task.operation, task.params, task.output, None)
+    requests = [comm.isend(header, dest=dest, tag=tag)]
+    if data.nbytes:
+        requests.append(comm.Isend(bufferSpec(data), dest=dest, tag=TAG_TASK_DATA))
+    return requests, data
+
+
+def receiveTask(comm, header, pool):
+    # header is the already received TAG_TASK message; the payload lands in a
+    # pooled buffer which the caller hands back with pool.release once done,
+    # or is mapped read-only from rank 0's spill file
+    task_id, kind, shape, dtype, operation, params, output, location = header
+    if location is not None:
+        return task_id, kind, mapSpilled(*location, shape, dtype), operation, params, output
+    data = pool.acquire(shape, dtype)
+    if data.nbytes:
+        comm.Recv(bufferSpec(data), source=0, tag=TAG_TASK_DATA)
+    return task_id, kind, data, operation, params, output
+
+
+def decodePayload(kind, data, plan=None):
+    # plan: (reduction, target size) when rank 0 asked for a reduced decode, see image_codec.planDecode
+    if kind != KIND_ENCODED:
+        return data
+    image = cv2.imdecode(data, cv2.IMREAD_COLOR) if plan is None else decodeScaled(data, plan[1], plan[0])
+    if image is None:
+        raise ValueError("Could not decode image")
+    return image
+
+
+def sendResult(comm, task_id, result, error, timings, tag, kind=KIND_ARRAY):
+    # kind is KIND_ENCODED when result is the encoded file as a flat uint8 array.
+    # timings: {span: seconds} spent on the worker, see metrics.SPANS
+    if result is None:
+        comm.send((task_id, kind, None, None, error, timings), dest=0, tag=tag)
+        return
+    result = np.ascontiguousarray(result)
+    comm.send((task_id, kind, *describe(result), error, timings), dest=0, tag=tag)
+    if result.nbytes:
+        comm.Send(bufferSpec(result), dest=0, tag=TAG_RESULT_DATA)
+
+
+def receiveResult(comm, header, source, pool):
+    # Pixels land in a pooled buffer.  Encoded results are received straight
+    # into a bytearray that can be handed to the socket as is.
+    task_id, kind, shape, dtype, error, timings = header
+    result = None
+    if shape is not None:
+        if kind == KIND_ENCODED:
+            result = bytearray(int(np.prod(shape, dtype=np.int64)))
+            spec = [result, MPI.BYTE]
+        else:
+            result = pool.acquire(shape, dtype)
+            spec = bufferSpec(result)
+        if memoryview(result).nbytes:
+            comm.Recv(spec, source=source, tag=TAG_RESULT_DATA)
+    return task_id, result, error, timings
+
+
+def packArrays(arrays):
+    # Copies the arrays back to back into one byte buffer, so a whole batch
+    # travels as a single message.  Returns the buffer and each array's offset.
+    offsets, total = [], 0
+    for array in arrays:
+        offsets.append(total)
+        total += array.nbytes
+    packed = np.empty(total, dtype=np.uint8)
+    for array, offset in zip(arrays, offsets):
+        packed[offset:offset + array.nbytes] = np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+    return packed, offsets
+
+
+def unpackArray(data, shape, dtype, offset):
+    dtype = np.dtype(dtype)
+    count = int(np.prod(shape, dtype=np.int64))
+    return np.frombuffer(data, dtype=dtype, count=count, offset=offset).reshape(shape)
+
+
+def sendBatch(comm, batch, dest, tag):
+    # Same contract as sendTask, for a TaskBatch
+    arrays = [inMemory(task.image) for task in batch.tasks]
+    packed, offsets = packArrays(arrays)
+    entries = [(task.task_id, KIND_ENCODED if task.encoded else KIND_ARRAY, *describe(array),
+                task.operation, task.params, task.output, offset)
+               for task, array, offset in zip(batch.tasks, arrays, offsets)]
+    requests = [comm.isend((batch.task_id, packed.nbytes, entries), dest=dest, tag=tag)]
+    if packed.nbytes:
+        requests.append(comm.Isend(bufferSpec(packed), dest=dest, tag=TAG_TASK_DATA))
+    return requests, packed
+
+
+def receiveBatch(comm, header, pool):
+    batch_id, nbytes, entries = header
+    data = pool.acquire((nbytes,), np.uint8)
+    if nbytes:
+        comm.Recv(bufferSpec(data), source=0, tag=TAG_TASK_DATA)
+    return BatchPayload(batch_id, entries, data)
+
+
+def sendBatchResult(comm, batch_result, tag):
+    data = batch_result.data
+    comm.send((batch_result.batch_id, data.nbytes, batch_result.entries, batch_result.timings),
+              dest=0, tag=tag)
+    if data.nbytes:
+        comm.Send(bufferSpec(data), dest=0, tag=TAG_RESULT_DATA)
+
+
+def receiveBatchResult(comm, header, source):
+    # Returns the batch id, {task_id: (result, error)} and the worker's timings for the whole batch.
+    # Pixel results are views into one bytearray that lives as long as they do,
+    # so they must not be handed to a BufferPool.
+    batch_id, nbytes, entries, timings = header
+    data = bytearray(nbytes)
+    if nbytes:
+        comm.Recv([data, MPI.BYTE], source=source, tag=TAG_RESULT_DATA)
+    results = {}
+    for task_id, kind, shape, dtype, error, offset in entries:
+        result = None
+        if shape is not None:
+            result = unpackArray(data, shape, dtype, offset)
+            if kind == KIND_ENCODED:
+                result = bytearray(result)
+        results[task_id] = (result, error)
+    return batch_id, results, timings
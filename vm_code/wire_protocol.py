@@ -0,0 +1,232 @@
+import socket
+import struct
+from collections import namedtuple
+
+# Every message on the ingest socket is a fixed size header followed by
+# exactly payload_length bytes of payload, so the receiver never has to
+# scan the image bytes for a sentinel and many images can be pipelined
+# on one connection without waiting for an acknowledgement.
+#
+#   magic (2s) | version (B) | frame type (B) | operation (B) | flags (B)
+#   output format (B) | quality (B) | ksize (H) | threshold1 (H) | threshold2 (H)
+#   request id (I) | payload length (Q)
+HEADER = struct.Struct('!2sBBBBBBHHHIQ')
+HEADER_SIZE = HEADER.size
+MAGIC = b'IP'
+VERSION = 2
+
+# Frame types
+FRAME_IMAGE = 1     # client -> server: encoded image to be processed
+FRAME_END = 2       # both ways: no more frames will follow on this connection
+FRAME_RESULT = 3    # server -> client: processed image for request_id
+FRAME_ERROR = 4     # server -> client: request_id failed, payload is the message
+
+# Operation codes, same numbering as ImageWorker.perform_operation
+OP_PIPELINE = 0     # payload starts with a pipeline table, see packPipeline
+OP_EDGES = 1
+OP_BLUR = 2
+OP_GRAYSCALE = 3
+OP_INVERT = 4
+
+# Image frame flags
+FLAG_BULK = 0x01         # throughput over latency, e.g. a big upload of many images
+FLAG_INTERACTIVE = 0x02  # someone is waiting on this one; with neither flag the server decides
+FLAG_DEADLINE = 0x04     # payload starts with a deadline, see DEADLINE
+FLAG_RESIZE = 0x08       # only a smaller result is wanted, see TARGET_SIZE
+PRIORITY_FLAGS = {'interactive': FLAG_INTERACTIVE, 'bulk': FLAG_BULK}
+
+# Encoding of the processed image.  On an image frame it is what the client
+# asks for, on a result frame it is what the payload actually is.
+FORMAT_AUTO = 0     # PNG for edge maps, JPEG for everything else
+FORMAT_JPEG = 1
+FORMAT_PNG = 2
+FORMAT_WEBP = 3
+# quality: 1-100 for JPEG and WebP, PNG compression level 1-9, 0 for the encoder default
+
+# Default operation parameters
+DEFAULT_KSIZE = 5
+DEFAULT_THRESHOLD1 = 90
+DEFAULT_THRESHOLD2 = 180
+
+# Refuse frames bigger than this instead of trying to allocate them
+MAX_PAYLOAD = 256 * 1024 * 1024
+INITIAL_BUFFER_SIZE = 1024 * 1024
+
+# Pipeline table at the front of an OP_PIPELINE payload: a step count, then
+# one fixed size entry per step, then the image bytes
+PIPELINE_COUNT = struct.Struct('!B')
+PIPELINE_STEP = struct.Struct('!BxHHH')
+MAX_PIPELINE_STEPS = 32
+
+# Milliseconds from arrival after which the result is no longer wanted, at
+# the very front of the payload of a frame with FLAG_DEADLINE
+DEADLINE = struct.Struct('!I')
+# Width and height of the box the result has to fit in, after the deadline if
+# there is one.  The image is downscaled as early as possible, never enlarged.
+TARGET_SIZE = struct.Struct('!HH')
+
+FrameHeader = namedtuple('FrameHeader', ['frame_type', 'operation', 'flags', 'output_format', 'quality', 'ksize',
+                                         'threshold1', 'threshold2', 'request_id', 'payload_length'])
+
+PipelineStep = namedtuple('PipelineStep', ['operation', 'ksize', 'threshold1', 'threshold2'],
+                          defaults=[DEFAULT_KSIZE, DEFAULT_THRESHOLD1, DEFAULT_THRESHOLD2])
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def packHeader(frame_type, request_id=0, payload_length=0, operation=0, flags=0,
+               ksize=DEFAULT_KSIZE, threshold1=DEFAULT_THRESHOLD1, threshold2=DEFAULT_THRESHOLD2,
+               output_format=FORMAT_AUTO, quality=0):
+    return HEADER.pack(MAGIC, VERSION, frame_type, operation, flags, output_format, quality,
+                       ksize, threshold1, threshold2, request_id, payload_length)
+
+
+def unpackHeader(data):
+    magic, version, *fields = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise ProtocolError(f"Bad frame magic: {magic!r}")
+    if version != VERSION:
+        raise ProtocolError(f"Unsupported protocol version: {version}")
+    header = FrameHeader(*fields)
+    if header.payload_length > MAX_PAYLOAD:
+        raise ProtocolError(f"Frame payload too large: {header.payload_length} bytes")
+    return header
+
+
+def operationParams(header):
+    # Parameters handed to ImageWorker.perform_operation for an image frame
+    return {'ksize': header.ksize, 'threshold1': header.threshold1, 'threshold2': header.threshold2}
+
+
+def pipelineStep(step):
+    # Accepts a bare operation code, a dict of PipelineStep fields or a tuple
+    if isinstance(step, int):
+        return PipelineStep(step)
+    if isinstance(step, dict):
+        return PipelineStep(**step)
+    return PipelineStep(*step)
+
+
+def packPipeline(steps):
+    if not 0 < len(steps) <= MAX_PIPELINE_STEPS:
+        raise ProtocolError(f"A pipeline needs between 1 and {MAX_PIPELINE_STEPS} steps")
+    table = [PIPELINE_COUNT.pack(len(steps))]
+    table += [PIPELINE_STEP.pack(*pipelineStep(step)) for step in steps]
+    return b''.join(table)
+
+
+def splitPipelinePayload(payload):
+    # Returns the list of PipelineStep and a view of the image bytes behind the table
+    view = memoryview(payload)
+    if len(view) < PIPELINE_COUNT.size:
+        raise ProtocolError("Pipeline frame too short")
+    count, = PIPELINE_COUNT.unpack_from(view)
+    table_size = PIPELINE_COUNT.size + count * PIPELINE_STEP.size
+    if not 0 < count <= MAX_PIPELINE_STEPS or len(view) < table_size:
+        raise ProtocolError(f"Bad pipeline table with {count} steps")
+    steps = [PipelineStep(*PIPELINE_STEP.unpack_from(view, PIPELINE_COUNT.size + i * PIPELINE_STEP.size))
+             for i in range(count)]
+    return steps, view[table_size:]
+
+
+def packOptions(priority=None, deadline_ms=None, target_size=None):
+    # Returns the flags and payload prefix for a priority class name, a deadline and a target size
+    flags = PRIORITY_FLAGS[priority] if priority is not None else 0
+    prefix = b''
+    if deadline_ms is not None:
+        flags |= FLAG_DEADLINE
+        prefix += DEADLINE.pack(deadline_ms)
+    if target_size is not None:
+        if not all(0 < side <= 0xFFFF for side in target_size):
+            raise ProtocolError(f"Bad target size: {target_size}")
+        flags |= FLAG_RESIZE
+        prefix += TARGET_SIZE.pack(*target_size)
+    return flags, prefix
+
+
+def splitDeadline(header, payload):
+    # Returns the deadline in milliseconds, or None, and the rest of the payload
+    if not header.flags & FLAG_DEADLINE:
+        return None, payload
+    if len(payload) < DEADLINE.size:
+        raise ProtocolError("Frame too short for its deadline")
+    deadline_ms, = DEADLINE.unpack_from(payload)
+    return deadline_ms, memoryview(payload)[DEADLINE.size:]
+
+
+def splitTargetSize(header, payload):
+    # Returns (width, height) or None, and the rest of the payload
+    if not header.flags & FLAG_RESIZE:
+        return None, payload
+    if len(payload) < TARGET_SIZE.size:
+        raise ProtocolError("Frame too short for its target size")
+    target = TARGET_SIZE.unpack_from(payload)
+    if not all(target):
+        raise ProtocolError(f"Bad target size: {target}")
+    return target, memoryview(payload)[TARGET_SIZE.size:]
+
+
+def configureSocket(sock):
+    # Headers are tiny, don't let Nagle hold them back waiting for an ack
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+
+
+def recvExact(sock, view):
+    # Fill the whole memoryview straight from the socket, no intermediate copies
+    received = 0
+    total = len(view)
+    while received < total:
+        count = sock.recv_into(view[received:], total - received)
+        if count == 0:
+            raise ConnectionError("Connection closed in the middle of a frame")
+        received += count
+
+
+def sendFrame(sock, header, payload=b''):
+    payload = memoryview(payload).cast('B')
+    total = len(header) + len(payload)
+    if not len(payload):
+        sock.sendall(header)
+        return
+    # One syscall for header + payload in the common case
+    sent = sock.sendmsg([header, payload])
+    if sent < len(header):
+        sock.sendall(header[sent:])
+        sock.sendall(payload)
+    elif sent < total:
+        sock.sendall(payload[sent - len(header):])
+
+
+class FrameReader:
+    def __init__(self, sock, initial_size=INITIAL_BUFFER_SIZE):
+        self.sock = sock
+        self.header_buffer = bytearray(HEADER_SIZE)
+        self.buffer = bytearray(initial_size)
+
+    def readHeader(self):
+        # Returns None if the peer closed the connection between frames
+        view = memoryview(self.header_buffer)
+        count = self.sock.recv_into(view, HEADER_SIZE)
+        if count == 0:
+            return None
+        if count < HEADER_SIZE:
+            recvExact(self.sock, view[count:])
+        return unpackHeader(self.header_buffer)
+
+    def readFrame(self):
+        # The returned payload view is only valid until the next readFrame call
+        header = self.readHeader()
+        if header is None:
+            return None, None
+        length = header.payload_length
+        if length > len(self.buffer):
+            # Replace rather than resize, older views may still be exported
+            self.buffer = bytearray(max(length, 2 * len(self.buffer)))
+        payload = memoryview(self.buffer)[:length]
+        recvExact(self.sock, payload)
+        return header, payload
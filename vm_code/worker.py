@@ -0,0 +1,330 @@
+import os
+import queue
+import threading
+import time
+import urllib.request
+
+import cv2
+import numpy as np
+from mpi4py import MPI
+
+from batching import stackImages, stackKey, unstack
+from dispatcher import TAG_READY, TAG_RESULT, TAG_STOP, TAG_STOPPED, TAG_BATCH, TAG_BATCH_RESULT
+from image_codec import encodeImage
+from pipeline import checkTask, runPipeline
+from tiling import edgeCandidates
+from transport import (INVALID_TASK, KIND_ARRAY, KIND_ENCODED, BatchPayload, BatchResult, BufferPool, decodePayload,
+                       describe, packArrays, receiveBatch, receiveTask, sendBatchResult, sendResult, unpackArray)
+from wire_protocol import ProtocolError
+
+IDLE_SLEEP = 0.0005
+MAX_IDLE_SLEEP = 0.005
+# EC2 instance metadata service, only asked when INSTANCE_ID is not set
+METADATA_URL = 'http://169.254.169.254/latest'
+METADATA_TIMEOUT = 0.5
+
+
+def availableCores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def instanceId():
+    # Lets the cluster controller tie this rank to the instance it runs on
+    instance_id = os.environ.get('INSTANCE_ID')
+    if instance_id:
+        return instance_id
+    try:
+        token_request = urllib.request.Request(f'{METADATA_URL}/api/token', method='PUT',
+                                               headers={'X-aws-ec2-metadata-token-ttl-seconds': '60'})
+        with urllib.request.urlopen(token_request, timeout=METADATA_TIMEOUT) as response:
+            token = response.read().decode()
+        id_request = urllib.request.Request(f'{METADATA_URL}/meta-data/instance-id',
+                                            headers={'X-aws-ec2-metadata-token': token})
+        with urllib.request.urlopen(id_request, timeout=METADATA_TIMEOUT) as response:
+            return response.read().decode()
+    except OSError:
+        return None  # Not on EC2
+
+
+def configureOpenCVThreads(pool_size, cores=None):
+    # Every pool thread already runs its own OpenCV call, so only let OpenCV's
+    # internal parallel_for use whatever cores the pool leaves over
+    cores = cores or availableCores()
+    cv2.setNumThreads(max(1, cores // pool_size))
+
+
+class ImageWorker(threading.Thread):
+    # Long lived pool thread.  OpenCV releases the GIL, so a handful of these
+    # keep all the cores of a rank busy without any process overhead.
+    def __init__(self, rank, task_queue, result_queue, buffers):
+        super().__init__(daemon=True)
+        self.rank = rank
+        self.task_queue = task_queue
+        self.result_queue = result_queue
+        self.buffers = buffers
+
+    def run(self):
+        while True:
+            task = self.task_queue.get()
+            if task is None:  # Termination signal
+                break
+            if isinstance(task, BatchPayload):
+                self.result_queue.put(self.runBatch(task))
+                continue
+            task_id, kind, data, operation_code, params, output = task
+            result, error, timings, result_kind = self.runTask(kind, data, operation_code, params, output)
+            if result is None or not np.may_share_memory(result, data):
+                self.buffers.release(data)
+            self.result_queue.put((task_id, result, error, timings, result_kind))
+
+    def runTask(self, kind, data, operation_code, params, output):
+        # Decode, operation and encode for one image, whatever engine it came from.
+        # Returns (result, error, timings, result kind).
+        timings = {}
+        start = time.perf_counter()
+        result, error, result_kind = None, None, KIND_ARRAY
+        try:
+            checkTask(operation_code, params)
+            image = decodePayload(kind, data, params.get('decode'))
+            decoded = time.perf_counter()
+            if kind == KIND_ENCODED:
+                timings['decode'] = decoded - start
+            # The receive buffer is ours, pipelines may work in place; a mapped spill file is read-only
+            result = self.perform_operation(image, operation_code, params, owned=image.flags.writeable)
+            computed = time.perf_counter()
+            timings['compute'] = computed - decoded
+            if result is None:
+                error = f"Operation {operation_code} failed on worker {self.rank}"
+            elif output is not None:
+                # Encode here so only the compressed file crosses MPI and rank 0 never touches pixels
+                result, result_kind = encodeImage(result, *output), KIND_ENCODED
+                timings['encode'] = time.perf_counter() - computed
+        except ProtocolError as e:
+            result, error = None, INVALID_TASK + str(e)
+        except Exception as e:
+            result, error = None, str(e)
+            print(f"Error in worker {self.rank}: {e}")
+        return result, error, timings, result_kind
+
+    def runBatch(self, batch):
+        start = time.perf_counter()
+        decode_seconds = encode_seconds = 0.0
+        count = len(batch.entries)
+        images, results, errors = [None] * count, [None] * count, [None] * count
+        kinds = [KIND_ARRAY] * count
+        groups = {}
+        for index, (_, kind, shape, dtype, operation, params, _, offset) in enumerate(batch.entries):
+            try:
+                checkTask(operation, params)
+            except ProtocolError as e:
+                errors[index] = INVALID_TASK + str(e)
+                continue
+            try:
+                images[index] = decodePayload(kind, unpackArray(batch.data, shape, dtype, offset),
+                                              params.get('decode'))
+            except Exception as e:
+                errors[index] = str(e)
+                continue
+            key = stackKey(operation, params, images[index])
+            groups.setdefault(index if key is None else key, []).append(index)
+
+        decoded = time.perf_counter()
+        if any(entry[1] == KIND_ENCODED for entry in batch.entries):
+            decode_seconds = decoded - start
+        for indices in groups.values():
+            operation, params = batch.entries[indices[0]][4:6]
+            if len(indices) > 1:
+                # One OpenCV call over all the images stacked on top of each other
+                stacked = self.perform_operation(stackImages([images[i] for i in indices]), operation, params,
+                                                 owned=True)
+                outputs = unstack(stacked, len(indices)) if stacked is not None else [None] * len(indices)
+            else:
+                outputs = [self.perform_operation(images[indices[0]], operation, params, owned=True)]
+            for index, result in zip(indices, outputs):
+                output = batch.entries[index][6]
+                if result is None:
+                    errors[index] = f"Operation {operation} failed on worker {self.rank}"
+                elif output is not None:
+                    encode_start = time.perf_counter()
+                    try:
+                        result, kinds[index] = encodeImage(result, *output), KIND_ENCODED
+                    except Exception as e:
+                        result, errors[index] = None, str(e)
+                    encode_seconds += time.perf_counter() - encode_start
+                results[index] = result
+
+        # Everything goes back in one buffer; after packing nothing refers to the input any more
+        packed, offsets = packArrays([result for result in results if result is not None])
+        offsets = iter(offsets)
+        entries = []
+        for (task_id, *_), result, kind, error in zip(batch.entries, results, kinds, errors):
+            if result is None:
+                entries.append((task_id, kind, None, None, error, 0))
+            else:
+                entries.append((task_id, kind, *describe(result), error, next(offsets)))
+        self.buffers.release(batch.data)
+        timings = {'compute': time.perf_counter() - decoded - encode_seconds}
+        if decode_seconds:
+            timings['decode'] = decode_seconds
+        if encode_seconds:
+            timings['encode'] = encode_seconds
+        return BatchResult(batch.batch_id, entries, packed, timings)
+
+    def perform_operation(self, image, operation_code, params=None, owned=False):
+        params = params or {}
+        try:
+            if operation_code == 0:
+                return self.runSteps(image, params['steps'], params.get('deferred_hysteresis'), owned)
+            elif operation_code == 1 and params.get('deferred_hysteresis'):
+                # Stripe of a tiled image, rank 0 finishes the hysteresis
+                gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+                return edgeCandidates(gray_image, params.get('threshold1', 90), params.get('threshold2', 180))
+            elif operation_code == 1:
+                return self.edgeDetection(image, params.get('threshold1', 90), params.get('threshold2', 180))
+            elif operation_code == 2:
+                ksize = params.get('ksize', 5)
+                return self.imageBlur(image, (ksize, ksize))
+            elif operation_code == 3:
+                return self.convertToGrayscale(image)
+            elif operation_code == 4:
+                return self.colorInversion(image)
+            else:
+                raise ValueError(f"Unknown operation code: {operation_code}")
+        except Exception as e:
+            print(f"Error during image processing: {e}")
+            return None
+
+    def runSteps(self, img, steps, deferred_hysteresis=False, owned=False):
+        if not deferred_hysteresis:
+            return runPipeline(img, steps, owned)
+        # Stripe of a tiled image whose pipeline ends in edge detection
+        *steps, edges = steps
+        gray_image = runPipeline(img, steps, owned)
+        if gray_image.ndim == 3:
+            gray_image = cv2.cvtColor(gray_image, cv2.COLOR_BGR2GRAY)
+        return edgeCandidates(gray_image, edges.threshold1, edges.threshold2)
+
+    def imageBlur(self, img, ksize=(5, 5)):
+        try:
+            blurred_image = cv2.GaussianBlur(img, ksize, 0)
+            return blurred_image
+        except Exception as e:
+            print(f"Blurring error: {e}")
+            return None
+
+    def edgeDetection(self, img, threshold1=90, threshold2=180):
+        try:
+            gray_image = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            edges = cv2.Canny(gray_image, threshold1, threshold2)
+            return edges
+        except Exception as e:
+            print(f"Edge detection error: {e}")
+            return None
+
+    def colorInversion(self, img):
+        try:
+            inverted_image = cv2.bitwise_not(img)
+            return inverted_image
+        except Exception as e:
+            print(f"Color inversion error: {e}")
+            return None
+
+    def convertToGrayscale(self, img):
+        try:
+            gray_image = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            return gray_image
+        except Exception as e:
+            print(f"Grayscale conversion error: {e}")
+            return None
+
+
+class WorkerPool:
+    # One per worker rank.  The main thread is the only one that talks MPI:
+    # it keeps the pool's task queue fed and sends back whatever the pool
+    # threads finish, so MPI never has to be called from several threads.
+    def __init__(self, comm, size=None):
+        self.comm = comm
+        self.rank = comm.Get_rank()
+        cores = availableCores()
+        self.size = size or cores
+        configureOpenCVThreads(self.size, cores)
+        self.task_queue = queue.Queue()
+        self.result_queue = queue.Queue()
+        self.buffers = BufferPool()
+        self.threads = [ImageWorker(self.rank, self.task_queue, self.result_queue, self.buffers)
+                        for _ in range(self.size)]
+
+    def sendItem(self, item):
+        if isinstance(item, BatchResult):
+            sendBatchResult(self.comm, item, TAG_BATCH_RESULT)
+        else:
+            task_id, result, error, timings, kind = item
+            sendResult(self.comm, task_id, result, error, timings, TAG_RESULT, kind)
+
+    def sendResults(self):
+        sent = 0
+        while True:
+            try:
+                item = self.result_queue.get_nowait()
+            except queue.Empty:
+                return sent
+            self.sendItem(item)
+            sent += 1
+
+    def receiveTask(self, header):
+        try:
+            self.task_queue.put(receiveTask(self.comm, header, self.buffers))
+        except Exception as e:
+            # e.g. rank 0 removed the spill file after giving the task to another rank; only this task fails
+            print(f"Error in worker {self.rank}: {e}")
+            self.result_queue.put((header[0], None, f"Could not receive the image on worker {self.rank}: {e}", {},
+                                   KIND_ARRAY))
+
+    def run(self):
+        for thread in self.threads:
+            thread.start()
+        ready = {'capacity': self.size, 'host': MPI.Get_processor_name(), 'instance': instanceId()}
+        self.comm.send(ready, dest=0, tag=TAG_READY)
+        status = MPI.Status()
+        idle_sleep = IDLE_SLEEP
+        try:
+            while True:
+                progress = self.sendResults()
+                if self.comm.Iprobe(source=0, tag=MPI.ANY_TAG, status=status):
+                    tag = status.Get_tag()
+                    header = self.comm.recv(source=0, tag=tag)
+                    if tag == TAG_STOP:
+                        break
+                    if tag == TAG_BATCH:
+                        self.task_queue.put(receiveBatch(self.comm, header, self.buffers))
+                    else:
+                        self.receiveTask(header)
+                    progress += 1
+                if progress:
+                    idle_sleep = IDLE_SLEEP
+                    continue
+                # Nothing to do: sleep on the result queue so a finished image goes out at once
+                try:
+                    self.sendItem(self.result_queue.get(timeout=idle_sleep))
+                except queue.Empty:
+                    idle_sleep = min(idle_sleep * 2, MAX_IDLE_SLEEP)
+        finally:
+            self.stop()
+        # Every thread is gone; rank 0 may now have this node shut down
+        self.comm.send(None, dest=0, tag=TAG_STOPPED)
+
+    def stop(self):
+        for _ in self.threads:
+            self.task_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+def worker_main(comm, pool_size=None):
+    try:
+        WorkerPool(comm, pool_size).run()
+    except Exception as e:
+        print(f"Worker error: {e}")